@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+"""Compares the parsers of RSS Feeds of YaRSS2 on an RSS Feed file"""
+
+import argparse
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Compare the parsers of RSS Feeds on an RSS Feed file")
+    parser.add_argument("file", help="The RSS Feed file")
+    parser.add_argument("-n", "--number", type=int, default=10, help="Parses with each parser (default: 10)")
+    parser.add_argument("-p", "--parser", action="append", dest="names", help="Only this parser (repeatable)")
+    parser.add_argument("--full-items", action="store_true", help="Parse all the values of the items")
+    args = parser.parse_args(args)
+
+    # The bundled libraries, e.g. atoma, are added to sys.path
+    from yarss2 import load_libs
+    load_libs()
+    from yarss2.util import feed_parsers
+
+    with open(args.file, "rb") as f:
+        data = f.read()
+    for backend in feed_parsers.get_backends():
+        if not backend.is_available():
+            print("%-12s not available (requires %s)" % (backend.name, ", ".join(backend.requires)))
+    for name, seconds, items in feed_parsers.benchmark(data, names=args.names, number=args.number,
+                                                       full_items=args.full_items):
+        print("%-12s %10.3f ms %6d items" % (name, seconds * 1000, items))
+
+
+if __name__ == '__main__':
+    main()
@@ -7,14 +7,20 @@
 # See LICENSE for more details.
 #
 
+import os
+
+from twisted.internet import threads
+
+import deluge.configmanager
 from deluge.core.rpcserver import export
 from deluge.plugins.pluginbase import CorePluginBase
 
 import yarss2.util.common
-from yarss2.rssfeed_scheduler import RSSFeedScheduler
+from yarss2.rssfeed_handling import reset_change_detection
+from yarss2.rssfeed_scheduler import PRIORITY_MANUAL, RSSFeedScheduler
 from yarss2.torrent_handling import TorrentHandler
-from yarss2.util import logging
-from yarss2.util.http import get_matching_cookies_dict
+from yarss2.util import http_sessions, logging
+from yarss2.util.torrent_cache import CACHE_DIRNAME, TorrentCache
 from yarss2.util.yarss_email import send_torrent_email
 from yarss2.yarss_config import YARSSConfig, get_user_agent
 
@@ -37,25 +43,47 @@ class Core(CorePluginBase):
 
     def enable(self, config=None):
         self.log = logging.getLogger(__name__)
-        self.torrent_handler = TorrentHandler(self.log)
         if config is None:
             self.yarss_config = YARSSConfig(self.log)
         else:
             self.yarss_config = config
-        self.rssfeed_scheduler = RSSFeedScheduler(self.yarss_config, self.log)
+        # Shared by the torrents added by the GUI and by the RSS Feed updates
+        self.torrent_cache = TorrentCache(os.path.join(deluge.configmanager.get_config_dir(), CACHE_DIRNAME),
+                                          max_size=self.yarss_config.get_config()["general"]["torrent_cache_size"])
+        self.torrent_handler = TorrentHandler(self.log, torrent_cache=self.torrent_cache)
+        self.rssfeed_scheduler = RSSFeedScheduler(self.yarss_config, self.log, torrent_cache=self.torrent_cache)
         self.rssfeed_scheduler.enable_timers()
         self.log.info("Enabled YaRSS2 %s" % yarss2.util.common.get_version())
 
     def disable(self):
         self.yarss_config.save()
         self.rssfeed_scheduler.disable_timers()
+        # Close the idle connections of the HTTP client
+        self.rssfeed_scheduler.set_async_http(False)
+        http_sessions.session_pool.close()
+        self.torrent_cache.flush()
 
     def update(self):
         pass
 
     @export
     def initiate_rssfeed_update(self, rssfeed_key, subscription_key=None):
-        return self.rssfeed_scheduler.queue_rssfeed_update(rssfeed_key, subscription_key=subscription_key)
+        # Run before the updates queued by the timer
+        return self.rssfeed_scheduler.queue_rssfeed_update(rssfeed_key, subscription_key=subscription_key,
+                                                           priority=PRIORITY_MANUAL)
+
+    @export
+    def get_feed_update_stats(self):
+        """Returns the number of running and queued jobs in each stage of the RSS Feed
+        updates (fetch, match and download), and the number of jobs abandoned for
+        not finishing within the deadline. The fetch stats also count the fetches
+        that were skipped because the RSS Feed had not changed."""
+        return self.rssfeed_scheduler.get_stage_stats()
+
+    @export
+    def get_feed_health(self):
+        """Returns the circuit breaker state of the RSS Feeds with failed updates, by RSS Feed key"""
+        return self.rssfeed_scheduler.feed_health.get_states()
 
     @export
     def get_config(self):
@@ -64,11 +92,15 @@ class Core(CorePluginBase):
 
     @export
     def save_general_config(self, conf):
-        conf = {"general": conf}
+        # Keep the values not included in conf, e.g. when saved by an older client
+        general = dict(self.yarss_config.get_config()["general"])
+        general.update(conf)
+        conf = {"general": general}
         try:
             self.yarss_config.set_config(conf)
         except ValueError as v:
             self.log.error("Failed to save general configurations:" + str(v))
+        self.rssfeed_scheduler.update_run_queue_limits()
 
     @export
     def save_email_configurations(self, email_configurations):
@@ -90,18 +122,33 @@ class Core(CorePluginBase):
                 self.log.info("Deleting Subscription '%s'" %
                               self.yarss_config.get_config()["subscriptions"][dict_key]["name"])
         try:
-            return self.yarss_config.generic_save_config("subscriptions", dict_key=dict_key,
-                                                         data_dict=subscription_data, delete=delete)
+            config = self.yarss_config.generic_save_config("subscriptions", dict_key=dict_key,
+                                                           data_dict=subscription_data, delete=delete)
+            if subscription_data is not None:
+                self._reset_change_detection(subscription_data["rssfeed_key"])
+            return config
         except ValueError as v:
             self.log.error("Failed to save subscription:" + str(v))
         return None
 
+    def _reset_change_detection(self, rssfeed_key):
+        """Make the next update parse the whole RSS Feed, so that a changed
+        subscription is matched against all the items"""
+        rssfeed = self.yarss_config.get_config()["rssfeeds"].get(rssfeed_key)
+        if rssfeed is not None:
+            reset_change_detection(rssfeed)
+
     @export
     def save_rssfeed(self, dict_key=None, rssfeed_data=None, delete=False):
         """Saves the rssfeed in rssfeed_data.
         If rssfeed_data is None and delete=True, delete rssfeed with key==dict_key
         """
         try:
+            if rssfeed_data is not None:
+                old_rssfeed = self.yarss_config.get_config()["rssfeeds"].get(rssfeed_data.get("key"))
+                # The ETag, Last-Modified and content hash belong to the old URL
+                if old_rssfeed is not None and old_rssfeed["url"] != rssfeed_data["url"]:
+                    reset_change_detection(rssfeed_data)
             if delete:
                 if rssfeed_data is not None:
                     self.log.warn("save_rssfeed called with delete=True, but rssfeed_data is not None!")
@@ -113,7 +160,8 @@ class Core(CorePluginBase):
                                                            data_dict=rssfeed_data, delete=delete)
             if delete is True:
                 self.rssfeed_scheduler.delete_timer(dict_key)
-            # Successfully saved rssfeed, check if timer was changed
+            # Successfully saved rssfeed, check if timer was changed.
+            # An existing RSS Feed keeps its phase, so it's not updated when saved.
             elif config:
                 if self.rssfeed_scheduler.set_timer(rssfeed_data["key"], rssfeed_data["update_interval"],
                                                     rssfeed_data["update_on_startup"]):
@@ -163,13 +211,21 @@ class Core(CorePluginBase):
 
     @export
     def add_torrent(self, torrent_info):
-        site_cookies_dict = get_matching_cookies_dict(self.yarss_config.get_config()["cookies"], torrent_info["link"])
+        site_cookies_dict = self.yarss_config.get_cookie_index().get_cookies(torrent_info["link"])[0]
         torrent_info["site_cookies_dict"] = site_cookies_dict
         if "rssfeed_key" in torrent_info:
             rssfeed_data = self.yarss_config.get_config()["rssfeeds"][torrent_info["rssfeed_key"]]
             torrent_info["user_agent"] = get_user_agent(rssfeed_data=rssfeed_data)
-        torrent_download = self.torrent_handler.add_torrent(torrent_info)
-        return torrent_download.to_dict()
+
+        def add_torrent(torrent_download):
+            torrent_info["torrent_download"] = torrent_download
+            return self.torrent_handler.add_torrent(torrent_info).to_dict()
+
+        # The download waits for the rate limit of the site, so it must not block the reactor.
+        # The torrent is added to Deluge in the main thread.
+        d = threads.deferToThread(self.torrent_handler.get_torrent, torrent_info)
+        d.addCallback(add_torrent)
+        return d
 
     @export
     def get_completion_paths(self, value):
@@ -180,6 +236,7 @@ class Core(CorePluginBase):
 
     @export
     def get_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None):
-        return self.rssfeed_scheduler.rssfeedhandler.get_rssfeed_parsed(rssfeed_data,
-                                                                        site_cookies_dict=site_cookies_dict,
-                                                                        user_agent=user_agent)
+        # Downloaded and parsed in a worker thread, like the updates of the RSS Feeds
+        return threads.deferToThread(self.rssfeed_scheduler.rssfeedhandler.get_rssfeed_parsed, rssfeed_data,
+                                     site_cookies_dict=site_cookies_dict, user_agent=user_agent,
+                                     full_items=True)
@@ -3,3 +3,17 @@ from deluge.error import DelugeError
 
 class FetchAndFeedparsingError(DelugeError):
     pass
+
+
+class FeedHostNotFoundError(FetchAndFeedparsingError):
+    """The host name of the RSS Feed could not be resolved"""
+    pass
+
+
+class FeedUpdateDeadlineError(DelugeError):
+    pass
+
+
+class DownloadRejectedError(DelugeError):
+    """The response is too large, or has a content type that is not accepted"""
+    pass
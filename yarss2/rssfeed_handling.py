@@ -6,13 +6,29 @@
 # the additional special exception to link portions of this program with the OpenSSL library.
 # See LICENSE for more details.
 #
+import hashlib
 import re
 
-import attr
+import twisted.internet.defer as defer
 
-from yarss2.error import FetchAndFeedparsingError
-from yarss2.util import common, http
-from yarss2.yarss_config import get_user_agent
+from yarss2.error import FeedHostNotFoundError, FeedUpdateDeadlineError, FetchAndFeedparsingError
+from yarss2.util import common, feed_parsers, http, torrent_cache
+from yarss2.util.single_flight import SingleFlight
+from yarss2.yarss_config import DEFAULT_MAX_FEED_SIZE, get_user_agent
+
+
+# The values in the RSS Feed config used to detect that the RSS Feed has not changed
+CHANGE_DETECTION_KEYS = ("etag", "last_modified", "content_hash")
+
+
+def reset_change_detection(rssfeed_data):
+    """Make the next update of the RSS Feed parse and match all the items"""
+    for key in CHANGE_DETECTION_KEYS:
+        rssfeed_data[key] = ""
+
+
+def get_content_hash(content):
+    return hashlib.sha1(content).hexdigest()
 
 
 def _parse_size(string):
@@ -68,76 +84,90 @@ def get_download_size(item):
     return _get_size(item)
 
 
-def atoma_result_to_dict(atoma_result):
-
-    def item_to_dict(item):
-        d = attr.asdict(item)
-        if d['pub_date'] is not None:
-            dt = d['pub_date']
-            if dt.tzinfo is None:
-                dt = common.datetime_add_timezone(dt)
-            d['published_date'] = dt.isoformat()
-            # We must remove datetime.datetime to make the dict encodable by rencode
-            del d['pub_date']
-
-        return d
-
-    items = [item_to_dict(item) for item in atoma_result.items if item.title is not None]
-    result = {
-        'items': items, 'bozo': 0,
-        'feed': {
-            'ttl': atoma_result.ttl,
-            'encoded': atoma_result.content_encoded,
-            'link': atoma_result.link,
-            'title': atoma_result.title,
-            'subtitle': atoma_result.description,
-            'language': atoma_result.language,
-            'version': atoma_result.version,
-        }
-    }
-    return result
-
-
-def fetch_and_parse_rssfeed_atom(url_file_stream_or_string, site_cookies_dict=None,
-                                 user_agent=None, request_headers=None, timeout=10):
+def fetch_and_parse_rssfeed(url_file_stream_or_string, site_cookies_dict=None,
+                            user_agent=None, request_headers=None, timeout=10, etag=None, modified=None,
+                            content_hash=None, max_size=None, watermark=None, full_items=False, parser=None):
     result = http.download_file(url_file_stream_or_string, site_cookies_dict=site_cookies_dict,
-                                user_agent=user_agent, request_headers=request_headers, timeout=timeout)
+                                user_agent=user_agent, request_headers=request_headers, timeout=timeout,
+                                etag=etag, modified=modified, max_size=max_size)
+    return parse_rssfeed(result, content_hash=content_hash, watermark=watermark, full_items=full_items,
+                         parser=parser)
+
+
+def parse_rssfeed(result, content_hash=None, watermark=None, full_items=False, parser=None):
+    """Parse the RSS Feed downloaded by http.download_file with the parser backend named
+    parser, or the default backend if None. See feed_parsers.get_backend.
+    If the hash of the content equals content_hash, the content is not parsed.
+    If watermark (a datetime) is given, the parsing stops at the first item older than
+    watermark, and "stopped_at_watermark" is True in the returned dict.
+    The items only have the values used by get_rssfeed_parsed, unless full_items is True.
+    If the content is not XML, "raw_result" is the text of the page, summarized with
+    http.summarize_html_body, or cleaned with http.clean_html_body if full_items is True.
+    See feed_stream.parse_rss_stream."""
     import atoma
-    atoma.rss.supported_rss_versions = []
+    backend = feed_parsers.get_backend(parser)
     parsed_feeds = {}
+    new_content_hash = None
+    if result.get('status') != 304 and result.get('content') is not None:
+        new_content_hash = get_content_hash(result['content'])
 
-    try:
-        atoma_result = atoma.parse_rss_bytes(result['content'])
-        parsed_feeds = atoma_result_to_dict(atoma_result)
-    except atoma.FeedXMLError as err:
-        readable_body = http.clean_html_body(result['content'])
-        parsed_feeds["raw_result"] = readable_body
-        parsed_feeds["bozo"] = 1
+    if result.get('status') == 304 or (content_hash and new_content_hash == content_hash):
+        # Not Modified, or the same content as last time, so there is nothing to parse
+        parsed_feeds["bozo"] = 0
         parsed_feeds["feed"] = {}
         parsed_feeds["items"] = []
-        parsed_feeds["bozo_exception"] = err
-
-    parsed_feeds['parser'] = "atoma"
+        parsed_feeds["not_modified"] = True
+        parsed_feeds["content_unchanged"] = result.get('status') != 304
+    else:
+        try:
+            parsed_feeds = backend.parse(result['content'], watermark=watermark, full_items=full_items)
+        except atoma.FeedXMLError as err:
+            if full_items:
+                readable_body = http.clean_html_body(result['content'])
+            else:
+                readable_body = http.summarize_html_body(result['content'])
+            parsed_feeds["raw_result"] = readable_body
+            parsed_feeds["bozo"] = 1
+            parsed_feeds["feed"] = {}
+            parsed_feeds["items"] = []
+            parsed_feeds["bozo_exception"] = err
+
+    for key in ("status", "retry_after", "headers", "permanent_redirect"):
+        if key in result:
+            parsed_feeds[key] = result[key]
+    if new_content_hash is not None:
+        parsed_feeds["content_hash"] = new_content_hash
+    parsed_feeds['parser'] = backend.name
     return parsed_feeds
 
 
-def fetch_and_parse_rssfeed_feedparser(url_file_stream_or_string, site_cookies_dict=None,
-                                       user_agent=None, request_headers=None, timeout=10):
-    from yarss2.lib.feedparser import api as feedparser
+def get_fetch_key(url, cookie_header, user_agent):
+    """Returns the key of a download of url for SingleFlight. The downloads with the same cookies
+    and user agent are shared, whatever the ETag and Last-Modified of the callers, and each caller
+    parses the content. See RSSFeedHandler.download_rssfeed."""
+    return (url, tuple(sorted(cookie_header.items())), user_agent)
 
-    parsed_feed = feedparser.parse(url_file_stream_or_string, request_headers=request_headers,
-                                   agent=user_agent, timeout=10)
-    parsed_feed['parser'] = "feedparser"
-    return parsed_feed
 
-
-fetch_and_parse_rssfeed = fetch_and_parse_rssfeed_atom
+def get_shared_download(flight_result, etag=None, modified=None):
+    """Returns the download in flight_result, the (conditions, download) of a shared download,
+    or None if the caller with etag and modified must download the RSS Feed itself. A 304 Not Modified
+    answer to the ETag and Last-Modified of another caller says nothing of the caller's own."""
+    conditions, result = flight_result
+    if result.get("status") == 304 and conditions != (etag or None, modified or None):
+        return None
+    return result
 
 
 class RSSFeedHandler(object):
 
     def __init__(self, log):
         self.log = log
+        # Bytes of an RSS Feed to download
+        self.max_feed_size = DEFAULT_MAX_FEED_SIZE
+        # The downloads in progress, shared by the updates and the RSS Feeds fetched by the GUI
+        self.fetches = SingleFlight()
+        # The parser of the RSS Feeds that do not select one, see feed_parsers
+        self.parser = feed_parsers.AUTO
 
     def get_link(self, item):
         link = None
@@ -150,6 +180,10 @@ class RSSFeedHandler(object):
                     pass
         return link
 
+    def get_parser(self, rssfeed_data):
+        """Returns the name of the parser backend used for the RSS Feed"""
+        return feed_parsers.get_backend(rssfeed_data.get("parser") or self.parser).name
+
     def get_magnet_link(self, item):
         """
         Get magnet URI from torrent item
@@ -162,10 +196,27 @@ class RSSFeedHandler(object):
     def get_size(self, item):
         return _get_size(item)
 
-    def get_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None):
+    def get_rssfeed_parsed(self, rssfeed_data, site_cookies_dict=None, user_agent=None, timeout=10, download=None,
+                           etag=None, modified=None, content_hash=None, watermark=None, full_items=False,
+                           deadline=None):
         """
         rssfeed_data: A dictionary containing rss feed data as stored in the YaRSS2 config.
         site_cookies_dict: A dictionary of cookie values to be used for this rssfeed.
+        timeout: Seconds to wait for the server to answer.
+        deadline: A common.Deadline. The download is abandoned with FeedUpdateDeadlineError
+                  when it has passed.
+        download: The RSS Feed already downloaded by download_rssfeed_async. If None,
+                  the RSS Feed is downloaded in the calling thread with download_rssfeed.
+        etag, modified: The ETag and Last-Modified of the previous response. If the RSS Feed
+                        has not changed, "not_modified" is True in the returned dict.
+        content_hash: The hash of the content of the previous response. If the content is the
+                      same, it is not parsed, and "content_unchanged" is also True.
+        watermark: A datetime. The items after the first item older than watermark are not
+                   parsed. See get_watermark.
+        full_items: If True, the items in "raw_result" have all the values of the RSS Feed,
+                    else only the values used here, and an error page is cleaned for the GUI
+                    instead of summarized.
+        The RSS Feed is parsed with the parser in rssfeed_data, or self.parser. See get_parser.
         """
         return_dict = {}
         rssfeeds_dict = {}
@@ -176,21 +227,42 @@ class RSSFeedHandler(object):
             cookie_header = http.get_cookie_header(site_cookies_dict)
             return_dict["cookie_header"] = cookie_header
 
-        self.log.info("Fetching RSS Feed: '%s' with Cookie: '%s' and User-agent: '%s'." %
-                      (rssfeed_data["name"], http.get_cookie_header(cookie_header), user_agent))
-
-        # Will abort after 10 seconds if server doesn't answer
+        # Will abort after timeout seconds if server doesn't answer
         try:
-            parsed_feed = fetch_and_parse_rssfeed(rssfeed_data["url"], user_agent=user_agent,
-                                                  request_headers=cookie_header, timeout=10)
+            parser = self.get_parser(rssfeed_data)
+            if download is None:
+                self.log.info("Fetching RSS Feed: '%s' with Cookie: '%s' and User-agent: '%s'." %
+                              (rssfeed_data["name"], http.get_cookie_header(cookie_header), user_agent))
+                download = self.download_rssfeed(rssfeed_data["url"], cookie_header=cookie_header,
+                                                 user_agent=user_agent, timeout=timeout, etag=etag,
+                                                 modified=modified, deadline=deadline)
+            parsed_feed = parse_rssfeed(download, content_hash=content_hash, watermark=watermark,
+                                        full_items=full_items, parser=parser)
+        except FeedUpdateDeadlineError:
+            raise
         except Exception as e:
             self.log.warning("Exception occured in feedparser: " + str(e))
             self.log.warning("Feedparser was called with url: '%s' using cookies: '%s' and User-agent: '%s'" %
                              (rssfeed_data["url"], http.get_cookie_header(cookie_header), user_agent))
             self.log.warning("Stacktrace:\n" + common.get_exception_string())
+            if http.is_host_not_found_error(e):
+                raise FeedHostNotFoundError("Exception occured in feedparser: " + str(e))
             raise FetchAndFeedparsingError("Exception occured in feedparser: " + str(e))
 
         return_dict["raw_result"] = parsed_feed
+        # HTTP status, the seconds to wait before the next request if given by the server,
+        # the new URL of the RSS Feed if it has moved permanently, and the publish dates
+        # of the items if the parsing stopped at the watermark
+        for key in ("status", "retry_after", "permanent_redirect", "published_dates"):
+            if key in parsed_feed:
+                return_dict[key] = parsed_feed[key]
+        if parsed_feed.get("headers"):
+            return_dict["cache_lifetime"] = http.get_cache_lifetime(parsed_feed["headers"])
+        self.get_change_detection_values(parsed_feed, return_dict)
+        if parsed_feed.get("not_modified"):
+            return_dict["not_modified"] = True
+            return_dict["content_unchanged"] = parsed_feed["content_unchanged"]
+            return return_dict
 
         # Error parsing
         if parsed_feed["bozo"] == 1:
@@ -230,19 +302,37 @@ class RSSFeedHandler(object):
                 link = magnet
 
             storage_folder = item.get('folder', None)
+            # Finds the torrent file in the cache, whatever URL it was downloaded from
+            infohash = torrent_cache.normalize_infohash((item.get('torrent') or {}).get('infohash')) or \
+                torrent_cache.get_magnet_infohash(magnet)
             rssfeeds_dict[key] = self._new_rssfeeds_dict_item(item['title'], link=link,
                                                               torrent=torrent, magnet=magnet,
-                                                              published_date=published_date, folder=storage_folder)
+                                                              published_date=published_date, folder=storage_folder,
+                                                              infohash=infohash)
             key += 1
 
         if no_publish_time:
             self.log.warning("Published time is not available!")
-        if key > 0:
+        # The parsing stopping at the watermark is a successful update, even without new items
+        if key > 0 or parsed_feed.get("stopped_at_watermark"):
             return_dict["items"] = rssfeeds_dict
         return return_dict
 
+    def get_change_detection_values(self, parsed_feed, return_dict):
+        """Store the ETag, Last-Modified and content hash of the response in return_dict"""
+        status = parsed_feed.get("status")
+        if status is not None and status >= 400:
+            return
+        if "content_hash" in parsed_feed:
+            return_dict["content_hash"] = parsed_feed["content_hash"]
+        headers = parsed_feed.get("headers") or {}
+        for key, header in (("etag", "etag"), ("last_modified", "last-modified")):
+            # A 304 response may leave out the headers that have not changed
+            if header in headers or not parsed_feed.get("not_modified"):
+                return_dict[key] = headers.get(header, "")
+
     def _new_rssfeeds_dict_item(self, title, link=None, torrent=None, magnet=None,
-                                published_date=None, key=None, folder=None):
+                                published_date=None, key=None, folder=None, infohash=None):
         d = {}
         d["title"] = title
         d["link"] = link
@@ -251,9 +341,12 @@ class RSSFeedHandler(object):
         d["magnet"] = magnet
         d["torrent"] = torrent
         d["folder"] = folder
+        d["infohash"] = infohash
 
         if published_date:
             d["updated"] = published_date
+        # For comparing the publish times as numbers when matching
+        d["updated_epoch"] = common.isodate_to_epoch(d["updated"])
 
         if key is not None:
             d["key"] = key
@@ -336,16 +429,36 @@ class RSSFeedHandler(object):
 
         return matching_items, message
 
-    def fetch_feed_torrents(self, config, rssfeed_key, subscription_key=None):
+    def fetch_feed_torrents(self, config, rssfeed_key, subscription_key=None, deadline=None):
         """Called to fetch torrents for a feed
         If rssfeed_key is not None, all subscriptions linked to that RSS Feed
         will be run.
         If rssfeed_key is None, only the subscription with key == subscription_key
         will be run
+        deadline: A common.Deadline. FeedUpdateDeadlineError is raised if it expires.
+        """
+        fetch_data = self.fetch_feed_items(config, rssfeed_key, subscription_key=subscription_key, deadline=deadline)
+        self.match_feed_items(config, fetch_data)
+        return fetch_data
+
+    def fetch_feed_items(self, config, rssfeed_key, subscription_key=None, deadline=None, download=None,
+                         cookie_index=None):
+        """Fetch and parse the RSS Feed if any of the subscriptions to run are active.
+        The items are matched against the subscriptions by match_feed_items.
+        See fetch_feed_torrents for the arguments.
+        download: The RSS Feed already downloaded by download_rssfeed_async, which is parsed
+                  instead of fetching the RSS Feed.
+        cookie_index: The http.CookieIndex of the cookies in config. Created from config if None.
         """
         fetch_data = {}
         fetch_data["matching_torrents"] = []
         fetch_data["rssfeed_items"] = None
+        fetch_data["subscriptions"] = []
+        fetch_data["deadline"] = deadline if deadline is not None else common.Deadline()
+        fetch_data["download"] = download
+        # Conditional requests are only made when the RSS Feed is matched against all the
+        # subscriptions, as a subscription run manually may not have seen the previous response
+        fetch_data["conditional"] = subscription_key is None
 
         if rssfeed_key is None:
             if subscription_key is None:
@@ -358,19 +471,22 @@ class RSSFeedHandler(object):
                 return fetch_data
 
         rssfeed_data = config["rssfeeds"][rssfeed_key]
-        fetch_data["site_cookies_dict"] = http.get_matching_cookies_dict(config["cookies"], rssfeed_data["site"])
+        fetch_data["rssfeed_key"] = rssfeed_key
+        if cookie_index is None:
+            cookie_index = http.CookieIndex(config["cookies"],
+                                            substring_match=config["general"]["cookie_substring_match"])
+        fetch_data["site_cookies_dict"] = cookie_index.get_cookies(rssfeed_data["site"])[0]
         fetch_data["user_agent"] = get_user_agent(rssfeed_data=rssfeed_data)
 
         self.log.info("Update handler executed on RSS Feed '%s (%s)' (Update interval %d min)" %
                       (rssfeed_data["name"], rssfeed_data["site"], rssfeed_data["update_interval"]))
 
-        for key in config["subscriptions"].keys():
-            # subscription_key is given, only that subscription will be run
-            if subscription_key is not None and subscription_key != key:
-                continue
-            subscription_data = config["subscriptions"][key]
-            if subscription_data["rssfeed_key"] == rssfeed_key and subscription_data["active"] is True:
-                self.fetch_feed(subscription_data, rssfeed_data, fetch_data)
+        fetch_data["subscriptions"] = self.get_active_subscriptions(config, rssfeed_key,
+                                                                    subscription_key=subscription_key)
+        if fetch_data["subscriptions"]:
+            if fetch_data["deadline"].expired():
+                raise FeedUpdateDeadlineError("Deadline passed before fetching RSS Feed '%s'" % rssfeed_data["name"])
+            self.fetch_rssfeed_items(rssfeed_data, fetch_data)
 
         if subscription_key is None:
             # Update last_update value of the rssfeed only when rssfeed is run by the timer,
@@ -380,6 +496,140 @@ class RSSFeedHandler(object):
             rssfeed_data["last_update"] = dt.isoformat()
         return fetch_data
 
+    def get_active_subscriptions(self, config, rssfeed_key, subscription_key=None):
+        """Returns the active subscriptions of the RSS Feed. If subscription_key
+        is given, only that subscription is returned"""
+        subscriptions = []
+        for key in config["subscriptions"].keys():
+            # subscription_key is given, only that subscription will be run
+            if subscription_key is not None and subscription_key != key:
+                continue
+            subscription_data = config["subscriptions"][key]
+            if subscription_data["rssfeed_key"] == rssfeed_key and subscription_data["active"] is True:
+                subscriptions.append(subscription_data)
+        return subscriptions
+
+    def download_rssfeed(self, url, cookie_header=None, user_agent=None, timeout=10, etag=None, modified=None,
+                         deadline=None):
+        """Download the RSS Feed with http.download_file in the calling thread. A download of the
+        same RSS Feed in progress, e.g. by an update when the GUI fetches the RSS Feed, is shared.
+        See get_fetch_key. The download is abandoned when deadline (a common.Deadline) has passed.
+        Returns the result of http.download_file, which is parsed by get_rssfeed_parsed.
+        """
+        cookie_header = cookie_header or {}
+
+        def download():
+            return ((etag or None, modified or None),
+                    http.download_file(url, user_agent=user_agent, request_headers=cookie_header, timeout=timeout,
+                                       etag=etag, modified=modified, max_size=self.max_feed_size, deadline=deadline))
+
+        result = get_shared_download(self.fetches.call(get_fetch_key(url, cookie_header, user_agent), download),
+                                     etag=etag, modified=modified)
+        if result is None:
+            result = download()[1]
+        return result
+
+    def download_rssfeed_async(self, rssfeed_data, http_client, site_cookies_dict=None, user_agent=None,
+                               timeout=10, etag=None, modified=None):
+        """Download the RSS Feed with http_client (an AsyncHTTPClient) without blocking.
+        Returns a Deferred called with the download, which is parsed by get_rssfeed_parsed.
+        Fails with FetchAndFeedparsingError if the RSS Feed could not be downloaded.
+        """
+        cookie_header = http.get_cookie_header(site_cookies_dict) if site_cookies_dict else {}
+        self.log.info("Fetching RSS Feed: '%s' with Cookie: '%s' and User-agent: '%s'." %
+                      (rssfeed_data["name"], cookie_header, user_agent))
+
+        def on_error(failure):
+            # Cancelled by the watchdog of the run queue
+            if failure.check(defer.CancelledError):
+                return failure
+            self.log.warning("Failed to download RSS Feed '%s' from url: '%s': %s" %
+                             (rssfeed_data["name"], rssfeed_data["url"], failure.getErrorMessage()))
+            if http.is_host_not_found_error(failure.value):
+                raise FeedHostNotFoundError("Failed to download RSS Feed: " + failure.getErrorMessage())
+            raise FetchAndFeedparsingError("Failed to download RSS Feed: " + failure.getErrorMessage())
+
+        def download():
+            d = http_client.get_feed(rssfeed_data["url"], user_agent=user_agent, request_headers=cookie_header,
+                                     timeout=timeout, etag=etag, modified=modified, max_size=self.max_feed_size)
+            d.addCallback(lambda result: ((etag or None, modified or None), result))
+            return d
+
+        def on_download(flight_result):
+            result = get_shared_download(flight_result, etag=etag, modified=modified)
+            if result is None:
+                return download().addCallback(lambda flight_result: flight_result[1])
+            return result
+
+        d = self.fetches.call_async(get_fetch_key(rssfeed_data["url"], cookie_header, user_agent), download)
+        d.addCallback(on_download)
+        d.addErrback(on_error)
+        return d
+
+    def match_feed_items(self, config, fetch_data):
+        """Match the items fetched by fetch_feed_items against the subscriptions.
+        The matches are added to fetch_data["matching_torrents"]"""
+        if fetch_data.get("not_modified"):
+            return
+        for subscription_data in fetch_data["subscriptions"]:
+            self.fetch_feed(subscription_data, config["rssfeeds"][fetch_data["rssfeed_key"]], fetch_data)
+
+    def get_watermark(self, subscriptions):
+        """Returns the oldest last_match of the subscriptions, as the items older than that
+        are not added by any of them, or None if all the items must be parsed"""
+        watermark = None
+        for subscription_data in subscriptions:
+            if subscription_data["ignore_timestamp"] or not subscription_data["last_match"]:
+                return None
+            last_match = common.isodate_to_datetime(subscription_data["last_match"])
+            if watermark is None or last_match < watermark:
+                watermark = last_match
+        return watermark
+
+    def fetch_rssfeed_items(self, rssfeed_data, fetch_data):
+        """Fetch and parse the RSS Feed, and store the items in fetch_data"""
+        fetch_data["fetched"] = True
+        # The scheduled updates of all the subscriptions of the RSS Feed are conditional. They may
+        # skip the items older than the watermark, while a subscription run manually gets all the items.
+        conditional = fetch_data.get("conditional", False)
+        rssfeed_parsed = self.get_rssfeed_parsed(rssfeed_data, site_cookies_dict=fetch_data["site_cookies_dict"],
+                                                 user_agent=fetch_data["user_agent"],
+                                                 timeout=fetch_data["deadline"].get_timeout(10),
+                                                 deadline=fetch_data["deadline"],
+                                                 download=fetch_data.get("download"),
+                                                 etag=rssfeed_data.get("etag") if conditional else None,
+                                                 modified=rssfeed_data.get("last_modified") if conditional else None,
+                                                 content_hash=rssfeed_data.get("content_hash") if conditional else None,
+                                                 watermark=(self.get_watermark(fetch_data["subscriptions"])
+                                                            if conditional else None))
+        if rssfeed_parsed is None:
+            return
+        fetch_data["status"] = rssfeed_parsed.get("status")
+        fetch_data["retry_after"] = rssfeed_parsed.get("retry_after")
+        fetch_data["cache_lifetime"] = rssfeed_parsed.get("cache_lifetime")
+        fetch_data["permanent_redirect"] = rssfeed_parsed.get("permanent_redirect")
+        fetch_data["published_dates"] = rssfeed_parsed.get("published_dates")
+        if conditional:
+            for key in CHANGE_DETECTION_KEYS:
+                if key in rssfeed_parsed:
+                    rssfeed_data[key] = rssfeed_parsed[key]
+        if rssfeed_parsed.get("not_modified"):
+            fetch_data["not_modified"] = True
+            fetch_data["content_unchanged"] = rssfeed_parsed["content_unchanged"]
+            self.log.info("RSS Feed '%s' has not changed since the last update." % rssfeed_data["name"])
+            return
+        if "bozo_exception" in rssfeed_parsed:
+            self.log.warning("bozo_exception when parsing rssfeed: %s" % str(rssfeed_parsed["bozo_exception"]))
+            # The summary of the error page, e.g. a login page or a challenge page
+            error_page = rssfeed_parsed.get("raw_result", {}).get("raw_result")
+            if error_page:
+                self.log.warning("Content of RSS Feed '%s':\n%s" % (rssfeed_data["name"], error_page[:500]))
+        if "items" in rssfeed_parsed:
+            fetch_data["rssfeed_items"] = rssfeed_parsed["items"]
+            self.handle_ttl(rssfeed_data, rssfeed_parsed, fetch_data)
+        else:
+            self.log.warning("No items retrieved")
+
     def handle_ttl(self, rssfeed_data, rssfeed_parsed, fetch_data):
         if rssfeed_data["obey_ttl"] is False:
             return
@@ -407,20 +657,14 @@ class RSSFeedHandler(object):
         """Search a feed with config 'subscription_data'"""
         self.log.info("Fetching subscription '%s'." % subscription_data["name"])
 
+        if fetch_data["deadline"].expired():
+            raise FeedUpdateDeadlineError("Deadline passed before matching subscription '%s'" %
+                                          subscription_data["name"])
         # Feed has not yet been fetched.
+        if not fetch_data.get("fetched"):
+            self.fetch_rssfeed_items(rssfeed_data, fetch_data)
         if fetch_data["rssfeed_items"] is None:
-            rssfeed_parsed = self.get_rssfeed_parsed(rssfeed_data, site_cookies_dict=fetch_data["site_cookies_dict"],
-                                                     user_agent=fetch_data["user_agent"])
-            if rssfeed_parsed is None:
-                return
-            if "bozo_exception" in rssfeed_parsed:
-                self.log.warning("bozo_exception when parsing rssfeed: %s" % str(rssfeed_parsed["bozo_exception"]))
-            if "items" in rssfeed_parsed:
-                fetch_data["rssfeed_items"] = rssfeed_parsed["items"]
-                self.handle_ttl(rssfeed_data, rssfeed_parsed, fetch_data)
-            else:
-                self.log.warning("No items retrieved")
-                return
+            return
         # Remove the custom text lines before matching (not strictly necessary though,
         # but they are only for testing in the DialogSubscription)
         options = subscription_data.copy()
@@ -428,13 +672,15 @@ class RSSFeedHandler(object):
         matches, message = self.update_rssfeeds_dict_matching(fetch_data["rssfeed_items"], options=options)
         self.log.info("%d items in feed, %d matches the filter." %
                       (len(fetch_data["rssfeed_items"]), len(matches.keys())))
-        last_match_dt = common.isodate_to_datetime(subscription_data["last_match"])
+        last_match_epoch = common.isodate_to_epoch(subscription_data["last_match"])
 
         for key in list(matches.keys()):
             # Discard match only if timestamp is available,
             # and the timestamp is older or equal to the last matching timestamp
-            matched_updated = common.isodate_to_datetime(matches[key]["updated"])
-            if matched_updated and last_match_dt >= matched_updated:
+            matched_epoch = matches[key].get("updated_epoch")
+            if matched_epoch is None:
+                matched_epoch = common.isodate_to_epoch(matches[key]["updated"])
+            if last_match_epoch >= matched_epoch:
                 if subscription_data["ignore_timestamp"] is True:
                     self.log.info("Old timestamp: '%s', but ignore option is enabled so add torrent anyways."
                                   % matches[key]["title"])
@@ -442,6 +688,7 @@ class RSSFeedHandler(object):
                     self.log.info("Not adding because of old timestamp: '%s'" % matches[key]["title"])
                     del matches[key]
                     continue
+            matched_updated = common.isodate_to_datetime(matches[key]["updated"])
             fetch_data["matching_torrents"].append({"title": matches[key]["title"],
                                                     "link": matches[key]["link"],
                                                     "updated_datetime": matched_updated,
@@ -449,4 +696,5 @@ class RSSFeedHandler(object):
                                                     "user_agent": fetch_data["user_agent"],
                                                     "referrer": rssfeed_data["url"],
                                                     "subscription_data": subscription_data,
-                                                    "folder": matches[key]["folder"]})
+                                                    "folder": matches[key]["folder"],
+                                                    "infohash": matches[key].get("infohash")})
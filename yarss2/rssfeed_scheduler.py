@@ -7,68 +7,212 @@
 # See LICENSE for more details.
 #
 
+import bisect
+import copy
+import heapq
+import itertools
+import threading
 import traceback
+import zlib
 
 import twisted.internet.defer as defer
-from twisted.internet import threads
-from twisted.internet.task import LoopingCall
+from twisted.internet import reactor, task, threads
+from twisted.python import threadable
 from twisted.python.failure import Failure
 
 import deluge.component as component
 
-from yarss2.rssfeed_handling import RSSFeedHandler
+from yarss2.error import FeedHostNotFoundError, FeedUpdateDeadlineError, FetchAndFeedparsingError
+from yarss2.rssfeed_handling import CHANGE_DETECTION_KEYS, RSSFeedHandler, reset_change_detection
 from yarss2.torrent_handling import TorrentHandler
-from yarss2.yarss_config import YARSSConfigChangedEvent
+from yarss2.util import common, http_sessions, rate_limit
+from yarss2.util.adaptive_interval import get_adaptive_interval
+from yarss2.util.async_http import AsyncHTTPClient
+from yarss2.util.common import TorrentDownload
+from yarss2.util.failed_downloads import FailedDownloads
+from yarss2.util.feed_health import FeedHealth
+from yarss2.util.http import get_hostname, urlparse
+from yarss2.yarss_config import YARSSConfigChangedEvent, get_user_agent
+
+
+# Priorities of the jobs in the RSSFeedRunQueue. Lower values run first.
+PRIORITY_MANUAL = 0
+PRIORITY_NORMAL = 10
+
+# Number of queued jobs at which a stage queue is full
+STAGE_QUEUE_MAX = 10
+
+# Maximum part of the update interval used to offset the updates of an RSS Feed
+TIMER_JITTER_FRACTION = 0.1
+# Maximum offset in seconds
+TIMER_JITTER_MAX = 300
 
 
 class RSSFeedScheduler(object):
-    """Handles scheduling the RSS Feed fetches."""
+    """Handles scheduling the RSS Feed fetches.
 
-    def __init__(self, config, logger):
+    The next update time of each RSS Feed is kept in a heap, and a single
+    delayed call is scheduled for the RSS Feed that is due first.
+    """
+
+    def __init__(self, config, logger, clock=None, torrent_cache=None, main_thread_caller=None):
         self.yarss_config = config
         self.rssfeed_timers = {}
-        self.run_queue = RSSFeedRunQueue()
+        self.clock = clock if clock is not None else reactor
+        # Called with a function and its arguments to call it in the main thread. See call_in_main_thread
+        self.main_thread_caller = main_thread_caller
+        self._timer_heap = []
+        self._timer_call = None
+        # Closes the HTTP sessions of the worker threads that have been idle for a while
+        self._evict_sessions_call = None
+        # The queues of the stages of the RSS Feed updates. A stage is not started
+        # while the queue of the next stage is full.
+        self.run_queue = RSSFeedRunQueue(clock=self.clock)
+        self.match_queue = RSSFeedRunQueue(clock=self.clock, max_queued=STAGE_QUEUE_MAX)
+        self.download_queue = RSSFeedRunQueue(clock=self.clock, max_queued=STAGE_QUEUE_MAX)
+        self.run_queue.set_downstream(self.match_queue)
+        self.match_queue.set_downstream(self.download_queue)
+        self._updates_in_progress = {}
+        self.feed_health = FeedHealth(clock=self.clock)
+        # The time of the last fetch of an RSS Feed that got a response from the server
+        self.last_response_time = None
+        # The torrent URLs that failed to download, which are not downloaded again for a while
+        self.failed_downloads = FailedDownloads(clock=self.clock)
+        # How the fetches of the RSS Feeds ended. Counted by the worker threads.
+        self._fetch_counts = {"parsed": 0, "not_modified": 0, "content_unchanged": 0}
+        self._fetch_counts_lock = threading.Lock()
+        # The client for the HTTP requests run by the reactor, None when the requests
+        # are run in the worker threads
+        self.http_client = None
         self.log = logger
         self.rssfeedhandler = RSSFeedHandler(logger)
-        self.torrent_handler = TorrentHandler(logger)
+        self.torrent_handler = TorrentHandler(logger, torrent_cache=torrent_cache)
+        self.update_run_queue_limits()
         # To make it possible to disable adding torrents in testing
         self.add_torrents_func = self.torrent_handler.add_torrents
 
+    def update_run_queue_limits(self):
+        """Apply the concurrency and download size limits in the general config"""
+        general = self.yarss_config.get_config()["general"]
+        self.run_queue.set_limits(general["max_concurrent_feed_updates"], general["max_connections_per_host"])
+        self.match_queue.set_limits(general["max_concurrent_feed_matching"])
+        self.download_queue.set_limits(general["max_concurrent_torrent_downloads"],
+                                       general["max_torrent_downloads_per_host"])
+        self.set_async_http(general["use_async_http"])
+        self.rssfeedhandler.max_feed_size = general["max_feed_size"]
+        self.rssfeedhandler.parser = general["feed_parser"]
+        self.torrent_handler.max_torrent_size = general["max_torrent_size"]
+        self.failed_downloads.set_limits(general["failed_download_ttl"], general["failed_download_max_retries"])
+        rate_limit.rate_limiter.set_limits(general["site_request_rate"], general["site_request_burst"],
+                                           general["site_rate_limits"])
+        self.permanent_redirect_threshold = general["permanent_redirect_threshold"]
+        self.gone_deactivate_threshold = general["gone_deactivate_threshold"]
+        self.gone_deactivate_min_time = general["gone_deactivate_min_time"]
+        if self.torrent_handler.torrent_cache is not None:
+            self.torrent_handler.torrent_cache.set_max_size(general["torrent_cache_size"])
+
+    def set_async_http(self, enabled):
+        """Run the HTTP requests of the updates in the reactor with an AsyncHTTPClient,
+        or in the worker threads if enabled is False"""
+        if enabled and self.http_client is None:
+            self.http_client = AsyncHTTPClient(rate_limiter=rate_limit.rate_limiter)
+        elif not enabled and self.http_client is not None:
+            # The requests in progress finish with the old client
+            self.http_client.close()
+            self.http_client = None
+
     def enable_timers(self):
-        """Creates the LoopingCall timers, one for each RSS Feed"""
+        """Schedules the updates of all the RSS Feeds.
+
+        Each RSS Feed is scheduled at the stored next update time, or one interval
+        after the last update. The RSS Feeds that are updated on startup, or that
+        were due while the daemon was not running, are started one at a time,
+        separated by the startup_update_spacing value in the general config.
+        """
         config = self.yarss_config.get_config()
+        now = self.clock.seconds()
+        startup_keys = []
         for key in config["rssfeeds"]:
             rssfeed = config["rssfeeds"][key]
-            self.set_timer(rssfeed["key"], rssfeed['update_interval'], rssfeed["update_on_startup"])
+            next_update = self._get_stored_next_update(rssfeed, now)
+            if rssfeed["update_on_startup"] or (next_update is not None and next_update <= now):
+                startup_keys.append(rssfeed["key"])
+            else:
+                self.set_timer(rssfeed["key"], rssfeed['update_interval'], next_update=next_update)
             self.log.info("Scheduled RSS Feed '%s' with interval %s" %
                           (rssfeed["name"], rssfeed["update_interval"]))
 
+        spacing = config["general"]["startup_update_spacing"]
+        startup_keys.sort(key=lambda key: (self._get_jitter(key, config["rssfeeds"][key]["update_interval"]), key))
+        for i, key in enumerate(startup_keys):
+            self.set_timer(key, config["rssfeeds"][key]["update_interval"], next_update=now + i * spacing)
+
+        if self._evict_sessions_call is None:
+            self._evict_sessions_call = task.LoopingCall(self.evict_idle_sessions)
+            self._evict_sessions_call.clock = self.clock
+            self._evict_sessions_call.start(http_sessions.IDLE_TIMEOUT, now=False)
+
+    def evict_idle_sessions(self):
+        http_sessions.session_pool.evict_idle()
+
+    def _get_stored_next_update(self, rssfeed, now):
+        """Returns the timestamp of the next update stored in the config,
+        or one interval after the last update. None if neither is available."""
+        interval = rssfeed["update_interval"] * 60
+        next_update = common.isodate_to_timestamp(rssfeed["next_update"])
+        if next_update is None:
+            last_update = common.isodate_to_timestamp(rssfeed["last_update"])
+            if last_update is None:
+                return None
+            next_update = last_update + interval
+        # The interval may have been shortened, or the clock changed
+        return min(next_update, now + interval)
+
     def disable_timers(self):
-        for key in list(self.rssfeed_timers.keys()):
-            self.rssfeed_timers[key]["timer"].stop()
-            del self.rssfeed_timers[key]
+        if self._timer_call is not None and self._timer_call.active():
+            self._timer_call.cancel()
+        self._timer_call = None
+        if self._evict_sessions_call is not None and self._evict_sessions_call.running:
+            self._evict_sessions_call.stop()
+        self._evict_sessions_call = None
+        self._timer_heap = []
+        self.rssfeed_timers.clear()
+
+    def set_timer(self, key, interval, update_on_startup=False, next_update=None):
+        """Schedule the RSS Feed with key to be updated every interval minutes.
 
-    def set_timer(self, key, interval, update_on_startup=False):
-        """Schedule a timer for the specified interval."""
+        A new timer is started after the interval (or immediately if update_on_startup is True),
+        offset by a small deterministic jitter. If the RSS Feed is already scheduled, the phase
+        is kept, so the next update is run interval minutes after the previous update.
+        next_update is a timestamp (in seconds) overriding the time of the next update.
+        """
         try:
             interval = int(interval)
         except ValueError:
             self.log.error("Failed to convert interval '%s' to int!" % str(interval))
             return False
-        # Already exists, so reschedule
-        if key in self.rssfeed_timers:
-            try:
-                self.rssfeed_timers[key]["timer"].stop()
-            except AssertionError as e:
-                self.log.warning("AssertionError:", e)
-                return False
-            self.rssfeed_timers[key]["update_interval"] = interval
-        else:
-            # New timer
-            # Second argument, the rssfeedkey is passed as argument to the callback method
-            timer = LoopingCall(self.queue_rssfeed_update, key)
-            self.rssfeed_timers[key] = {"timer": timer, "update_interval": interval}
-        self.rssfeed_timers[key]["timer"].start(interval * 60, now=update_on_startup)  # Multiply to get seconds
+        now = self.clock.seconds()
+        timer = self.rssfeed_timers.get(key)
+        if next_update is None:
+            if timer is None:
+                # New timer
+                delay = 0 if update_on_startup else interval * 60
+                next_update = now + delay + self._get_jitter(key, interval)
+            elif timer["update_interval"] == interval:
+                # The saved RSS Feed config may contain an outdated value
+                self._store_next_update(key, timer["next_update"])
+                return True
+            else:
+                # Already exists, so reschedule relative to the previous update
+                previous = timer["last_update"]
+                if previous is None:
+                    previous = timer["next_update"] - timer["update_interval"] * 60
+                next_update = max(now, previous + interval * 60)
+        if timer is None:
+            timer = {"last_update": None}
+            self.rssfeed_timers[key] = timer
+        timer["update_interval"] = interval
+        self._push_timer(key, next_update)
         return True
 
     def delete_timer(self, key):
@@ -76,113 +220,910 @@ class RSSFeedScheduler(object):
         if key not in self.rssfeed_timers:
             self.log.warning("Cannot delete timer. No timer with key %s" % key)
             return False
-        self.rssfeed_timers[key]["timer"].stop()
         del self.rssfeed_timers[key]
+        self.feed_health.remove(key)
+        # The entry in the heap is discarded when reached
+        self._schedule_timer_call()
         return True
 
-    def rssfeed_update_handler_safe(self, rssfeed_key=None, subscription_key=None):
+    def _get_jitter(self, key, interval):
+        """Returns a deterministic offset in seconds for the RSS Feed with key.
+        Spreads the updates of RSS Feeds with the same interval instead of
+        running them in the same reactor iteration"""
+        max_jitter = min(interval * 60 * TIMER_JITTER_FRACTION, TIMER_JITTER_MAX)
+        return (zlib.crc32(str(key).encode("utf-8")) % 1000) / 1000.0 * max_jitter
+
+    def _push_timer(self, key, next_update):
+        self.rssfeed_timers[key]["next_update"] = next_update
+        heapq.heappush(self._timer_heap, (next_update, key))
+        self._store_next_update(key, next_update)
+        # Remove the stale entries left behind by rescheduled and deleted timers
+        if len(self._timer_heap) > 2 * len(self.rssfeed_timers) + 16:
+            self._timer_heap = [(timer["next_update"], k) for k, timer in self.rssfeed_timers.items()]
+            heapq.heapify(self._timer_heap)
+        self._schedule_timer_call()
+
+    def _store_next_update(self, key, next_update):
+        """Store the time of the next update so it's kept when the daemon is restarted"""
+        rssfeed = self.yarss_config.get_config()["rssfeeds"].get(key)
+        if rssfeed is not None:
+            rssfeed["next_update"] = common.timestamp_to_isodate(next_update)
+
+    def _is_stale(self, entry):
+        next_update, key = entry
+        timer = self.rssfeed_timers.get(key)
+        return timer is None or timer["next_update"] != next_update
+
+    def _schedule_timer_call(self):
+        """Make sure the delayed call is scheduled for the first RSS Feed in the heap"""
+        while self._timer_heap and self._is_stale(self._timer_heap[0]):
+            heapq.heappop(self._timer_heap)
+        if self._timer_call is not None and self._timer_call.active():
+            if self._timer_heap and self._timer_call.getTime() == self._timer_heap[0][0]:
+                return
+            self._timer_call.cancel()
+        self._timer_call = None
+        if self._timer_heap:
+            delay = max(0, self._timer_heap[0][0] - self.clock.seconds())
+            self._timer_call = self.clock.callLater(delay, self._on_timer)
+
+    def _on_timer(self):
+        """Queue the updates of the RSS Feeds that are due"""
+        self._timer_call = None
+        now = self.clock.seconds()
+        while self._timer_heap and self._timer_heap[0][0] <= now:
+            entry = heapq.heappop(self._timer_heap)
+            if self._is_stale(entry):
+                continue
+            next_update, key = entry
+            timer = self.rssfeed_timers[key]
+            timer["last_update"] = next_update
+            interval = timer["update_interval"] * 60
+            # Skip the updates that were missed, e.g. while the system was suspended
+            missed = max(0, int((now - next_update) // interval)) if interval > 0 else 0
+            self._push_timer(key, next_update + (missed + 1) * max(interval, 1))
+            # The RSS Feed is backing off after failed updates
+            if not self.feed_health.allow_update(key):
+                state = self.feed_health.get_state(key)
+                self.log.info("Skipping update of RSS Feed '%s' after %d failed updates. Retrying in %d seconds." %
+                              (self.yarss_config.get_config()["rssfeeds"][key]["name"], state["failures"],
+                               state["retry_in"]))
+                continue
+            self.queue_rssfeed_update(rssfeed_key=key)
+        self._schedule_timer_call()
+
+    def run_stage_safe(self, stage_func, stage_kwargs, rssfeed_key, subscription_key=None, config=None):
         """
-        This function is called by the LoopingCall, and should avoid passing any
-        raised exceptions back to the loopingcall. This is to make sure the loopingcall
-        doesn't stop.
+        Runs a stage of an update of an RSS Feed with the keyword arguments in stage_kwargs.
+        This function is run by the stage queues, and should avoid passing any raised
+        exceptions back to the queue. Returns None if the stage failed.
         """
         try:
-            return self.rssfeed_update_handler(rssfeed_key=rssfeed_key, subscription_key=subscription_key)
+            return stage_func(**stage_kwargs)
+        except FeedUpdateDeadlineError as err:
+            self.log.warning("Abandoned the update of RSS Feed '%s': %s" % (rssfeed_key, str(err)))
+            self.record_update_failure(rssfeed_key, subscription_key, config, str(err))
+        except FetchAndFeedparsingError as err:
+            # Already logged by the RSSFeedHandler
+            self.record_update_failure(rssfeed_key, subscription_key, config, str(err),
+                                       host_not_found=isinstance(err, FeedHostNotFoundError))
         except:  # noqa: E722 do not use bare 'except'
             traceback.print_exc()
             exc_str = traceback.format_exc()
             self.log.warning("An exception was thrown by the RSS update handler. Please report this bug!\n%s" % exc_str)
 
-    def rssfeed_update_handler(self, rssfeed_key=None, subscription_key=None):
-        """Goes through all the feeds and runs the active ones.
-        Multiple subscriptions on one RSS Feed will download the RSS feed page only once
+    def run_async_stage_safe(self, stage_func, stage_kwargs, rssfeed_key, subscription_key=None, config=None):
+        """Like run_stage_safe, for the stages run in the reactor, which return a Deferred.
+        Returns a Deferred called with None if the stage failed.
+        """
+        d = defer.maybeDeferred(stage_func, **stage_kwargs)
+        d.addErrback(self._on_async_stage_failed, rssfeed_key, subscription_key, config)
+        return d
+
+    def _on_async_stage_failed(self, failure, rssfeed_key, subscription_key, config):
+        if failure.check(defer.CancelledError):
+            # Cancelled by the watchdog of the stage queue, which has already failed the job
+            return None
+        if failure.check(FeedUpdateDeadlineError):
+            self.log.warning("Abandoned the update of RSS Feed '%s': %s" % (rssfeed_key, failure.getErrorMessage()))
+            self.record_update_failure(rssfeed_key, subscription_key, config, failure.getErrorMessage())
+        elif failure.check(FetchAndFeedparsingError):
+            # Already logged by the RSSFeedHandler
+            self.record_update_failure(rssfeed_key, subscription_key, config, failure.getErrorMessage(),
+                                       host_not_found=failure.check(FeedHostNotFoundError) is not None)
+        else:
+            self.log.warning("An exception was thrown by the RSS update handler. Please report this bug!\n%s" %
+                             failure.getTraceback())
+        return None
+
+    def fetch_stage(self, rssfeed_key=None, subscription_key=None, config=None, deadline=None, download=None,
+                    cookie_index=None):
+        """The first stage of an update. Fetches and parses the RSS Feed.
+        Multiple subscriptions on one RSS Feed will download the RSS feed page only once.
+
+        config: A private snapshot of the config (See get_config_snapshot) used when the update
+                runs in a worker thread. The changes to the RSS Feed are then merged into the live
+                config by add_torrents_callback in the main thread.
+                If None, the live config is used directly.
+        deadline: Seconds the whole update may take, or a common.Deadline. The timeouts of the
+                  requests are reduced to the remaining time, and FeedUpdateDeadlineError is raised
+                  when it has passed.
+        download: The RSS Feed downloaded by fetch_rssfeed_async, which is only parsed.
+        cookie_index: The http.CookieIndex of the live config, taken in the main thread with the
+                      snapshot in config. If None, it is created from the cookies of config.
+
+        Returns a dict with the state of the update, which is passed on to the
+        next stages, or None if the RSS Feed is not active.
         """
+        if not isinstance(deadline, common.Deadline):
+            deadline = common.Deadline(deadline)
+        update = {"snapshot": config is not None, "deadline": deadline}
+        if config is None:
+            config = self.yarss_config.get_config()
+            if cookie_index is None:
+                cookie_index = self.yarss_config.get_cookie_index()
+
         if subscription_key:
             self.log.info("Manually running Subscription '%s'" %
-                          (self.yarss_config.get_config()["subscriptions"][subscription_key]["name"]))
+                          (config["subscriptions"][subscription_key]["name"]))
         elif rssfeed_key:
-            if self.yarss_config.get_config()["rssfeeds"][rssfeed_key]["active"] is False:
+            if config["rssfeeds"][rssfeed_key]["active"] is False:
                 return
 
-        fetch_result = self.rssfeedhandler.fetch_feed_torrents(self.yarss_config.get_config(), rssfeed_key,
-                                                               subscription_key=subscription_key)
-        matching_torrents = fetch_result["matching_torrents"]
-        # Fetching the torrent files. Do this slow task in non-main thread.
-        for torrent in matching_torrents:
-            torrent["torrent_download"] = self.torrent_handler.get_torrent(torrent)
+        if update["snapshot"]:
+            # The values the snapshot started from, see update_rssfeed_state
+            rssfeed_data = config["rssfeeds"][rssfeed_key or config["subscriptions"][subscription_key]["rssfeed_key"]]
+            update["change_detection"] = dict((key, rssfeed_data[key]) for key in CHANGE_DETECTION_KEYS)
+
+        fetch_result = self.rssfeedhandler.fetch_feed_items(config, rssfeed_key,
+                                                            subscription_key=subscription_key,
+                                                            deadline=update["deadline"], download=download,
+                                                            cookie_index=cookie_index)
+        # The RSS Feed was fetched
+        if "status" in fetch_result:
+            self.record_fetch_result(rssfeed_key, subscription_key, config, fetch_result)
+            self.count_fetch(fetch_result)
+
+        # Subscription is run directly. Get RSS Feed key
+        if not rssfeed_key:
+            rssfeed_key = config["subscriptions"][subscription_key]["rssfeed_key"]
+        update["rssfeed_key"] = rssfeed_key
+        update["config"] = config
+        update["fetch_result"] = fetch_result
+        return update
+
+    def fetch_rssfeed_async(self, rssfeed_key=None, subscription_key=None, config=None, deadline=None,
+                            cookie_index=None):
+        """The first stage of an update when the HTTP requests are run in the reactor.
+        Downloads the RSS Feed, which is parsed by parse_and_match_stage in a worker thread.
+        See fetch_stage for the arguments.
+
+        Returns a Deferred called with the keyword arguments of parse_and_match_stage.
+        """
+        stage_kwargs = {"rssfeed_key": rssfeed_key, "subscription_key": subscription_key,
+                        "config": config, "deadline": common.Deadline(deadline), "download": None,
+                        "cookie_index": cookie_index}
+        if not rssfeed_key:
+            rssfeed_key = config["subscriptions"][subscription_key]["rssfeed_key"]
+        elif not subscription_key and config["rssfeeds"][rssfeed_key]["active"] is False:
+            return defer.succeed(stage_kwargs)
+        # Nothing to match the items against, so the RSS Feed is not downloaded
+        if not self.rssfeedhandler.get_active_subscriptions(config, rssfeed_key, subscription_key=subscription_key):
+            return defer.succeed(stage_kwargs)
+        rssfeed_data = config["rssfeeds"][rssfeed_key]
+        if cookie_index is None:
+            cookie_index = self.yarss_config.get_cookie_index()
+        site_cookies_dict = cookie_index.get_cookies(rssfeed_data["site"])[0]
+        # See RSSFeedHandler.fetch_feed_items
+        conditional = subscription_key is None
+        d = self.rssfeedhandler.download_rssfeed_async(rssfeed_data, self.http_client,
+                                                       site_cookies_dict=site_cookies_dict,
+                                                       user_agent=get_user_agent(rssfeed_data=rssfeed_data),
+                                                       timeout=stage_kwargs["deadline"].get_timeout(10),
+                                                       etag=rssfeed_data["etag"] if conditional else None,
+                                                       modified=rssfeed_data["last_modified"] if conditional else None)
+
+        def on_download(download):
+            stage_kwargs["download"] = download
+            return stage_kwargs
+        d.addCallback(on_download)
+        return d
+
+    def parse_and_match_stage(self, rssfeed_key=None, subscription_key=None, config=None, deadline=None,
+                              download=None, cookie_index=None):
+        """The second stage of an update when the HTTP requests are run in the reactor.
+        Parses the RSS Feed downloaded by fetch_rssfeed_async, and matches the items
+        against the subscriptions"""
+        update = self.fetch_stage(rssfeed_key=rssfeed_key, subscription_key=subscription_key,
+                                  config=config, deadline=deadline, download=download, cookie_index=cookie_index)
+        if update is None:
+            return None
+        return self.match_stage(update)
+
+    def match_stage(self, update):
+        """The second stage of an update. Matches the items against the subscriptions"""
+        self.rssfeedhandler.match_feed_items(update["config"], update["fetch_result"])
+        return update
+
+    def download_stage(self, update):
+        """The last stage of an update. Fetching the torrent files is
+        a slow task, so it is done in non-main thread."""
+        for torrent in update["fetch_result"]["matching_torrents"]:
+            self.download_torrent_stage(update, torrent)
+        return update
+
+    def download_torrent_stage(self, update, torrent):
+        """Download the torrent file of one of the matching items"""
+        deadline = update["deadline"]
+        if deadline.expired():
+            raise FeedUpdateDeadlineError("Deadline passed while downloading torrents")
+        if self.skip_failed_download(torrent):
+            return update
+        timeout = deadline.get_timeout(None)
+        torrent["torrent_download"] = self.torrent_handler.get_torrent(torrent, timeout=timeout, deadline=deadline)
+        self.record_download_result(torrent)
+        return update
+
+    def download_torrent_async(self, update, torrent):
+        """Download the torrent file of one of the matching items in the reactor"""
+        deadline = update["deadline"]
+        if deadline.expired():
+            raise FeedUpdateDeadlineError("Deadline passed while downloading torrents")
+        if self.skip_failed_download(torrent):
+            return update
+        d = self.torrent_handler.get_torrent_async(torrent, self.http_client, timeout=deadline.get_timeout(None))
+
+        def on_download(download):
+            torrent["torrent_download"] = download
+            self.record_download_result(torrent)
+            return update
+        d.addCallback(on_download)
+        return d
+
+    def skip_failed_download(self, torrent):
+        """If the torrent URL has failed to download recently, the download is set to
+        a failed TorrentDownload without downloading it. Returns True if skipped"""
+        reason = self.failed_downloads.get_skip_reason(torrent["link"])
+        if reason is None:
+            return False
+        self.log.info("Skipping download of torrent '%s' from url '%s': %s" %
+                      (torrent["title"], torrent["link"], reason))
+        download = TorrentDownload({"url": torrent["link"]})
+        download.set_error("Skipped download: %s" % reason)
+        torrent["torrent_download"] = download
+        return True
+
+    def record_download_result(self, torrent):
+        """Record the result of the download of the torrent file in the negative cache"""
+        download = torrent["torrent_download"]
+        if download.is_magnet:
+            return
+        if download.success:
+            self.failed_downloads.record_success(torrent["link"])
+        elif self.failed_downloads.record_failure(torrent["link"], download.error_msg):
+            self.log.warning("Torrent '%s' failed to download %d times. The url '%s' is no longer retried." %
+                             (torrent["title"], self.failed_downloads.max_retries, torrent["link"]))
+
+    def get_update_result(self, update):
+        """Returns the result of the update, which is passed on to add_torrents_callback"""
+        if update is None:
+            return None
+        rssfeed_key = update["rssfeed_key"]
+        config = update["config"]
+        fetch_result = update["fetch_result"]
+
+        # Match the items again on the next update, even if the RSS Feed has not changed,
+        # so the torrent files that failed to download are retried
+        for torrent in fetch_result["matching_torrents"]:
+            download = torrent.get("torrent_download")
+            if download is not None and not download.success and \
+               not self.failed_downloads.is_given_up(torrent["link"]):
+                reset_change_detection(config["rssfeeds"][rssfeed_key])
+                break
+
+        def update_rssfeed_func():
+            self.update_rssfeed_state(rssfeed_key, config["rssfeeds"][rssfeed_key], fetch_result,
+                                      change_detection=update.get("change_detection"))
+
+        # The live config must only be changed in the main thread
+        if not update["snapshot"]:
+            update_rssfeed_func()
+            update_rssfeed_func = None
+
+        return (self.add_torrents_func, self.save_subscription_last_match,
+                fetch_result["matching_torrents"], config, update_rssfeed_func)
+
+    def record_fetch_result(self, rssfeed_key, subscription_key, config, fetch_result):
+        """Record the result of fetching the RSS Feed in the circuit breaker of the RSS Feed.
+        If the RSS Feed has been permanently redirected to the same URL permanent_redirect_threshold
+        times in a row, the URL is stored in fetch_result["moved_to"]."""
+        status = fetch_result["status"]
+        # A response from a server shows that the network and the resolver are working
+        self.last_response_time = self.clock.seconds()
+        if status is not None and status >= 400:
+            self.record_update_failure(rssfeed_key, subscription_key, config, "HTTP status %d" % status,
+                                       retry_after=fetch_result.get("retry_after"), gone=status == 410)
+            return
+        rssfeed_key = self._get_rssfeed_key(rssfeed_key, subscription_key, config)
+        self.feed_health.record_success(rssfeed_key)
+        url = fetch_result.get("permanent_redirect")
+        count = self.feed_health.record_redirect(rssfeed_key, url)
+        if url is not None:
+            self.log.info("RSS Feed '%s' is permanently redirected to '%s' (%d updates in a row)." %
+                          (self._get_rssfeed_name(rssfeed_key, config), url, count))
+            if self.permanent_redirect_threshold and count >= self.permanent_redirect_threshold:
+                fetch_result["moved_to"] = url
+
+    def record_update_failure(self, rssfeed_key, subscription_key, config, error, retry_after=None, gone=False,
+                              host_not_found=False):
+        """Record a failed update in the circuit breaker of the RSS Feed. If gone is True, the RSS Feed
+        no longer exists, and it is deactivated after gone_deactivate_threshold such failures in a row,
+        spanning at least gone_deactivate_min_time seconds.
+
+        If host_not_found is True, the RSS Feed is only gone if another server has responded since
+        the previous failed update of the RSS Feed. When the network or the resolver is down,
+        the updates of all the RSS Feeds fail, and none of them are counted as gone."""
+        try:
+            rssfeed_key = self._get_rssfeed_key(rssfeed_key, subscription_key, config)
+        except KeyError:
+            return
+        if host_not_found:
+            last_failure = self.feed_health.get_last_failure_time(rssfeed_key)
+            gone = self.last_response_time is not None and \
+                (last_failure is None or self.last_response_time > last_failure)
+        delay = self.feed_health.record_failure(rssfeed_key, error, retry_after=retry_after, gone=gone)
+        self.log.warning("Update of RSS Feed '%s' failed (%s). Backing off for %d seconds." %
+                         (self._get_rssfeed_name(rssfeed_key, config), error, delay))
+        if gone and self.gone_deactivate_threshold:
+            count = self.feed_health.get_gone_count(rssfeed_key)
+            if count >= self.gone_deactivate_threshold and \
+               self.feed_health.get_gone_time(rssfeed_key) >= self.gone_deactivate_min_time:
+                reason = "Gone in %d updates in a row. Last error: %s" % (count, error)
+                self.call_in_main_thread(self.deactivate_rssfeed, rssfeed_key, reason)
+
+    def call_in_main_thread(self, f, *args):
+        """Call f with args in the main thread, as the live config must only be changed there"""
+        if self.main_thread_caller is not None:
+            self.main_thread_caller(f, *args)
+        elif threadable.isInIOThread():
+            f(*args)
+        else:
+            reactor.callFromThread(f, *args)
+
+    def deactivate_rssfeed(self, rssfeed_key, reason):
+        """Deactivate the RSS Feed, which no longer exists, and save the config"""
+        rssfeed = self.yarss_config.get_config()["rssfeeds"].get(rssfeed_key)
+        if rssfeed is None or not rssfeed["active"]:
+            return
+        self.log.warning("Deactivating RSS Feed '%s' (%s): %s" % (rssfeed["name"], rssfeed["url"], reason))
+        rssfeed["active"] = False
+        self.feed_health.remove(rssfeed_key)
+        self.yarss_config.generic_save_config("rssfeeds", data_dict=rssfeed)
+        self.emit_config_changed()
+
+    def _get_rssfeed_key(self, rssfeed_key, subscription_key, config):
+        if rssfeed_key is not None:
+            return rssfeed_key
+        if config is None:
+            config = self.yarss_config.get_config()
+        return config["subscriptions"][subscription_key]["rssfeed_key"]
+
+    def _get_rssfeed_name(self, rssfeed_key, config):
+        """Returns the name of the RSS Feed for the log messages, or the key if it has been deleted"""
+        if config is None:
+            config = self.yarss_config.get_config()
+        rssfeed = config["rssfeeds"].get(rssfeed_key)
+        return rssfeed["name"] if rssfeed is not None else rssfeed_key
+
+    def update_rssfeed_state(self, rssfeed_key, rssfeed_data, fetch_result, change_detection=None):
+        """Store the values changed by an update of the RSS Feed in the live config.
+        rssfeed_data may be the live RSS Feed config, or a snapshot of it.
+        change_detection: The ETag, Last-Modified and content hash of the snapshot when the update started.
+        """
+        rssfeed = self.yarss_config.get_config()["rssfeeds"].get(rssfeed_key)
+        # The RSS Feed was deleted while being updated
+        if rssfeed is None:
+            return
+        if rssfeed is not rssfeed_data:
+            for key in ("last_update", "obey_ttl"):
+                rssfeed[key] = rssfeed_data[key]
+            # Not stored if they were changed during the update, e.g. reset when a subscription
+            # or the URL was saved, as the next update must then parse the whole RSS Feed
+            if rssfeed["url"] == rssfeed_data["url"] and \
+               (change_detection is None or all(rssfeed[key] == value for key, value in change_detection.items())):
+                for key in CHANGE_DETECTION_KEYS:
+                    rssfeed[key] = rssfeed_data[key]
+
+        # Save the new URL of an RSS Feed that has moved, unless the URL was changed during the update
+        moved_to = fetch_result.get("moved_to")
+        if moved_to and rssfeed["url"] == rssfeed_data["url"]:
+            self.log.warning("RSS Feed '%s' has moved permanently. Changing the URL from '%s' to '%s'." %
+                             (rssfeed["name"], rssfeed["url"], moved_to))
+            rssfeed["url"] = moved_to
+            # The cookies are looked up by the site
+            rssfeed["site"] = urlparse.urlparse(moved_to).netloc
+            self.feed_health.record_redirect(rssfeed_key, None)
+            self.yarss_config.generic_save_config("rssfeeds", data_dict=rssfeed)
 
         # Update TTL value?
         if "ttl" in fetch_result:
-            # Subscription is run directly. Get RSS Feed key
-            if not rssfeed_key:
-                rssfeed_key = self.yarss_config.get_config()["subscriptions"][subscription_key]["rssfeed_key"]
             self.log.info("Rescheduling RSS Feed '%s' with interval '%s' according to TTL." %
-                          (self.yarss_config.get_config()["rssfeeds"][rssfeed_key]["name"], fetch_result["ttl"]))
-            rssfeed = self.yarss_config.get_config()["rssfeeds"][rssfeed_key]
+                          (rssfeed["name"], fetch_result["ttl"]))
             # Set new interval in config
             rssfeed["update_interval"] = fetch_result["ttl"]
             # Reschedule timer
             self.set_timer(rssfeed_key, fetch_result["ttl"], rssfeed["update_on_startup"])
-        # Send YARSSConfigChangedEvent to GUI with updated config.
+        if rssfeed["adaptive_interval"] and (fetch_result.get("rssfeed_items") or fetch_result.get("published_dates")):
+            self.adapt_update_interval(rssfeed_key, rssfeed, fetch_result)
+        self.emit_config_changed()
+
+    def emit_config_changed(self):
+        """Send YARSSConfigChangedEvent to GUI with updated config"""
         try:
             # Tests throws KeyError for EventManager when running this method, so wrap this in try/except
             component.get("EventManager").emit(YARSSConfigChangedEvent(self.yarss_config.get_config()))
         except KeyError:
             pass
 
-        def save_subscription_func(subscription_data):
-            self.yarss_config.generic_save_config("subscriptions", data_dict=subscription_data)
+    def adapt_update_interval(self, rssfeed_key, rssfeed, fetch_result):
+        """Reschedule the RSS Feed with an interval estimated from the publish times of the items"""
+        if fetch_result.get("published_dates"):
+            # The parsing stopped at the watermark, so not all the items are in rssfeed_items
+            published_dates = [common.isodate_to_datetime(date) for date in fetch_result["published_dates"]]
+        else:
+            published_dates = [common.isodate_to_datetime(item["updated"])
+                               for item in fetch_result["rssfeed_items"].values() if item["updated"]]
+        # Don't poll more often than the server says the feed is unchanged
+        lower_bound = fetch_result.get("cache_lifetime")
+        if rssfeed["obey_ttl"]:
+            lower_bound = max(lower_bound or 0, rssfeed["update_interval"] * 60)
+        interval = get_adaptive_interval(published_dates, common.get_current_date(),
+                                         rssfeed["adaptive_interval_min"], rssfeed["adaptive_interval_max"],
+                                         lower_bound=lower_bound)
+        if interval is None:
+            interval = rssfeed["update_interval"]
+        timer = self.rssfeed_timers.get(rssfeed_key)
+        if timer is None or timer["update_interval"] == interval:
+            return
+        self.log.info("Rescheduling RSS Feed '%s' with adaptive interval '%s'." % (rssfeed["name"], interval))
+        self.set_timer(rssfeed_key, interval, rssfeed["update_on_startup"])
 
-        return (self.add_torrents_func, save_subscription_func,
-                fetch_result["matching_torrents"], self.yarss_config.get_config())
+    def save_subscription_last_match(self, subscription_data):
+        """Save the last_match value of subscription_data, which may be a snapshot
+        of the subscription in the live config"""
+        subscriptions = self.yarss_config.get_config()["subscriptions"]
+        if "key" in subscription_data:
+            subscription = subscriptions.get(subscription_data["key"])
+            # The subscription was deleted while the RSS Feed was being updated
+            if subscription is None:
+                return
+            if subscription is not subscription_data:
+                # Another update of the subscription, e.g. a manual run during a scheduled update,
+                # may have finished first with a newer match
+                if common.isodate_to_epoch(subscription_data["last_match"]) <= \
+                   common.isodate_to_epoch(subscription["last_match"]):
+                    return
+                subscription["last_match"] = subscription_data["last_match"]
+            subscription_data = subscription
+        self.yarss_config.generic_save_config("subscriptions", data_dict=subscription_data)
 
     def add_torrents_callback(self, args):
         """
-        Called with the results from rssfeed_update_handler
+        Called with the result of get_update_result
         add_torrents_func must be called on the main thread
 
         """
         if args is None:
             return
-        add_torrents_func, save_subscription_func, matching_torrents, config = args
+        add_torrents_func, save_subscription_func, matching_torrents, config, update_rssfeed_func = args
+        if update_rssfeed_func is not None:
+            update_rssfeed_func()
         add_torrents_func(save_subscription_func, matching_torrents, config)
 
-    def queue_rssfeed_update(self, *args, **kwargs):
-        d = self.run_queue.push(self.rssfeed_update_handler_safe, *args, **kwargs)
-        d.addCallback(self.add_torrents_callback)
+    def get_config_snapshot(self, rssfeed_key=None, subscription_key=None):
+        """Returns a copy of the parts of the config needed to update an RSS Feed,
+        so that the update can run in a worker thread without sharing the dicts
+        of the live config.
+        """
+        config = self.yarss_config.get_config()
+        if rssfeed_key is None:
+            rssfeed_key = config["subscriptions"][subscription_key]["rssfeed_key"]
+        snapshot = dict(config)
+        snapshot["rssfeeds"] = {rssfeed_key: config["rssfeeds"][rssfeed_key]}
+        snapshot["subscriptions"] = dict((key, subscription) for key, subscription in
+                                         config["subscriptions"].items()
+                                         if subscription["rssfeed_key"] == rssfeed_key)
+        for key in ("rssfeeds", "subscriptions", "cookies", "email_configurations", "email_messages"):
+            snapshot[key] = copy.deepcopy(snapshot[key])
+        return snapshot
+
+    def queue_rssfeed_update(self, rssfeed_key=None, subscription_key=None, priority=PRIORITY_NORMAL):
+        """Queue an update of the RSS Feed, or only the subscription if subscription_key is given.
+
+        The update passes through the stage queues: run_queue fetches and parses the RSS Feed,
+        match_queue matches the items against the subscriptions, and download_queue downloads
+        the torrent files, each in a separate job. Each stage queue has its own concurrency limit,
+        so the downloads of one RSS Feed may overlap with the fetching of other RSS Feeds.
+
+        An update with the same keys that is already queued is not queued again.
+        Updates run by the timer are also not queued when the same update is already in progress.
+        """
+        key = (rssfeed_key, subscription_key)
+        if priority != PRIORITY_MANUAL and key in self._updates_in_progress:
+            return defer.succeed(None)
+        config = self.yarss_config.get_config()
+        try:
+            feed_key = rssfeed_key if rssfeed_key is not None else \
+                config["subscriptions"][subscription_key]["rssfeed_key"]
+            rssfeed_data = config["rssfeeds"][feed_key]
+        except KeyError as err:
+            self.log.warning("Cannot update RSS Feed. Invalid RSS Feed or Subscription key: %s" % str(err))
+            return defer.succeed(None)
+        host = get_hostname(rssfeed_data["url"])
+        deadline = config["general"]["feed_update_deadline"] or None
+        if self.http_client is not None:
+            # Download in the reactor, then parse in a worker thread
+            d = self.run_queue.push_job(self.start_update, args=(self.fetch_rssfeed_async, rssfeed_key,
+                                                                 subscription_key, deadline, True),
+                                        host=host, key=key, priority=priority,
+                                        coalesce_running=priority != PRIORITY_MANUAL,
+                                        deadline=deadline, in_thread=False)
+            d.addCallback(self._queue_parse_stage)
+        else:
+            d = self.run_queue.push_job(self.start_update, args=(self.fetch_stage, rssfeed_key,
+                                                                 subscription_key, deadline, False),
+                                        host=host, key=key, priority=priority,
+                                        coalesce_running=priority != PRIORITY_MANUAL,
+                                        deadline=deadline, in_thread=False)
+            d.addCallback(self._queue_stage, self.match_queue, self.match_stage)
+        self._updates_in_progress[key] = self._updates_in_progress.get(key, 0) + 1
+        d.addCallback(self._queue_downloads)
+        d.addCallback(self.get_update_result)
+        d.addBoth(self._on_update_finished, key)
+        d.addCallbacks(self.add_torrents_callback, self.on_update_deadline_exceeded,
+                       errbackArgs=(rssfeed_data["name"],))
+        return d
+
+    def start_update(self, stage_func, rssfeed_key, subscription_key, deadline, in_reactor):
+        """Starts the first stage of an update queued by queue_rssfeed_update. Called in the main
+        thread when the job is started by the run queue, so an update that has been waiting
+        in the queue runs with the current config.
+
+        Takes the snapshot of the config and the index of the cookies of the live config,
+        which is only used in the main thread, and runs stage_func with them, in the reactor
+        if in_reactor is True, else in a worker thread.
+        Returns a Deferred called with the result of the stage, or None if it failed.
+        """
+        try:
+            config = self.get_config_snapshot(rssfeed_key=rssfeed_key, subscription_key=subscription_key)
+        except KeyError as err:
+            # Deleted while the update was queued
+            self.log.warning("Cannot update RSS Feed. Invalid RSS Feed or Subscription key: %s" % str(err))
+            return None
+        stage_kwargs = {"rssfeed_key": rssfeed_key, "subscription_key": subscription_key,
+                        "config": config, "deadline": deadline, "cookie_index": self.yarss_config.get_cookie_index()}
+        if in_reactor:
+            return self.run_async_stage_safe(stage_func, stage_kwargs, rssfeed_key, subscription_key, config)
+        return threads.deferToThread(self.run_stage_safe, stage_func, stage_kwargs, rssfeed_key,
+                                     subscription_key, config)
+
+    def _queue_stage(self, update, stage_queue, stage_func, host=None):
+        """Queue the next stage of the update, unless the update has failed or was not run"""
+        if update is None:
+            return None
+        # The RSS Feed has not changed, so there is nothing more to do
+        if update["fetch_result"].get("not_modified"):
+            return update
+        args = (stage_func, {"update": update}, update["rssfeed_key"], None, update["config"])
+        return stage_queue.push_job(self.run_stage_safe, args=args, host=host,
+                                    deadline=update["deadline"].get_timeout(None))
+
+    def _queue_parse_stage(self, stage_kwargs):
+        """Queue parse_and_match_stage with the RSS Feed downloaded by fetch_rssfeed_async"""
+        if stage_kwargs is None:
+            return None
+        args = (self.parse_and_match_stage, stage_kwargs, stage_kwargs["rssfeed_key"],
+                stage_kwargs["subscription_key"], stage_kwargs["config"])
+        return self.match_queue.push_job(self.run_stage_safe, args=args,
+                                         deadline=stage_kwargs["deadline"].get_timeout(None))
+
+    def _queue_downloads(self, update):
+        """Queue the downloads of the torrent files of the matching items. The torrent files
+        are downloaded in parallel, and the update continues when all have finished."""
+        if update is None:
+            return None
+        deferreds = []
+        for torrent in update["fetch_result"]["matching_torrents"]:
+            if self.http_client is not None:
+                stage_func, run_func = self.download_torrent_async, self.run_async_stage_safe
+            else:
+                stage_func, run_func = self.download_torrent_stage, self.run_stage_safe
+            args = (stage_func, {"update": update, "torrent": torrent}, update["rssfeed_key"], None, update["config"])
+            deferreds.append(self.download_queue.push_job(run_func, args=args,
+                                                          host=get_hostname(torrent["link"]),
+                                                          deadline=update["deadline"].get_timeout(None),
+                                                          in_thread=self.http_client is None))
+        if not deferreds:
+            return update
+        d = defer.DeferredList(deferreds, consumeErrors=True)
+        d.addCallback(self._on_downloads_finished, update)
         return d
 
+    def _on_downloads_finished(self, results, update):
+        """The download is stored in each torrent dict, so the matching
+        torrents stay in the original order given by the RSS Feed"""
+        for success, result in results:
+            # Abandoned by the watchdog
+            if not success:
+                return result
+            # The download stage failed, so the update is abandoned
+            if result is None:
+                return None
+        return update
+
+    def _on_update_finished(self, result, key):
+        self._updates_in_progress[key] -= 1
+        if not self._updates_in_progress[key]:
+            del self._updates_in_progress[key]
+        return result
+
+    def count_fetch(self, fetch_result):
+        """Count how the fetch of an RSS Feed ended"""
+        if fetch_result.get("content_unchanged"):
+            key = "content_unchanged"
+        elif fetch_result.get("not_modified"):
+            key = "not_modified"
+        else:
+            key = "parsed"
+        with self._fetch_counts_lock:
+            self._fetch_counts[key] += 1
+
+    def get_stage_stats(self):
+        """Returns the stats of each stage queue, by stage name. The stats of the fetch
+        stage include the number of fetches that were parsed, that were answered with 304
+        Not Modified (not_modified) and that had the same content as the previous fetch
+        (content_unchanged)"""
+        fetch_stats = self.run_queue.get_stats()
+        with self._fetch_counts_lock:
+            fetch_stats.update(self._fetch_counts)
+        return {"fetch": fetch_stats,
+                "match": self.match_queue.get_stats(),
+                "download": self.download_queue.get_stats()}
+
+    def on_update_deadline_exceeded(self, failure, rssfeed_name):
+        """Called when the watchdog of the run queue abandons an update"""
+        failure.trap(FeedUpdateDeadlineError)
+        self.log.warning("The update of RSS Feed '%s' did not finish in time and was abandoned: %s" %
+                         (rssfeed_name, failure.getErrorMessage()))
+
+
+class RSSFeedJob(object):
+    """A job in the RSSFeedRunQueue"""
+    def __init__(self, f, args, kwargs, host=None, key=None, priority=PRIORITY_NORMAL, in_thread=True):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.host = host
+        self.key = key
+        self.priority = priority
+        self.seq = None
+        # Seconds the job may run before it is abandoned
+        self.deadline = None
+        self.watchdog = None
+        self.abandoned = False
+        # Run in a worker thread, or in the reactor if f returns a Deferred
+        self.in_thread = in_thread
+        # The Deferred of the running function
+        self.running = None
+        self.deferred = defer.Deferred()
+        # Deferreds of the jobs coalesced with this job
+        self.waiters = []
+
 
 class RSSFeedRunQueue(object):
-    """Runs functions in separate threads. If a job is already running,
-    jobs pushed are queued until the running job has finished"""
-    def __init__(self, concurrent_max=1):
+    """Runs functions in separate threads, or in the reactor for functions returning a Deferred.
+    At most concurrent_max jobs are run at the same time,
+    and at most max_per_host of those towards the same host. Jobs pushed when the limits are
+    reached are queued until a running job has finished.
+
+    Queued jobs are started in order of priority (lowest value first), then in the order they were pushed.
+    A job pushed with the same key as a job already queued is coalesced with the queued job. The
+    deferred returned for a coalesced job is called with None when the queued job has finished.
+
+    A job pushed with a deadline is abandoned by a watchdog if it has not finished in time.
+    The slot of the job is freed and the deferred of the job fails with FeedUpdateDeadlineError.
+    The thread cannot be interrupted, so the result of the job is discarded when it finishes.
+    The Deferred of a job run in the reactor is cancelled.
+
+    Queues may be chained with set_downstream. A queue holding max_queued jobs is full,
+    and the queue upstream of it does not start new jobs until it has room.
+    """
+    def __init__(self, concurrent_max=1, max_per_host=None, clock=None, max_queued=None):
+        self.clock = clock if clock is not None else reactor
         self.concurrentMax = concurrent_max
+        self.max_queued = max_queued
+        self._downstream = None
+        self._upstream = []
+        self.max_per_host = max_per_host
         self._running = 0
+        self._running_hosts = {}
+        self._running_keys = {}
+        # Sorted list of (priority, seq, job)
         self._queued = []
+        self._queued_keys = {}
+        self._seq = itertools.count()
+        # Abandoned jobs whose threads are still running
+        self._abandoned_running = 0
+        self.stall_count = 0
+
+    def set_limits(self, concurrent_max, max_per_host=None):
+        """Change the limits. Queued jobs are started if the new limits allow it"""
+        self.concurrentMax = max(1, concurrent_max)
+        self.max_per_host = max_per_host if max_per_host and max_per_host > 0 else None
+        self._start_queued()
+
+    def set_downstream(self, queue):
+        """Don't start jobs while queue is full"""
+        self._downstream = queue
+        queue._upstream.append(self)
+
+    def is_full(self):
+        return self.max_queued is not None and len(self._queued) >= self.max_queued
 
     def push(self, f, *args, **kwargs):
         """Push job to queue"""
-        if self._running < self.concurrentMax:
-            return self._run(f, args, kwargs)
+        return self.push_job(f, args=args, kwargs=kwargs)
+
+    def push_host(self, host, f, *args, **kwargs):
+        """Push job accessing host to queue. host may be None if the job
+        is not subject to the per host limit"""
+        return self.push_job(f, args=args, kwargs=kwargs, host=host)
+
+    def push_job(self, f, args=(), kwargs=None, host=None, key=None, priority=PRIORITY_NORMAL,
+                 coalesce_running=False, deadline=None, in_thread=True):
+        """Push job to queue
+
+        Args:
+            host (str): The host accessed by the job, or None if not subject to the per host limit
+            key: Jobs with the same key (not None) are coalesced
+            priority (int): Lower values are run first
+            coalesce_running (bool): Coalesce with a running job with the same key instead of
+                                     queueing a new job to run when the running job has finished
+            deadline (int): Seconds the job may run before it is abandoned, or None for no limit
+            in_thread (bool): Run f in a worker thread. If False, f is called in the reactor
+                              thread, and the job runs until the Deferred returned by f has fired
+        """
+        if kwargs is None:
+            kwargs = {}
+        if key is not None:
+            job = self._queued_keys.get(key)
+            if job is None and coalesce_running:
+                job = self._running_keys.get(key)
+            if job is not None:
+                return self._coalesce(job, f, args, kwargs, priority)
+
+        job = RSSFeedJob(f, args, kwargs, host=host, key=key, priority=priority, in_thread=in_thread)
+        job.deadline = deadline
+        # Queued jobs are always waiting for a limit, so if this job
+        # can run now, it's not overtaking any job it competes with
+        if self._can_run(host):
+            self._run(job)
+        else:
+            self._enqueue(job)
+        return job.deferred
+
+    def _coalesce(self, job, f, args, kwargs, priority):
         d = defer.Deferred()
-        self._queued.append((f, args, kwargs, d))
+        job.waiters.append(d)
+        if job.key in self._queued_keys:
+            # Run the queued job with the latest arguments
+            job.f, job.args, job.kwargs = f, args, kwargs
+            if priority < job.priority:
+                self._queued.remove((job.priority, job.seq, job))
+                job.priority = priority
+                bisect.insort(self._queued, (job.priority, job.seq, job))
         return d
 
-    def _run(self, f, args, kwargs):
-        """Run function in separate thread"""
+    def _enqueue(self, job):
+        job.seq = next(self._seq)
+        bisect.insort(self._queued, (job.priority, job.seq, job))
+        if job.key is not None:
+            self._queued_keys[job.key] = job
+
+    def _can_run(self, host):
+        if self._running >= self.concurrentMax:
+            return False
+        if self._downstream is not None and self._downstream.is_full():
+            return False
+        if host is None or self.max_per_host is None:
+            return True
+        return self._running_hosts.get(host, 0) < self.max_per_host
+
+    def _run(self, job):
+        """Run function in separate thread, or in the reactor"""
         self._running += 1
-        deferred = threads.deferToThread(f, *args, **kwargs)
-        deferred.addBoth(self._try_queued)
-        return deferred
+        if job.host is not None:
+            self._running_hosts[job.host] = self._running_hosts.get(job.host, 0) + 1
+        if job.key is not None:
+            self._running_keys[job.key] = job
+        if job.deadline:
+            job.watchdog = self.clock.callLater(job.deadline, self._on_deadline, job)
+        if job.in_thread:
+            job.running = threads.deferToThread(job.f, *job.args, **job.kwargs)
+        else:
+            job.running = defer.maybeDeferred(job.f, *job.args, **job.kwargs)
+        job.running.addBoth(self._try_queued, job)
+
+    def _on_deadline(self, job):
+        """Abandon job, which has not finished within the deadline"""
+        job.watchdog = None
+        job.abandoned = True
+        self.stall_count += 1
+        self._abandoned_running += 1
+        self._release(job)
+        self._start_queued()
+        self._fire(job, Failure(FeedUpdateDeadlineError("Job did not finish within %s seconds" % job.deadline)))
+        if not job.in_thread:
+            job.running.cancel()
 
-    def _try_queued(self, r):
-        """Execute next job in queue if it exists"""
+    def _try_queued(self, r, job):
+        """Execute next jobs in queue if the limits allow it, and pass the result on"""
+        if job.abandoned:
+            # The slot was freed, and the deferred fired, by the watchdog
+            self._abandoned_running -= 1
+            return
+        if job.watchdog is not None:
+            job.watchdog.cancel()
+            job.watchdog = None
+        self._release(job)
+        self._start_queued()
+        self._fire(job, r)
+
+    def _release(self, job):
         self._running -= 1
-        if self._running < self.concurrentMax and self._queued:
-            f, args, kwargs, d = self._queued.pop(0)
-            new_d = self._run(f, args, kwargs)
-            new_d.chainDeferred(d)
+        if job.host is not None:
+            self._running_hosts[job.host] -= 1
+            if not self._running_hosts[job.host]:
+                del self._running_hosts[job.host]
+        if job.key is not None and self._running_keys.get(job.key) is job:
+            del self._running_keys[job.key]
+
+    def _fire(self, job, r):
         if isinstance(r, Failure):
-            r.trap()
-        return r
+            job.deferred.errback(r)
+        else:
+            job.deferred.callback(r)
+        for d in job.waiters:
+            d.callback(None)
+
+    def _start_queued(self):
+        """Start queued jobs in order of priority, skipping the jobs
+        whose host already has max_per_host jobs running"""
+        index = 0
+        started = False
+        while index < len(self._queued) and self._running < self.concurrentMax:
+            job = self._queued[index][2]
+            if not self._can_run(job.host):
+                index += 1
+                continue
+            del self._queued[index]
+            if job.key is not None:
+                del self._queued_keys[job.key]
+            self._run(job)
+            started = True
+        # There may now be room for the jobs upstream
+        if started:
+            for queue in self._upstream:
+                queue._start_queued()
+
+    def get_queued_count(self):
+        return len(self._queued)
+
+    def get_running_count(self):
+        return self._running
+
+    def get_stats(self):
+        return {"running": self._running,
+                "queued": len(self._queued),
+                "stalled": self.stall_count,
+                "abandoned_running": self._abandoned_running}
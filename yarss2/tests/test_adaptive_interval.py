@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import datetime
+
+from twisted.trial import unittest
+
+from yarss2.util import common
+from yarss2.util.adaptive_interval import get_adaptive_interval
+
+
+class AdaptiveIntervalTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.now = common.get_current_date()
+
+    def get_dates(self, *minutes_ago):
+        return [self.now - datetime.timedelta(minutes=minutes) for minutes in minutes_ago]
+
+    def test_too_few_items(self):
+        self.assertEquals(get_adaptive_interval([], self.now, 5, 720), None)
+        self.assertEquals(get_adaptive_interval(self.get_dates(10), self.now, 5, 720), None)
+        # Items in the future are ignored
+        self.assertEquals(get_adaptive_interval(self.get_dates(10, -60), self.now, 5, 720), None)
+
+    def test_busy_feed(self):
+        # An item every 10 minutes, the newest just published
+        dates = self.get_dates(0, 10, 20, 30, 40)
+        self.assertEquals(get_adaptive_interval(dates, self.now, 1, 720), 5)
+        # Within the bounds
+        self.assertEquals(get_adaptive_interval(dates, self.now, 15, 720), 15)
+
+    def test_quiet_feed(self):
+        # A burst of items four hours ago
+        dates = self.get_dates(240, 241, 242)
+        self.assertEquals(get_adaptive_interval(dates, self.now, 5, 720), 60)
+        self.assertEquals(get_adaptive_interval(dates, self.now, 5, 30), 30)
+
+    def test_lower_bound(self):
+        dates = self.get_dates(0, 10, 20)
+        self.assertEquals(get_adaptive_interval(dates, self.now, 1, 720, lower_bound=30 * 60), 30)
@@ -0,0 +1,331 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.trial import unittest
+from twisted.web import http, resource, server, util
+
+import yarss2.util.common
+from yarss2.error import DownloadRejectedError
+from yarss2.rssfeed_handling import RSSFeedHandler
+from yarss2.rssfeed_scheduler import RSSFeedScheduler
+from yarss2.torrent_handling import TorrentHandler
+from yarss2.util import http as http_util
+from yarss2.util import http_sessions, logging
+from yarss2.util.async_http import AsyncHTTPClient, NoVerifyPolicyForHTTPS
+
+from . import common as test_common
+from .utils.log_utils import plugin_tests_logger_name
+
+log = logging.getLogger(plugin_tests_logger_name)
+
+
+class StaticResource(resource.Resource):
+    isLeaf = True
+
+    def __init__(self, content, content_type=b"text/plain", code=200, headers=None):
+        resource.Resource.__init__(self)
+        self.content = content
+        self.content_type = content_type
+        self.code = code
+        self.headers = headers or {}
+        self.etag = None
+        self.requests = []
+
+    def render_GET(self, request):  # NOQA
+        self.requests.append(request)
+        if self.etag is not None and request.setETag(self.etag) == http.CACHED:
+            return b""
+        request.setResponseCode(self.code)
+        request.setHeader(b"content-type", self.content_type)
+        for name, value in self.headers.items():
+            request.setHeader(name, value)
+        return self.content
+
+
+class ChunkedResource(resource.Resource):
+    """Sends the content in chunks, without a Content-Length"""
+    isLeaf = True
+
+    def __init__(self, chunk, count):
+        resource.Resource.__init__(self)
+        self.chunk = chunk
+        self.count = count
+
+    def render_GET(self, request):  # NOQA
+        for i in range(self.count):
+            request.write(self.chunk)
+        request.finish()
+        return server.NOT_DONE_YET
+
+
+class HangingResource(resource.Resource):
+    """Never answers the request"""
+    isLeaf = True
+
+    def render_GET(self, request):  # NOQA
+        return server.NOT_DONE_YET
+
+
+class RecordingSite(server.Site):
+    """Site keeping track of the connections, so the test can wait for them to be closed"""
+
+    def __init__(self, root):
+        server.Site.__init__(self, root)
+        self.connections_lost = []
+
+    def buildProtocol(self, addr):  # NOQA
+        protocol = server.Site.buildProtocol(self, addr)
+        d = defer.Deferred()
+        self.connections_lost.append(d)
+        connection_lost = protocol.connectionLost
+
+        def on_connection_lost(reason):
+            connection_lost(reason)
+            d.callback(None)
+        protocol.connectionLost = on_connection_lost
+        return protocol
+
+
+class AsyncHTTPClientTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.torrent_data = yarss2.util.common.read_file(
+            yarss2.util.common.get_resource("FreeBSD-9.0-RELEASE-amd64-dvd1.torrent", path="tests/data/"))
+        feed_data = yarss2.util.common.read_file(
+            yarss2.util.common.get_resource(test_common.testdata_rssfeed_filename, path="tests/"))
+        self.root = resource.Resource()
+        self.site = RecordingSite(self.root)
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.base_url = "http://127.0.0.1:%d" % self.port.getHost().port
+        # Download the torrent files from the test server
+        feed_data = feed_data.replace(b"http://torrents.FreeBSD.org:8080", self.base_url.encode("utf-8"))
+        self.feed = StaticResource(feed_data, content_type=b"application/rss+xml")
+        self.torrent = StaticResource(self.torrent_data, content_type=b"application/x-bittorrent")
+        self.root.putChild(b"feed", self.feed)
+        self.root.putChild(b"gzip", resource.EncodingResourceWrapper(self.feed, [server.GzipEncoderFactory()]))
+        self.root.putChild(b"redirect", util.Redirect(b"/feed"))
+        self.root.putChild(b"moved", StaticResource(b"", code=301,
+                                                    headers={b"Location": (self.base_url + "/feed").encode()}))
+        self.root.putChild(b"busy", StaticResource(b"Busy", code=503, headers={b"Retry-After": b"120"}))
+        self.root.putChild(b"torrents", self.torrent)
+        self.root.putChild(b"hang", HangingResource())
+        self.root.putChild(b"chunked", ChunkedResource(b"x" * 1000, 10))
+        self.client = AsyncHTTPClient()
+
+    @defer.inlineCallbacks
+    def tearDown(self):  # NOQA
+        yield self.client.close()
+        # Close the connections of the threaded downloads
+        http_sessions.session_pool.close()
+        yield self.port.stopListening()
+        yield defer.DeferredList(self.site.connections_lost)
+
+    @defer.inlineCallbacks
+    def test_get(self):
+        result = yield self.client.get(self.base_url + "/feed", headers={"User-Agent": "Test agent"})
+        self.assertEquals(result["status"], 200)
+        self.assertEquals(result["url"], self.base_url + "/feed")
+        self.assertEquals(result["headers"]["content-type"], "application/rss+xml")
+        self.assertEquals(result["content"], self.feed.content)
+        self.assertEquals(self.feed.requests[0].getHeader(b"user-agent"), b"Test agent")
+
+    @defer.inlineCallbacks
+    def test_get_reuses_connection(self):
+        yield self.client.get(self.base_url + "/feed")
+        yield self.client.get(self.base_url + "/torrents/1.torrent")
+        self.assertEquals(len(self.site.connections_lost), 1)
+
+    @defer.inlineCallbacks
+    def test_get_gzip(self):
+        result = yield self.client.get(self.base_url + "/gzip")
+        self.assertEquals(result["content"], self.feed.content)
+
+    @defer.inlineCallbacks
+    def test_get_redirect(self):
+        result = yield self.client.get(self.base_url + "/redirect")
+        self.assertEquals(result["status"], 200)
+        self.assertEquals(result["url"], self.base_url + "/feed")
+        self.assertEquals(result["content"], self.feed.content)
+
+    @defer.inlineCallbacks
+    def test_get_feed_permanent_redirect(self):
+        result = yield self.client.get_feed(self.base_url + "/moved")
+        self.assertEquals(result["permanent_redirect"], self.base_url + "/feed")
+        result = yield self.client.get_feed(self.base_url + "/redirect")
+        self.assertFalse("permanent_redirect" in result)
+        result = yield threads.deferToThread(http_util.download_file, self.base_url + "/moved")
+        self.assertEquals(result["status"], 301)
+        self.assertEquals(result["permanent_redirect"], self.base_url + "/feed")
+
+    def test_get_timeout(self):
+        d = self.client.get(self.base_url + "/hang", timeout=0.2)
+        return self.assertFailure(d, defer.TimeoutError)
+
+    def test_get_max_size_content_length(self):
+        d = self.client.get(self.base_url + "/feed", max_size=len(self.feed.content) - 1)
+        return self.assertFailure(d, DownloadRejectedError)
+
+    @defer.inlineCallbacks
+    def test_get_max_size_streamed(self):
+        result = yield self.client.get(self.base_url + "/chunked", max_size=10000)
+        self.assertEquals(len(result["content"]), 10000)
+        yield self.assertFailure(self.client.get(self.base_url + "/chunked", max_size=9999), DownloadRejectedError)
+
+    def test_get_rejected_type(self):
+        d = self.client.get(self.base_url + "/torrents/1.torrent", rejected_types=("application/x-bittorrent",))
+        return self.assertFailure(d, DownloadRejectedError)
+
+    @defer.inlineCallbacks
+    def test_get_feed(self):
+        handler = RSSFeedHandler(log)
+        rssfeed_data = {"name": "Test", "url": self.base_url + "/feed", "site": "127.0.0.1",
+                        "prefer_magnet": False}
+        download = yield handler.download_rssfeed_async(rssfeed_data, self.client,
+                                                        site_cookies_dict={"uid": "18463"},
+                                                        user_agent="Test agent")
+        self.assertEquals(self.feed.requests[0].getHeader(b"cookie"), b"uid=18463")
+        parsed_feed = handler.get_rssfeed_parsed(rssfeed_data, download=download)
+        self.assertEquals(parsed_feed["status"], 200)
+        self.assertEquals(len(parsed_feed["items"]), len(test_common.load_json_testdata()))
+
+    @defer.inlineCallbacks
+    def test_get_feed_retry_after(self):
+        result = yield self.client.get_feed(self.base_url + "/busy")
+        self.assertEquals(result["status"], 503)
+        self.assertEquals(result["retry_after"], 120)
+
+    @defer.inlineCallbacks
+    def test_get_torrent_async(self):
+        handler = TorrentHandler(log)
+        download = yield handler.get_torrent_async({"link": self.base_url + "/torrents/1.torrent"}, self.client)
+        self.assertTrue(download.success)
+        self.assertEquals(download.filedump, self.torrent_data)
+        # Not a torrent file
+        download = yield handler.get_torrent_async({"link": self.base_url + "/feed"}, self.client)
+        self.assertFalse(download.success)
+        # Larger than the limit
+        handler.max_torrent_size = len(self.torrent_data) - 1
+        download = yield handler.get_torrent_async({"link": self.base_url + "/torrents/1.torrent"}, self.client)
+        self.assertFalse(download.success)
+
+    def get_scheduler(self, use_async_http=True):
+        config = test_common.get_test_config()
+        config_dict = test_common.get_test_config_dict()
+        config_dict["rssfeeds"]["0"]["url"] = self.base_url + "/feed"
+        config_dict["general"]["use_async_http"] = use_async_http
+        config.set_config(config_dict)
+        scheduler = RSSFeedScheduler(config, log)
+        scheduler.added = []
+
+        def add_torrents_cb(save_subscription_func, matching_torrents, config):
+            scheduler.added.extend(matching_torrents)
+        scheduler.add_torrents_func = add_torrents_cb
+        return scheduler
+
+    @defer.inlineCallbacks
+    def test_rssfeed_update(self):
+        """Tests an update of an RSS Feed with the requests run in the reactor"""
+        scheduler = self.get_scheduler()
+        try:
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+        finally:
+            # Close the connections before the server is stopped
+            scheduler.set_async_http(False)
+        self.assertEquals(len(self.feed.requests), 1)
+        self.assertEquals(len(self.torrent.requests), 3)
+        self.assertEquals(len(scheduler.added), 3)
+        for torrent in scheduler.added:
+            self.assertTrue(torrent["torrent_download"].success)
+            self.assertEquals(torrent["torrent_download"].filedump, self.torrent_data)
+
+    @defer.inlineCallbacks
+    def verify_rssfeed_update_not_modified(self, use_async_http):
+        self.feed.etag = b'"v1"'
+        self.feed.headers[b"Last-Modified"] = b"Sat, 17 Oct 2026 10:00:00 GMT"
+        scheduler = self.get_scheduler(use_async_http=use_async_http)
+        try:
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+            rssfeed = scheduler.yarss_config.get_config()["rssfeeds"]["0"]
+            self.assertEquals(rssfeed["etag"], '"v1"')
+            self.assertEquals(rssfeed["last_modified"], "Sat, 17 Oct 2026 10:00:00 GMT")
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+        finally:
+            scheduler.set_async_http(False)
+        self.assertEquals(len(self.feed.requests), 2)
+        self.assertEquals(self.feed.requests[1].getHeader(b"if-none-match"), b'"v1"')
+        self.assertEquals(self.feed.requests[1].getHeader(b"if-modified-since"), b"Sat, 17 Oct 2026 10:00:00 GMT")
+        self.assertEquals(self.feed.requests[1].code, 304)
+        # The update ended after the 304, so the items were not matched again
+        self.assertEquals(len(scheduler.added), 3)
+        stats = scheduler.get_stage_stats()["fetch"]
+        self.assertEquals((stats["parsed"], stats["not_modified"], stats["content_unchanged"]), (1, 1, 0))
+
+    def test_rssfeed_update_not_modified(self):
+        return self.verify_rssfeed_update_not_modified(True)
+
+    def test_rssfeed_update_not_modified_threaded(self):
+        return self.verify_rssfeed_update_not_modified(False)
+
+    @defer.inlineCallbacks
+    def verify_rssfeed_update_content_unchanged(self, use_async_http):
+        scheduler = self.get_scheduler(use_async_http=use_async_http)
+        try:
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+            self.assertTrue(scheduler.yarss_config.get_config()["rssfeeds"]["0"]["content_hash"])
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+            # A changed subscription is matched against all the items
+            scheduler.yarss_config.get_config()["rssfeeds"]["0"]["content_hash"] = ""
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+        finally:
+            scheduler.set_async_http(False)
+        self.assertEquals(len(self.feed.requests), 3)
+        self.assertEquals(len(scheduler.added), 6)
+        stats = scheduler.get_stage_stats()["fetch"]
+        self.assertEquals((stats["parsed"], stats["not_modified"], stats["content_unchanged"]), (2, 0, 1))
+
+    def test_rssfeed_update_content_unchanged(self):
+        return self.verify_rssfeed_update_content_unchanged(True)
+
+    def test_rssfeed_update_content_unchanged_threaded(self):
+        return self.verify_rssfeed_update_content_unchanged(False)
+
+    @defer.inlineCallbacks
+    def test_rssfeed_update_failed_download_is_retried(self):
+        """Tests that the RSS Feed is matched again after a torrent file failed to download,
+        and that the failed torrent URLs are skipped until the retry time"""
+        self.torrent.code = 404
+        self.torrent.content = b"Not found"
+        scheduler = self.get_scheduler()
+        clock = task.Clock()
+        scheduler.failed_downloads.clock = clock
+        try:
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+            self.assertEquals(scheduler.yarss_config.get_config()["rssfeeds"]["0"]["content_hash"], "")
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+            self.assertEquals(len(self.torrent.requests), 3)
+            clock.advance(scheduler.failed_downloads.ttl)
+            yield scheduler.queue_rssfeed_update(rssfeed_key="0")
+        finally:
+            scheduler.set_async_http(False)
+        self.assertEquals(len(self.torrent.requests), 6)
+        self.assertEquals(scheduler.get_stage_stats()["fetch"]["parsed"], 3)
+
+
+class NoVerifyPolicyForHTTPSTestCase(unittest.TestCase):
+
+    def test_sni(self):
+        from OpenSSL import SSL
+        policy = NoVerifyPolicyForHTTPS()
+        connection = policy.creatorForNetloc(b"tracker.example.com", 443).clientConnectionForTLS(None)
+        self.assertEquals(connection.get_servername(), b"tracker.example.com")
+        self.assertEquals(connection.get_context().get_verify_mode(), SSL.VERIFY_NONE)
+        # No SNI for an IP address
+        connection = policy.creatorForNetloc(b"127.0.0.1", 443).clientConnectionForTLS(None)
+        self.assertEquals(connection.get_servername(), None)
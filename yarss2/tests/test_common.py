@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import datetime
+
+from dateutil import parser as dateutil_parser
+from twisted.trial import unittest
+
+from yarss2.util import common
+
+
+class CommonTestCase(unittest.TestCase):
+
+    def test_isodate_to_datetime(self):
+        for date in ("2026-10-17T08:30:00+00:00", "2026-10-17T08:30:00.123456+02:00", "2026-10-17 08:30:00",
+                     "2026-10-17", "Sat, 17 Oct 2026 08:30:00 GMT"):
+            expected = common.datetime_add_timezone(dateutil_parser.parse(date))
+            self.assertEquals(common.isodate_to_datetime(date), expected)
+        self.assertEquals(common.isodate_to_datetime("Not a date"), common.get_default_date())
+        # Cached
+        self.assertTrue(common.isodate_to_datetime("2026-10-17") is common.isodate_to_datetime("2026-10-17"))
+
+    def test_isodate_to_datetime_cache_is_bounded(self):
+        start = datetime.datetime(2026, 1, 1)
+        for minutes in range(common.ISODATE_CACHE_SIZE + 10):
+            common.isodate_to_datetime((start + datetime.timedelta(minutes=minutes)).isoformat())
+        self.assertTrue(len(common._isodate_cache) <= common.ISODATE_CACHE_SIZE)
+
+    def test_isodate_to_epoch(self):
+        self.assertEquals(common.isodate_to_epoch("1970-01-02T00:00:00+00:00"), 86400)
+        self.assertTrue(common.isodate_to_epoch("2026-10-17T08:00:00") < common.isodate_to_epoch("2026-10-17T09:00:00"))
+        self.assertTrue(common.isodate_to_epoch("") < common.isodate_to_epoch("1900-01-01"))
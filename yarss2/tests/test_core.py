@@ -8,6 +8,7 @@
 #
 
 import twisted.internet.defer as defer
+from twisted.internet import reactor, task
 from twisted.trial import unittest
 
 import deluge.component as component
@@ -69,17 +70,19 @@ class CoreTestCase(unittest.TestCase):
 #
 #        #default_subscription = yarss2.yarss_config.get_fresh_subscription_config()
 
+    @defer.inlineCallbacks
     def test_add_torrent(self):
         torrent_name = "FreeBSD-9.0-RELEASE-amd64-dvd1.torrent"
         torrent_url = yarss2.util.common.get_resource(torrent_name, path="tests/data/")
         torrent_info = {"link": torrent_url}
-        download_dict = self.core.add_torrent(torrent_info)
+        download_dict = yield self.core.add_torrent(torrent_info)
         download = TorrentDownload(download_dict)
 
         self.assertTrue(download.success, "Download failed, but should be True")
         self.assertEquals(torrent_url, test_torrent_handling.test_component.downloads.pop().torrent_url)
         self.assertEquals(test_torrent_handling.test_component.added.pop().filename, torrent_name)
 
+    @defer.inlineCallbacks
     def test_add_torrent_default_user_agent(self):
         torrent_name = "FreeBSD-9.0-RELEASE-amd64-dvd1.torrent"
         torrent_url = yarss2.util.common.get_resource(torrent_name, path="tests/data/")
@@ -89,9 +92,10 @@ class CoreTestCase(unittest.TestCase):
         self.config.set_config(config)
         self.core.yarss_config = self.config
 
-        download_dict = self.core.add_torrent(torrent_info)
+        download_dict = yield self.core.add_torrent(torrent_info)
         self.assertEquals(download_dict["headers"]["User-Agent"], default_user_agent)
 
+    @defer.inlineCallbacks
     def test_add_torrent_custom_user_agent(self):
         torrent_name = "FreeBSD-9.0-RELEASE-amd64-dvd1.torrent"
         torrent_url = yarss2.util.common.get_resource(torrent_name, path="tests/data/")
@@ -102,7 +106,7 @@ class CoreTestCase(unittest.TestCase):
         self.config.set_config(config)
         self.core.yarss_config = self.config
 
-        download_dict = self.core.add_torrent(torrent_info)
+        download_dict = yield self.core.add_torrent(torrent_info)
         self.assertEquals(download_dict["headers"]["User-Agent"], custom_user_agent)
 
     def test_initiate_rssfeed_update(self):
@@ -130,6 +134,41 @@ class CoreTestCase(unittest.TestCase):
         d.addCallback(callback_check)
         return d
 
+    def test_save_resets_change_detection(self):
+        """Tests that the next update fetches the whole RSS Feed when a subscription
+        or the URL of the RSS Feed is changed"""
+        config = test_common.get_test_config_dict()
+        config["rssfeeds"]["0"]["etag"] = '"v1"'
+        config["rssfeeds"]["0"]["last_modified"] = "Sat, 17 Oct 2026 10:00:00 GMT"
+        config["rssfeeds"]["0"]["content_hash"] = "3c7a8b"
+        self.config.set_config(config)
+        self.core.yarss_config = self.config
+        rssfeed = self.config.get_config()["rssfeeds"]["0"]
+
+        # Saved unchanged
+        self.core.save_rssfeed(rssfeed_data=dict(rssfeed))
+        self.assertEquals(self.config.get_config()["rssfeeds"]["0"]["etag"], '"v1"')
+
+        self.core.save_subscription(subscription_data=dict(config["subscriptions"]["0"]))
+        rssfeed = self.config.get_config()["rssfeeds"]["0"]
+        self.assertEquals((rssfeed["etag"], rssfeed["last_modified"], rssfeed["content_hash"]), ("", "", ""))
+
+        rssfeed["etag"] = '"v1"'
+        self.core.save_rssfeed(rssfeed_data=dict(rssfeed, url="http://example.com/other.rss"))
+        self.assertEquals(self.config.get_config()["rssfeeds"]["0"]["etag"], "")
+
+    def test_save_cookie_rebuilds_cookie_index(self):
+        self.core.yarss_config = self.config
+        cookie = yarss2.yarss_config.get_fresh_cookie_config()
+        cookie["site"] = "basename.com"
+        cookie["value"] = {"uid": "1"}
+        self.core.save_cookie(cookie_data=cookie)
+        index = self.config.get_cookie_index()
+        self.assertTrue(self.config.get_cookie_index() is index)
+        self.assertEquals(index.get_cookies("http://basename.com/1.torrent")[0], {"uid": "1"})
+        self.core.save_cookie(dict_key=cookie["key"], delete=True)
+        self.assertEquals(self.config.get_cookie_index().get_cookies("http://basename.com/1.torrent")[0], {})
+
 
 class DelugeRPCProtocolTransferTester(DelugeTransferProtocol):
 
@@ -193,6 +232,8 @@ class RPCServerTestCase(BaseTestCase, TestCaseDebug):
         def on_shutdown(result):
             del self.rpcserver
 
+        # Stops the timers of the scheduler
+        self.core.disable()
         return component.shutdown().addCallback(on_shutdown)
 
     def test_core_get_completion_paths(self):
@@ -228,6 +269,7 @@ class RPCServerTestCase(BaseTestCase, TestCaseDebug):
         })
         self.assertEqual(expected_result, msg_received[2])
 
+    @defer.inlineCallbacks
     def test_core_get_rssfeed_parsed(self):
         method = "core.get_rssfeed_parsed"
         args = []
@@ -250,8 +292,10 @@ class RPCServerTestCase(BaseTestCase, TestCaseDebug):
         }
         args.append(rssfeed_data)
 
-        # Makes a call to core.get_rssfeed_parsed
+        # Makes a call to core.get_rssfeed_parsed, which answers when the RSS Feed is parsed
         self.protocol.dispatch(self.request_id, method, args, {})
+        while not self.protocol.transport.messages_written:
+            yield task.deferLater(reactor, 0.01, lambda: None)
 
         msg_bytes = self.protocol.transport.messages_written[0]
 
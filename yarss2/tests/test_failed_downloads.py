@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from yarss2.util.failed_downloads import FailedDownloads
+
+
+class FailedDownloadsTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.clock = task.Clock()
+        self.failed = FailedDownloads(ttl=60, max_retries=3, clock=self.clock)
+        self.url = "http://example.com/1.torrent"
+
+    def test_skipped_until_ttl(self):
+        self.assertEquals(self.failed.get_skip_reason(self.url), None)
+        self.assertFalse(self.failed.record_failure(self.url, "404 Not Found"))
+        self.assertTrue("404 Not Found" in self.failed.get_skip_reason(self.url))
+        self.clock.advance(60)
+        self.assertEquals(self.failed.get_skip_reason(self.url), None)
+        self.failed.record_failure(self.url, "404 Not Found")
+        self.failed.record_success(self.url)
+        self.assertEquals(self.failed.get_skip_reason(self.url), None)
+        self.assertEquals(self.failed.get_urls(), {})
+
+    def test_given_up_after_max_retries(self):
+        self.failed.record_failure(self.url, "error")
+        self.failed.record_failure(self.url, "error")
+        self.assertTrue(self.failed.record_failure(self.url, "error"))
+        self.clock.advance(600)
+        self.assertTrue(self.failed.is_given_up(self.url))
+        self.assertTrue(self.failed.get_skip_reason(self.url).startswith("Failed 3 times, not retried"))
+        # Always retried when max_retries is 0
+        self.failed.set_limits(60, 0)
+        self.assertFalse(self.failed.is_given_up(self.url))
+        self.assertEquals(self.failed.get_skip_reason(self.url), None)
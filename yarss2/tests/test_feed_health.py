@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import time
+
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from yarss2.util.feed_health import BACKOFF_BASE, BACKOFF_MAX, FeedHealth
+from yarss2.util.feedparsing.http import _parse_retry_after
+
+
+class FeedHealthTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.clock = Clock()
+        self.health = FeedHealth(clock=self.clock)
+
+    def test_closed_by_default(self):
+        self.assertTrue(self.health.allow_update("0"))
+        self.assertEquals(self.health.get_state("0")["state"], "closed")
+        self.assertEquals(self.health.get_states(), {})
+
+    def test_exponential_backoff(self):
+        self.assertEquals(self.health.record_failure("0", "error"), BACKOFF_BASE)
+        self.assertFalse(self.health.allow_update("0"))
+        self.assertTrue(self.health.allow_update("1"))
+        self.clock.advance(BACKOFF_BASE)
+        self.assertTrue(self.health.allow_update("0"))
+        self.assertEquals(self.health.get_state("0")["state"], "half-open")
+
+        # The update let through when half-open failed
+        self.assertEquals(self.health.record_failure("0", "error"), 2 * BACKOFF_BASE)
+        self.assertEquals(self.health.get_state("0"), {"state": "open", "failures": 2,
+                                                       "retry_in": 2 * BACKOFF_BASE, "last_error": "error"})
+        for i in range(100):
+            self.health.record_failure("0", "error")
+        self.assertEquals(self.health.get_state("0")["retry_in"], BACKOFF_MAX)
+
+        self.health.record_success("0")
+        self.assertTrue(self.health.allow_update("0"))
+        self.assertEquals(self.health.get_state("0")["failures"], 0)
+
+    def test_retry_after(self):
+        self.assertEquals(self.health.record_failure("0", "error", retry_after=3 * BACKOFF_BASE), 3 * BACKOFF_BASE)
+        # A shorter Retry-After does not reduce the backoff
+        self.assertEquals(self.health.record_failure("0", "error", retry_after=1), 2 * BACKOFF_BASE)
+        self.assertEquals(self.health.record_failure("1", "error", retry_after=10 * BACKOFF_MAX), BACKOFF_MAX)
+
+    def test_gone_count(self):
+        self.health.record_failure("0", "HTTP status 410", gone=True)
+        self.health.record_failure("0", "HTTP status 410", gone=True)
+        self.assertEquals(self.health.get_gone_count("0"), 2)
+        self.health.record_failure("0", "HTTP status 500")
+        self.assertEquals(self.health.get_gone_count("0"), 0)
+        self.health.record_failure("0", "HTTP status 410", gone=True)
+        self.health.record_success("0")
+        self.assertEquals(self.health.get_gone_count("0"), 0)
+
+    def test_gone_time(self):
+        self.assertEquals(self.health.get_gone_time("0"), 0)
+        self.assertEquals(self.health.get_last_failure_time("0"), None)
+        self.health.record_failure("0", "HTTP status 410", gone=True)
+        self.clock.advance(100)
+        self.health.record_failure("0", "HTTP status 410", gone=True)
+        self.assertEquals(self.health.get_last_failure_time("0"), 100)
+        self.clock.advance(50)
+        self.assertEquals(self.health.get_gone_time("0"), 150)
+        self.health.record_failure("0", "HTTP status 500")
+        self.assertEquals(self.health.get_gone_time("0"), 0)
+        self.health.record_failure("0", "HTTP status 410", gone=True)
+        self.clock.advance(10)
+        self.assertEquals(self.health.get_gone_time("0"), 10)
+
+    def test_record_redirect(self):
+        self.assertEquals(self.health.record_redirect("0", "http://a.com/feed"), 1)
+        self.assertEquals(self.health.record_redirect("0", "http://a.com/feed"), 2)
+        self.assertEquals(self.health.record_redirect("0", "http://b.com/feed"), 1)
+        self.assertEquals(self.health.record_redirect("0", None), 0)
+        self.assertEquals(self.health.record_redirect("0", "http://b.com/feed"), 1)
+
+    def test_parse_retry_after(self):
+        self.assertEquals(_parse_retry_after("120"), 120)
+        self.assertEquals(_parse_retry_after(b" 5 "), 5)
+        self.assertEquals(_parse_retry_after("Invalid"), None)
+        self.assertEquals(_parse_retry_after("Wed, 21 Oct 2015 07:28:00 GMT"), 0)
+        future = time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(time.time() + 3600))
+        self.assertTrue(3590 <= _parse_retry_after(future) <= 3600)
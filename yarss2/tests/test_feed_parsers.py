@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from twisted.trial import unittest
+
+import yarss2.util.common
+from yarss2 import rssfeed_handling
+from yarss2.util import feed_parsers, logging
+
+from .utils.log_utils import plugin_tests_logger_name
+
+log = logging.getLogger(plugin_tests_logger_name)
+
+
+def read_feed(name):
+    filename = yarss2.util.common.get_resource(name, path="tests/data/feeds/")
+    return yarss2.util.common.read_file(filename)
+
+
+class MissingParserBackend(feed_parsers.StreamParserBackend):
+    name = "missing"
+    requires = ("yarss2.no_such_module",)
+
+
+class FeedParsersTestCase(unittest.TestCase):
+
+    def test_get_backend(self):
+        auto = feed_parsers.get_backend()
+        self.assertEquals(auto.name, "lxml" if feed_parsers.get_backend("lxml").name == "lxml" else "atoma")
+        self.assertEquals(feed_parsers.get_backend("atoma").name, "atoma")
+        self.assertTrue(feed_parsers.get_backend("unknown") is auto)
+        self.assertTrue("atoma" in feed_parsers.get_available_backends())
+
+    def test_backend_not_available(self):
+        feed_parsers.register_backend(MissingParserBackend())
+        self.addCleanup(feed_parsers._backends.pop, "missing")
+        self.assertFalse("missing" in feed_parsers.get_available_backends())
+        self.assertEquals(feed_parsers.get_backend("missing").name, feed_parsers.get_backend().name)
+
+    def test_backends_same_result(self):
+        data = read_feed("ezrss-rss-2.xml")
+        expected = feed_parsers.get_backend("atoma").parse(data)
+        self.assertEquals(len(expected["items"]), 2)
+        for name in feed_parsers.get_available_backends():
+            if isinstance(feed_parsers.get_backend(name), feed_parsers.StreamParserBackend):
+                self.assertEquals(feed_parsers.get_backend(name).parse(data), expected)
+
+    def test_lxml_entities_forbidden(self):
+        if "lxml" not in feed_parsers.get_available_backends():
+            raise unittest.SkipTest("lxml is not installed")
+        from atoma import FeedXMLError
+        data = (b'<?xml version="1.0"?><!DOCTYPE rss [<!ENTITY a "aaaaaaaaaa">]>'
+                b'<rss version="2.0"><channel><item><title>&a;</title></item></channel></rss>')
+        self.assertRaises(FeedXMLError, feed_parsers.get_backend("lxml").parse, data)
+
+    def test_rssfeed_parser(self):
+        handler = rssfeed_handling.RSSFeedHandler(log)
+        rssfeed_data = {"name": "Test", "url": "http://example.com/rss", "prefer_magnet": False, "parser": "atoma"}
+        download = {"status": 200, "content": read_feed("ezrss-rss-2.xml")}
+        parsed_feed = handler.get_rssfeed_parsed(rssfeed_data, download=download)
+        self.assertEquals(parsed_feed["raw_result"]["parser"], "atoma")
+        self.assertEquals(len(parsed_feed["items"]), 2)
+        # The infohash given by the RSS Feed, which finds the torrent file in the cache
+        self.assertEquals(parsed_feed["items"][0]["infohash"], "4cf874831f61f5db9c3299e503e28a8103047ba0")
+        handler.parser = "atoma"
+        rssfeed_data["parser"] = ""
+        self.assertEquals(handler.get_parser(rssfeed_data), "atoma")
+
+    def test_parse_is_abstract(self):
+        class IncompleteBackend(feed_parsers.ParserBackend):
+            name = "incomplete"
+        self.assertRaises(TypeError, IncompleteBackend)
+
+    def test_benchmark(self):
+        results = feed_parsers.benchmark(read_feed("ezrss-rss-2.xml"), names=["atoma"], number=1)
+        self.assertEquals(len(results), 1)
+        name, seconds, items = results[0]
+        self.assertEquals((name, items), ("atoma", 2))
+        self.assertTrue(seconds > 0)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from twisted.trial import unittest
+
+import yarss2.util.common
+from yarss2 import rssfeed_handling
+from yarss2.util import common, logging
+from yarss2.util.feed_stream import atoma_result_to_dict, parse_rss_stream
+
+from . import common as test_common
+from .utils.log_utils import plugin_tests_logger_name
+
+log = logging.getLogger(plugin_tests_logger_name)
+
+
+def get_rss_bytes(hours):
+    items = "".join("<item><title>Item %d</title><link>http://example.com/%d.torrent</link>"
+                    "<pubDate>Sat, 17 Oct 2026 %02d:00:00 GMT</pubDate></item>" % (i, i, hour)
+                    for i, hour in enumerate(hours))
+    return ("<?xml version='1.0'?><rss version='2.0'><channel><title>Test</title>%s<ttl>30</ttl>"
+            "</channel></rss>" % items).encode("utf-8")
+
+
+class FeedStreamTestCase(unittest.TestCase):
+
+    def test_same_result_as_atoma(self):
+        import atoma
+        filename = yarss2.util.common.get_resource("t1.rss", path="tests/data/feeds/")
+        data = yarss2.util.common.read_file(filename)
+        atoma.rss.supported_rss_versions = []
+        self.assertEquals(atoma_result_to_dict(parse_rss_stream(data, full_items=True)),
+                          atoma_result_to_dict(atoma.parse_rss_bytes(data)))
+
+    def test_extracted_items(self):
+        for name in ("t1.rss", "ezrss-rss-2.xml"):
+            filename = yarss2.util.common.get_resource(name, path="tests/data/feeds/")
+            data = yarss2.util.common.read_file(filename)
+            items = atoma_result_to_dict(parse_rss_stream(data))["items"]
+            full_items = atoma_result_to_dict(parse_rss_stream(data, full_items=True))["items"]
+            self.assertEquals(len(items), len(full_items))
+            for item, full_item in zip(items, full_items):
+                self.assertEquals(item, dict((key, full_item.get(key)) for key in item))
+
+    def test_not_rss(self):
+        from atoma import FeedParseError, FeedXMLError
+        self.assertRaises(FeedXMLError, parse_rss_stream, b"<html><body>Too many requests")
+        self.assertRaises(FeedParseError, parse_rss_stream, b"<html><body>Too many requests</body></html>")
+
+    def test_watermark(self):
+        watermark = common.isodate_to_datetime("2026-10-17T08:00:00+00:00")
+        result = {"status": 200, "content": get_rss_bytes([12, 10, 8, 6, 4])}
+        parsed = rssfeed_handling.parse_rssfeed(result)
+        self.assertEquals(len(parsed["items"]), 5)
+        self.assertEquals(parsed["feed"]["ttl"], 30)
+        self.assertFalse("stopped_at_watermark" in parsed)
+        parsed = rssfeed_handling.parse_rssfeed(result, watermark=watermark)
+        self.assertEquals([item["title"] for item in parsed["items"]], ["Item 0", "Item 1", "Item 2"])
+        self.assertTrue(parsed["stopped_at_watermark"])
+        # The ttl after the items is still read
+        self.assertEquals(parsed["feed"]["ttl"], 30)
+        # The dates of the older items are still read for the adaptive update interval
+        self.assertEquals([common.isodate_to_datetime(date).hour for date in parsed["published_dates"]],
+                          [12, 10, 8, 6, 4])
+        # Not ordered newest first, so all the items are parsed
+        result = {"status": 200, "content": get_rss_bytes([10, 12, 6, 4])}
+        parsed = rssfeed_handling.parse_rssfeed(result, watermark=watermark)
+        self.assertEquals(len(parsed["items"]), 4)
+
+    def test_watermark_time_zone(self):
+        # last_match is stored with the time zone of the item replaced by UTC
+        watermark = common.isodate_to_datetime("2026-10-17T12:00:00+01:00")
+        items = "".join("<item><title>Item %d</title><link>http://example.com/%d.torrent</link>"
+                        "<pubDate>Sat, 17 Oct 2026 %s +0100</pubDate></item>" % (i, i, time)
+                        for i, time in enumerate(["12:30:00", "12:00:00", "11:00:00"]))
+        data = ("<?xml version='1.0'?><rss version='2.0'><channel><title>Test</title>%s</channel></rss>"
+                % items).encode("utf-8")
+        parsed = rssfeed_handling.parse_rssfeed({"status": 200, "content": data}, watermark=watermark)
+        self.assertEquals([item["title"] for item in parsed["items"]], ["Item 0", "Item 1"])
+
+    def test_watermark_only_for_scheduled_updates(self):
+        handler = rssfeed_handling.RSSFeedHandler(log)
+        watermarks = []
+
+        def get_rssfeed_parsed(rssfeed_data, watermark=None, **kwargs):
+            watermarks.append(watermark)
+
+        handler.get_rssfeed_parsed = get_rssfeed_parsed
+        subscriptions = [{"last_match": "2026-10-17T08:00:00+00:00", "ignore_timestamp": False}]
+        for conditional in (True, False):
+            fetch_data = {"site_cookies_dict": None, "user_agent": None, "deadline": common.Deadline(),
+                          "subscriptions": subscriptions, "conditional": conditional}
+            handler.fetch_rssfeed_items({}, fetch_data)
+        self.assertEquals(watermarks, [common.isodate_to_datetime("2026-10-17T08:00:00+00:00"), None])
+
+    def test_ttl_with_watermark(self):
+        """Tests that an update where the parsing stops at the watermark without new items
+        is successful, and that the ttl after the items is obeyed"""
+        handler = rssfeed_handling.RSSFeedHandler(log)
+        rssfeed_data = test_common.get_default_rssfeeds(1)["0"]
+        rssfeed_data.update({"obey_ttl": True, "update_interval": 60})
+        subscriptions = [{"last_match": "2026-10-17T08:00:00+00:00", "ignore_timestamp": False}]
+        fetch_data = {"site_cookies_dict": None, "user_agent": None, "deadline": common.Deadline(),
+                      "subscriptions": subscriptions, "conditional": True,
+                      "download": {"status": 200, "content": get_rss_bytes([6, 4])}}
+        handler.fetch_rssfeed_items(rssfeed_data, fetch_data)
+        self.assertEquals(fetch_data["rssfeed_items"], {})
+        self.assertEquals(fetch_data["ttl"], 30)
+        self.assertTrue(rssfeed_data["obey_ttl"])
+
+    def test_get_watermark(self):
+        handler = rssfeed_handling.RSSFeedHandler(log)
+        subscriptions = [{"last_match": "2026-10-17T08:00:00+00:00", "ignore_timestamp": False},
+                         {"last_match": "2026-10-16T08:00:00+00:00", "ignore_timestamp": False}]
+        self.assertEquals(handler.get_watermark(subscriptions),
+                          common.isodate_to_datetime("2026-10-16T08:00:00+00:00"))
+        subscriptions[0]["ignore_timestamp"] = True
+        self.assertEquals(handler.get_watermark(subscriptions), None)
+        subscriptions[0].update({"last_match": "", "ignore_timestamp": False})
+        self.assertEquals(handler.get_watermark(subscriptions), None)
+        self.assertEquals(handler.get_watermark([]), None)
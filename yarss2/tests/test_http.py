@@ -7,6 +7,9 @@
 # See LICENSE for more details.
 #
 
+import socket
+
+from twisted.internet.error import DNSLookupError
 from twisted.trial import unittest
 
 import yarss2.yarss_config
@@ -27,6 +30,17 @@ class HTTPTestCase(unittest.TestCase):
         encoded = http.encode_cookie_values(cookie_pairs)
         self.assertEquals(sorted(encoded.split("; ")), expected)
 
+    def test_get_cache_lifetime(self):
+        self.assertEquals(http.get_cache_lifetime({}), None)
+        self.assertEquals(http.get_cache_lifetime({"cache-control": "public, max-age=600"}), 600)
+        self.assertEquals(http.get_cache_lifetime({"cache-control": "no-cache"}), 0)
+        expires = "Thu, 01 Jan 1970 01:00:00 GMT"
+        self.assertEquals(http.get_cache_lifetime({"expires": expires}, now=1800), 1800)
+        self.assertEquals(http.get_cache_lifetime({"expires": expires}, now=7200), 0)
+        self.assertEquals(http.get_cache_lifetime({"expires": "0"}), 0)
+        # max-age takes precedence over Expires
+        self.assertEquals(http.get_cache_lifetime({"cache-control": "max-age=60", "expires": expires}, now=0), 60)
+
     def test_get_cookie_header(self):
         url = "http://basename.com/øashdnf/klasflas/dfnmalskdfn/malskdfnmasloal"
         cookies = {}
@@ -58,6 +72,38 @@ class HTTPTestCase(unittest.TestCase):
         self.assertEquals(matching_cookies["key2"], cookies["0"]["value"]["key2"])
         self.assertFalse("key3" in matching_cookies)
 
+    def get_cookies(self):
+        cookies = {}
+        for key, site, value in [("0", "basename.com", {"key1": "value1", "key2": "value2"}),
+                                 ("1", "tracker.basename.com", {"key2": "tracker"}),
+                                 ("2", "non-matching-basename.com", {"key3": "value3"}),
+                                 ("3", "basename", {"key4": "value4"}),
+                                 ("4", "basename.com", {"key5": "value5"})]:
+            cookies[key] = yarss2.yarss_config.get_fresh_cookie_config()
+            cookies[key]["site"] = site
+            cookies[key]["value"] = value
+        cookies["4"]["active"] = False
+        return cookies
+
+    def test_cookie_index(self):
+        index = http.CookieIndex(self.get_cookies())
+        cookies, header = index.get_cookies("https://tracker.basename.com/rss?passkey=1")
+        self.assertEquals(cookies, {"key1": "value1", "key2": "tracker", "key4": "value4"})
+        self.assertEquals(header, {"Cookie": "key1=value1; key2=tracker; key4=value4"})
+        cookies, header = index.get_cookies("basename.com")
+        self.assertEquals(cookies, {"key1": "value1", "key2": "value2", "key4": "value4"})
+        # Not a subdomain of basename.com
+        cookies, header = index.get_cookies("http://non-matching-basename.com/basename.com")
+        self.assertEquals(cookies, {"key3": "value3", "key4": "value4"})
+        self.assertEquals(index.get_cookies("http://example.com"), ({}, {}))
+
+    def test_cookie_index_substring_match(self):
+        cookies = self.get_cookies()
+        index = http.CookieIndex(cookies, substring_match=True)
+        url = "http://non-matching-basename.com/basename.com"
+        self.assertEquals(index.get_cookies(url)[0], http.get_matching_cookies_dict(cookies, url))
+        self.assertEquals(index.get_cookies(url)[1], http.get_cookie_header(cookies, url))
+
     def test_url_fix(self):
         url = u"http://de.wikipedia.org/wiki/Elf (Begriffsklärung)"
         expected = "http://de.wikipedia.org/wiki/Elf%20(Begriffskl%C3%A4rung)"
@@ -107,6 +153,25 @@ class HTTPTestCase(unittest.TestCase):
  </html>"""
         http.clean_html_body(web_page)
 
+    def test_summarize_html_body(self):
+        web_page = (b"<html><head><title>Just a moment...</title><style>p { color: red }</style>"
+                    b"<script>var a = '<p>b</p>';</script></head><body><p>\n  Checking your\n  browser"
+                    b" </p><noscript>Enable JavaScript</noscript>" + b"<p>filler</p>" * 100000 + b"</body></html>")
+        summary = http.summarize_html_body(web_page)
+        self.assertEquals(summary.split("\n")[:4], ["Just a moment...", "Checking your browser",
+                                                    "Enable JavaScript", "filler"])
+        self.assertEquals(len(summary), http.ERROR_PAGE_MAX_CHARS)
+        self.assertEquals(http.summarize_html_body(web_page, max_bytes=60), "Just a moment...")
+
+    def test_parse_error_page(self):
+        from yarss2 import rssfeed_handling
+        filename = common.get_resource("rarbg.to.rss.too_many_requests.html", path="tests/data/feeds/")
+        result = {"status": 200, "content": common.read_file(filename)}
+        parsed_feed = rssfeed_handling.parse_rssfeed(result)
+        self.assertEquals(parsed_feed["bozo"], 1)
+        self.assertTrue(parsed_feed["raw_result"].startswith("We have too many requests from your ip"))
+        self.assertTrue("You are using a VPN that is abused on our site" in parsed_feed["raw_result"])
+
     def test_atoma_parsing(self):
         import atoma
         atoma.rss.supported_rss_versions = []
@@ -117,3 +182,15 @@ class HTTPTestCase(unittest.TestCase):
         self.assertEquals('The top100 torrents', parsed_feeds.description)
         self.assertEquals('https://therss.so', parsed_feeds.link)
         self.assertEquals(None, parsed_feeds.ttl)
+
+    def test_is_host_not_found_error(self):
+        not_found = socket.gaierror(socket.EAI_NONAME, "Name or service not known")
+        self.assertTrue(http.is_host_not_found_error(not_found))
+        # Temporary failure in name resolution
+        self.assertFalse(http.is_host_not_found_error(socket.gaierror(socket.EAI_AGAIN, "Temporary failure")))
+        self.assertTrue(http.is_host_not_found_error(DNSLookupError("example.invalid")))
+        self.assertFalse(http.is_host_not_found_error(socket.error("Connection refused")))
+        # The cause of the error
+        error = IOError("Failed to open")
+        error.__cause__ = not_found
+        self.assertTrue(http.is_host_not_found_error(error))
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from twisted.internet import defer, reactor, task, threads
+from twisted.trial import unittest
+from twisted.web import resource, server
+
+from yarss2.error import DownloadRejectedError, FeedUpdateDeadlineError
+from yarss2.util import common, http
+from yarss2.util.http_sessions import SessionPool
+
+from .test_async_http import ChunkedResource, RecordingSite, StaticResource
+
+
+class TricklingResource(resource.Resource):
+    """Sends a chunk every interval seconds until the client closes the connection"""
+    isLeaf = True
+
+    def __init__(self, chunk, interval):
+        resource.Resource.__init__(self)
+        self.chunk = chunk
+        self.interval = interval
+        self.loops = []
+
+    def render_GET(self, request):  # NOQA
+        loop = task.LoopingCall(request.write, self.chunk)
+        self.loops.append(loop)
+        loop.start(self.interval)
+        request.notifyFinish().addBoth(lambda result: loop.stop())
+        return server.NOT_DONE_YET
+
+
+class FakeSession(object):
+
+    def __init__(self):
+        self.closed = False
+        self.urls = []
+
+    def request(self, method, url, **kwargs):
+        self.urls.append(url)
+        return url
+
+    def close(self):
+        self.closed = True
+
+
+class FakeSessionPool(SessionPool):
+
+    def _create_session(self):
+        self.created_count += 1
+        return FakeSession()
+
+
+class SessionPoolTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.now = 0
+        self.pool = FakeSessionPool(max_sessions=2, idle_timeout=60, clock=lambda: self.now)
+
+    def get_session(self, scheme, host):
+        return self.pool._sessions[(scheme, host)]["session"]
+
+    def test_session_per_host(self):
+        self.pool.get("http://example.com/feed")
+        self.pool.get("http://EXAMPLE.com/1.torrent")
+        self.pool.get("https://example.com/feed")
+        self.assertEquals(self.pool.created_count, 2)
+        self.assertEquals(self.get_session("http", "example.com").urls,
+                          ["http://example.com/feed", "http://EXAMPLE.com/1.torrent"])
+
+    def test_least_recently_used_is_evicted(self):
+        self.pool.get("http://a.com/")
+        self.pool.get("http://b.com/")
+        session_a = self.get_session("http", "a.com")
+        self.pool.get("http://a.com/")
+        self.pool.get("http://c.com/")
+        self.assertEquals(sorted(host for scheme, host in self.pool._sessions), ["a.com", "c.com"])
+        self.assertFalse(session_a.closed)
+        self.assertEquals(self.pool.get_stats()["evicted"], 1)
+
+    def test_session_in_use_is_not_evicted(self):
+        entry = self.pool._acquire(("http", "a.com"))
+        self.pool.get("http://b.com/")
+        self.pool.get("http://c.com/")
+        self.assertEquals(sorted(host for scheme, host in self.pool._sessions), ["a.com", "c.com"])
+        self.assertEquals(self.pool.get_stats()["in_use"], 1)
+        self.pool._release(entry)
+        self.pool.close()
+        self.assertTrue(entry["session"].closed)
+        self.assertEquals(self.pool.get_stats()["sessions"], 0)
+
+    def test_idle_session_is_evicted(self):
+        self.pool.get("http://a.com/")
+        session = self.get_session("http", "a.com")
+        self.now = 59
+        self.pool.evict_idle()
+        self.assertFalse(session.closed)
+        self.now = 60
+        self.pool.get("http://b.com/")
+        self.assertTrue(session.closed)
+        self.assertEquals(list(self.pool._sessions), [("http", "b.com")])
+
+
+class SessionPoolRequestsTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.root = resource.Resource()
+        self.site = RecordingSite(self.root)
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.base_url = "http://127.0.0.1:%d" % self.port.getHost().port
+        self.feed = StaticResource(b"<rss version='2.0'><channel><title>Test</title></channel></rss>",
+                                   content_type=b"application/rss+xml",
+                                   headers={b"Set-Cookie": b"session=1; Path=/"})
+        self.root.putChild(b"feed", self.feed)
+        self.root.putChild(b"chunked", ChunkedResource(b"x" * 1000, 10))
+        self.root.putChild(b"video", StaticResource(b"Video", content_type=b"video/mp4"))
+        self.trickling = TricklingResource(b"x" * 10, 0.05)
+        self.root.putChild(b"trickling", self.trickling)
+        self.pool = SessionPool()
+
+    @defer.inlineCallbacks
+    def tearDown(self):  # NOQA
+        self.pool.close()
+        yield self.port.stopListening()
+        yield defer.DeferredList(self.site.connections_lost)
+
+    @defer.inlineCallbacks
+    def test_requests_reuse_connection(self):
+        yield threads.deferToThread(self.pool.get, self.base_url + "/feed")
+        result = yield threads.deferToThread(http.download_file, self.base_url + "/feed",
+                                             site_cookies_dict={"uid": "18463"}, session_pool=self.pool)
+        self.assertEquals(result["status"], 200)
+        self.assertTrue(b"<title>Test</title>" in result["content"])
+        self.assertEquals(len(self.site.connections_lost), 1)
+        # The cookie set by the server is not sent with the next request
+        self.assertEquals(self.feed.requests[0].getHeader(b"cookie"), None)
+        self.assertEquals(self.feed.requests[1].getHeader(b"cookie"), b"uid=18463")
+
+    @defer.inlineCallbacks
+    def test_get_content_max_size(self):
+        response, content = yield threads.deferToThread(self.pool.get_content, self.base_url + "/chunked",
+                                                        max_size=10000)
+        self.assertEquals(len(content), 10000)
+        d = threads.deferToThread(self.pool.get_content, self.base_url + "/chunked", max_size=9999)
+        yield self.assertFailure(d, DownloadRejectedError)
+        # Rejected from the Content-Length
+        d = threads.deferToThread(http.download_file, self.base_url + "/feed", session_pool=self.pool, max_size=10)
+        yield self.assertFailure(d, DownloadRejectedError)
+        self.assertEquals(len(self.feed.requests), 1)
+
+    @defer.inlineCallbacks
+    def test_get_content_deadline(self):
+        """Tests that the reading of a slow response stops when the deadline has passed"""
+        d = threads.deferToThread(self.pool.get_content, self.base_url + "/trickling",
+                                  deadline=common.Deadline(0.3), timeout=5)
+        yield self.assertFailure(d, FeedUpdateDeadlineError)
+        # The response was closed, so the server stops sending
+        yield defer.DeferredList(self.site.connections_lost)
+        self.assertFalse(self.trickling.loops[0].running)
+
+    def test_download_file_rejected_type(self):
+        d = threads.deferToThread(http.download_file, self.base_url + "/video", session_pool=self.pool)
+        return self.assertFailure(d, DownloadRejectedError)
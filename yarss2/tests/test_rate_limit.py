@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+from twisted.internet import task
+from twisted.trial import unittest
+
+from yarss2.util.rate_limit import SiteRateLimiter
+
+from .test_http_sessions import FakeSessionPool
+
+
+class SiteRateLimiterTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.now = 0
+        self.sleeps = []
+        self.limiter = SiteRateLimiter(rate=2, burst=2, clock=lambda: self.now, sleep=self.sleeps.append)
+
+    def test_burst_then_rate(self):
+        delays = [self.limiter.reserve("http://example.com/%d.torrent" % i) for i in range(4)]
+        self.assertEquals(delays, [0, 0, 0.5, 1.0])
+        # Another site has its own bucket
+        self.assertEquals(self.limiter.reserve("http://other.com/"), 0)
+        self.now = 1.5
+        # The waiting requests have used the tokens added since
+        self.assertEquals(self.limiter.reserve("http://EXAMPLE.com/"), 0)
+        self.assertEquals(self.limiter.reserve("http://example.com/"), 0.5)
+        self.assertEquals(self.limiter.get_stats()["throttled"], 3)
+
+    def test_site_limits(self):
+        self.limiter.set_limits(0, 1, {"tracker.org": (1, 1)})
+        self.assertEquals(self.limiter.reserve("http://example.com/"), 0)
+        self.assertEquals(self.limiter.reserve("http://example.com/"), 0)
+        self.assertEquals(self.limiter.reserve("https://www.tracker.org/1"), 0)
+        self.assertEquals(self.limiter.reserve("https://www.tracker.org/2"), 1)
+        # The hosts of the domain share its bucket
+        self.assertEquals(self.limiter.reserve("https://dl.tracker.org/3"), 2)
+        self.assertEquals(self.limiter.get_stats()["sites"], 1)
+
+    def test_session_pool_waits(self):
+        pool = FakeSessionPool(rate_limiter=self.limiter)
+        for i in range(3):
+            pool.get("http://example.com/%d" % i)
+        self.assertEquals(self.sleeps, [0.5])
+
+    def test_wait_async(self):
+        clock = task.Clock()
+        self.limiter.set_limits(1, 1)
+        self.assertTrue(self.limiter.wait_async("http://example.com/", clock).called)
+        d = self.limiter.wait_async("http://example.com/", clock)
+        self.assertFalse(d.called)
+        clock.advance(1)
+        self.assertTrue(d.called)
@@ -7,15 +7,24 @@
 # See LICENSE for more details.
 #
 
+import datetime
 import threading
+import time
 
-from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.python import threadable
 from twisted.trial import unittest
 
 import yarss2.util.common
 import yarss2.yarss_config
-from yarss2.rssfeed_scheduler import RSSFeedRunQueue, RSSFeedScheduler
-from yarss2.util import logging
+from yarss2.error import FeedHostNotFoundError, FeedUpdateDeadlineError, FetchAndFeedparsingError
+from yarss2.rssfeed_handling import reset_change_detection
+from yarss2.rssfeed_scheduler import (PRIORITY_MANUAL, PRIORITY_NORMAL, TIMER_JITTER_FRACTION, TIMER_JITTER_MAX,
+                                      RSSFeedRunQueue, RSSFeedScheduler)
+from yarss2.util import http_sessions, logging
+from yarss2.util.common import TorrentDownload
+from yarss2.util.feed_health import BACKOFF_BASE
 
 from . import common as test_common
 from .test_torrent_handling import TestComponent
@@ -38,34 +47,50 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
         self.config.set_config({"rssfeeds": self.rssfeeds,
                                 "email_configurations": {"send_email_on_torrent_events": False}})
 
-        self.scheduler = RSSFeedScheduler(self.config, log)
-        test_component = TestComponent()
-        self.scheduler.torrent_handler.download_torrent_file = test_component.download_torrent_file
+        self.clock = Clock()
+        self.main_thread_calls = []
+        self.scheduler = RSSFeedScheduler(self.config, log, clock=self.clock,
+                                          main_thread_caller=self.call_in_main_thread)
+        self.test_component = TestComponent()
+        self.scheduler.torrent_handler.download_torrent_file = self.test_component.download_torrent_file
         self.scheduler.enable_timers()
 
+    def call_in_main_thread(self, f, *args):
+        """The updates run in the test thread, so the calls to the main thread are run directly"""
+        self.main_thread_calls.append((f, args))
+        f(*args)
+
     def tearDown(self):  # NOQA
-        # Must stop loopingcalls or test fails
         self.scheduler.disable_timers()
 
     def test_enable_timers(self):
         # Now verify the timers
         for key in self.scheduler.rssfeed_timers.keys():
-            # Is the timer running?
-            self.assertTrue(self.scheduler.rssfeed_timers[key]["timer"].running)
-
             # Does the timer have the correct interval?
-            interval = self.scheduler.rssfeed_timers[key]["timer"].interval
-            self.assertEquals(self.rssfeeds[key]["update_interval"] * 60, interval)
             self.assertEquals(self.rssfeeds[key]["update_interval"],
                               self.scheduler.rssfeed_timers[key]["update_interval"])
+            # The first update is one interval (plus the jitter) into the future
+            interval = self.rssfeeds[key]["update_interval"] * 60
+            next_update = self.scheduler.rssfeed_timers[key]["next_update"]
+            self.assertTrue(interval <= next_update <= interval * (1 + TIMER_JITTER_FRACTION))
+        # Only one delayed call is used for all the RSS Feeds, and one closes the idle HTTP sessions
+        self.assertEquals(len(self.clock.getDelayedCalls()), 2)
+
+    def test_idle_sessions_are_evicted(self):
+        evictions = []
+        self.patch(http_sessions.session_pool, "evict_idle", lambda: evictions.append(self.clock.seconds()))
+        self.clock.advance(http_sessions.IDLE_TIMEOUT)
+        self.assertEquals(evictions, [http_sessions.IDLE_TIMEOUT])
+        self.scheduler.disable_timers()
+        self.clock.advance(http_sessions.IDLE_TIMEOUT)
+        self.assertEquals(len(evictions), 1)
 
     def test_disable_timers(self):
         self.scheduler.disable_timers()
 
         # Now verify that the timers have been stopped
-        for key in self.scheduler.rssfeed_timers.keys():
-            # Is the timer running?
-            self.assertFalse(self.scheduler.rssfeed_timers[key]["timer"].running)
+        self.assertEquals(len(self.scheduler.rssfeed_timers), 0)
+        self.assertEquals(len(self.clock.getDelayedCalls()), 0)
 
     def test_delete_timer(self):
         # Delete timer
@@ -75,27 +100,294 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
         self.assertEquals(len(self.scheduler.rssfeed_timers.keys()), 4)
         self.assertFalse("0" in self.scheduler.rssfeed_timers)
 
+        # The deleted RSS Feed must not be updated
+        queued = self.record_queued_updates()
+        self.clock.advance(3 * 60 * (1 + TIMER_JITTER_FRACTION))
+        self.assertEquals(queued, ["1"])
+
     def test_reschedule_timer(self):
         # Change interval to 60 minutes
         self.assertTrue(self.scheduler.set_timer("0", 60))
-
-        interval = self.scheduler.rssfeed_timers["0"]["timer"].interval
-        self.assertEquals(60 * 60, interval)
         self.assertEquals(self.scheduler.rssfeed_timers["0"]["update_interval"], 60)
 
+        # The phase is kept, so the next update is 60 minutes after the previous update
+        queued = self.record_queued_updates()
+        self.clock.advance(60 * 60 - 1)
+        self.assertFalse("0" in queued)
+        self.clock.advance(60 * TIMER_JITTER_FRACTION + 1)
+        self.assertTrue("0" in queued)
+
+    def test_reschedule_timer_keeps_phase(self):
+        queued = self.record_queued_updates()
+        # First update of RSS Feed "1" (interval 3 minutes)
+        self.clock.advance(self.scheduler.rssfeed_timers["1"]["next_update"])
+        self.assertEquals(queued, ["0", "1"])
+        last_update = self.scheduler.rssfeed_timers["1"]["last_update"]
+
+        # Saving the RSS Feed with the same interval does not change the next update
+        next_update = self.scheduler.rssfeed_timers["1"]["next_update"]
+        self.assertTrue(self.scheduler.set_timer("1", 3, update_on_startup=True))
+        self.assertEquals(self.scheduler.rssfeed_timers["1"]["next_update"], next_update)
+
+        # Changing the interval schedules relative to the previous update
+        self.assertTrue(self.scheduler.set_timer("1", 10))
+        self.assertEquals(self.scheduler.rssfeed_timers["1"]["next_update"], last_update + 10 * 60)
+
     def test_schedule_timer(self):
         # Add new timer (with key "5") with interval 60 minutes
         self.assertTrue(self.scheduler.set_timer("5", 60))
 
         # Verify timer values
-        interval = self.scheduler.rssfeed_timers["5"]["timer"].interval
-        self.assertEquals(60 * 60, interval)
         self.assertEquals(self.scheduler.rssfeed_timers["5"]["update_interval"], 60)
+        self.assertTrue(self.scheduler.rssfeed_timers["5"]["next_update"] >= 60 * 60)
 
         # Should now be 6 timers
         self.assertEquals(len(self.scheduler.rssfeed_timers.keys()), 6)
 
-    def test_rssfeed_update_handler(self):
+    def test_timer_queues_updates(self):
+        queued = self.record_queued_updates()
+        self.clock.advance(60 * (1 + TIMER_JITTER_FRACTION))
+        self.assertEquals(queued, ["0"])
+        self.clock.pump([60] * 10)
+        # Feed "0" every minute, and feed "1" every third minute
+        self.assertEquals(queued.count("0"), 11)
+        self.assertEquals(queued.count("1"), 3)
+        # Missed updates are skipped
+        self.clock.advance(60 * 60)
+        self.assertEquals(queued.count("0"), 12)
+
+    @inlineCallbacks
+    def test_failed_updates_back_off(self):
+        """Tests that failed updates are recorded, and that the timer skips
+        the RSS Feed until the backoff delay has passed"""
+        self.config.set_config(test_common.get_test_config_dict())
+
+        def get_rssfeed_parsed(*args, **kwargs):
+            raise FetchAndFeedparsingError("Connection refused")
+        self.scheduler.rssfeedhandler.get_rssfeed_parsed = get_rssfeed_parsed
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        state = self.scheduler.feed_health.get_state("0")
+        self.assertEquals(state["state"], "open")
+        self.assertEquals(state["failures"], 1)
+        self.assertEquals(state["last_error"], "Connection refused")
+
+        queued = self.record_queued_updates()
+        self.clock.advance(BACKOFF_BASE - 1)
+        self.assertEquals(queued.count("0"), 0)
+        self.assertTrue(queued.count("1") > 0)
+        # Half-open, so the next update is let through
+        self.clock.advance(60)
+        self.assertEquals(queued.count("0"), 1)
+        self.assertEquals(self.scheduler.feed_health.get_state("0")["state"], "half-open")
+
+    @inlineCallbacks
+    def test_http_error_status_backs_off(self):
+        """Tests that an HTTP error status is a failure, and that Retry-After is honored"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        self.scheduler.add_torrents_func = lambda *args: None
+
+        def fetch_feed_items(config, rssfeed_key, subscription_key=None, deadline=None, download=None,
+                             cookie_index=None):
+            return {"matching_torrents": [], "subscriptions": [], "status": 503, "retry_after": 2 * BACKOFF_BASE}
+        self.scheduler.rssfeedhandler.fetch_feed_items = fetch_feed_items
+        yield self.scheduler.queue_rssfeed_update(subscription_key="0")
+        state = self.scheduler.feed_health.get_state("0")
+        self.assertEquals(state["failures"], 1)
+        self.assertEquals(state["last_error"], "HTTP status 503")
+        self.assertEquals(state["retry_in"], 2 * BACKOFF_BASE)
+
+        # A successful fetch closes the breaker
+        self.scheduler.rssfeedhandler.fetch_feed_items = lambda *args, **kwargs: {"matching_torrents": [],
+                                                                                  "subscriptions": [], "status": 200}
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        self.assertEquals(self.scheduler.feed_health.get_states(), {})
+
+    @inlineCallbacks
+    def test_permanent_redirect_changes_url(self):
+        """Tests that the URL of an RSS Feed is changed after permanent_redirect_threshold
+        updates in a row are redirected to the same URL"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        self.scheduler.add_torrents_func = lambda *args: None
+        redirects = ["http://new.example.com/feed", "http://moved.example.com/feed"]
+
+        def fetch_feed_items(config, rssfeed_key, subscription_key=None, deadline=None, download=None,
+                             cookie_index=None):
+            return {"matching_torrents": [], "subscriptions": [], "status": 301,
+                    "permanent_redirect": redirects[0]}
+        self.scheduler.rssfeedhandler.fetch_feed_items = fetch_feed_items
+        url = self.config.get_config()["rssfeeds"]["0"]["url"]
+        for i in range(self.scheduler.permanent_redirect_threshold - 1):
+            yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        # Redirected to another URL, so counted from the start
+        redirects.reverse()
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        redirects.reverse()
+        for i in range(self.scheduler.permanent_redirect_threshold - 1):
+            yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+            self.assertEquals(self.config.get_config()["rssfeeds"]["0"]["url"], url)
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        self.assertEquals(self.config.get_config()["rssfeeds"]["0"]["url"], "http://new.example.com/feed")
+        self.assertEquals(self.config.get_config()["rssfeeds"]["0"]["site"], "new.example.com")
+
+    def test_failure_log_has_rssfeed_name(self):
+        self.config.set_config(test_common.get_test_config_dict())
+        messages = []
+        self.patch(self.scheduler.log, "warning", messages.append)
+        self.scheduler.record_update_failure(None, "0", self.scheduler.get_config_snapshot("0"), "HTTP status 500")
+        self.assertEquals(messages, ["Update of RSS Feed 'Test RSS Feed' failed (HTTP status 500). "
+                                     "Backing off for %d seconds." % BACKOFF_BASE])
+
+    @inlineCallbacks
+    def test_gone_rssfeed_is_deactivated(self):
+        """Tests that an RSS Feed is deactivated after gone_deactivate_threshold updates in a row
+        where it is gone, spanning at least gone_deactivate_min_time seconds"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        self.scheduler.add_torrents_func = lambda *args: None
+        errors = []
+
+        def get_rssfeed_parsed(*args, **kwargs):
+            if errors:
+                raise errors[0]
+            return {"status": 410}
+
+        def update(other_rssfeed_responds=True):
+            self.clock.advance(60)
+            if other_rssfeed_responds:
+                self.scheduler.record_fetch_result("1", None, None, {"status": 200})
+                self.clock.advance(60)
+            return self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+
+        self.scheduler.rssfeedhandler.get_rssfeed_parsed = get_rssfeed_parsed
+        for i in range(self.scheduler.gone_deactivate_threshold - 1):
+            yield update()
+        self.assertEquals(self.scheduler.feed_health.get_gone_count("0"), self.scheduler.gone_deactivate_threshold - 1)
+        # Another error starts the count again
+        errors.append(FetchAndFeedparsingError("Connection refused"))
+        yield update()
+        errors[0] = FeedHostNotFoundError("Name or service not known")
+        for i in range(self.scheduler.gone_deactivate_threshold - 1):
+            yield update()
+        self.assertEquals(self.scheduler.feed_health.get_gone_count("0"), self.scheduler.gone_deactivate_threshold - 1)
+        # No other server has responded since the last update, so the network may be down
+        yield update(other_rssfeed_responds=False)
+        self.assertEquals(self.scheduler.feed_health.get_gone_count("0"), 0)
+
+        for i in range(self.scheduler.gone_deactivate_threshold):
+            yield update()
+        # Not gone for long enough
+        self.assertTrue(self.config.get_config()["rssfeeds"]["0"]["active"])
+        self.assertEquals(self.main_thread_calls, [])
+        self.clock.advance(self.scheduler.gone_deactivate_min_time)
+        yield update()
+        self.assertEquals([(f.__name__, args[0]) for f, args in self.main_thread_calls], [("deactivate_rssfeed", "0")])
+        self.assertFalse(self.config.get_config()["rssfeeds"]["0"]["active"])
+        self.assertEquals(self.scheduler.feed_health.get_states(), {})
+
+    def test_adaptive_interval(self):
+        """Tests that the timer interval follows the arrival rate of the items
+        when adaptive_interval is enabled"""
+        rssfeed = self.rssfeeds["2"]
+        now = yarss2.util.common.get_current_date()
+        items = dict((i, {"updated": (now - datetime.timedelta(minutes=40 * i)).isoformat()}) for i in range(5))
+        fetch_result = {"matching_torrents": [], "rssfeed_items": items}
+
+        self.scheduler.update_rssfeed_state("2", rssfeed, fetch_result)
+        self.assertEquals(self.scheduler.rssfeed_timers["2"]["update_interval"], 10)
+
+        rssfeed["adaptive_interval"] = True
+        self.scheduler.update_rssfeed_state("2", rssfeed, fetch_result)
+        self.assertEquals(self.scheduler.rssfeed_timers["2"]["update_interval"], 20)
+        # The configured interval is kept
+        self.assertEquals(rssfeed["update_interval"], 10)
+
+        # The interval is not shorter than the cache lifetime given by the server
+        fetch_result["cache_lifetime"] = 60 * 60
+        self.scheduler.update_rssfeed_state("2", rssfeed, fetch_result)
+        self.assertEquals(self.scheduler.rssfeed_timers["2"]["update_interval"], 60)
+
+        # The parsing stopped at the watermark, so the dates of the older items are used
+        fetch_result = {"matching_torrents": [], "rssfeed_items": {},
+                        "published_dates": [item["updated"] for item in items.values()]}
+        self.scheduler.update_rssfeed_state("2", rssfeed, fetch_result)
+        self.assertEquals(self.scheduler.rssfeed_timers["2"]["update_interval"], 20)
+
+        # Back to the configured interval when it cannot be estimated
+        fetch_result = {"matching_torrents": [], "rssfeed_items": {0: {"updated": ""}}}
+        self.scheduler.update_rssfeed_state("2", rssfeed, fetch_result)
+        self.assertEquals(self.scheduler.rssfeed_timers["2"]["update_interval"], 10)
+
+    def test_startup_updates_are_spread(self):
+        self.scheduler.disable_timers()
+        for key in self.rssfeeds:
+            self.rssfeeds[key]["update_on_startup"] = True
+        self.config.set_config({"rssfeeds": self.rssfeeds})
+        queued = self.record_queued_updates()
+        self.scheduler.enable_timers()
+
+        spacing = self.config.get_config()["general"]["startup_update_spacing"]
+        self.clock.advance(0)
+        self.assertEquals(len(queued), 1)
+        for i in range(4):
+            self.clock.advance(spacing)
+            self.assertEquals(len(queued), i + 2)
+        self.assertEquals(sorted(queued), sorted(self.rssfeeds.keys()))
+
+    def test_enable_timers_uses_stored_next_update(self):
+        self.scheduler.disable_timers()
+        now = int(time.time())
+        self.clock.advance(now)
+        # Remove the values stored when the timers were enabled in setUp
+        for key in self.rssfeeds:
+            self.rssfeeds[key]["next_update"] = ""
+        # Stored next update
+        self.rssfeeds["0"]["update_interval"] = 10
+        self.rssfeeds["0"]["next_update"] = yarss2.util.common.timestamp_to_isodate(now + 30)
+        # One interval after last update
+        self.rssfeeds["1"]["last_update"] = yarss2.util.common.timestamp_to_isodate(now - 60)
+        # Was due while the daemon was not running
+        self.rssfeeds["2"]["last_update"] = yarss2.util.common.timestamp_to_isodate(now - 3600)
+        # Never more than one interval into the future
+        self.rssfeeds["3"]["next_update"] = yarss2.util.common.timestamp_to_isodate(now + 3600 * 24)
+        self.config.set_config({"rssfeeds": self.rssfeeds})
+        self.scheduler.enable_timers()
+
+        timers = self.scheduler.rssfeed_timers
+        self.assertEquals(timers["0"]["next_update"], now + 30)
+        self.assertEquals(timers["1"]["next_update"], now - 60 + 3 * 60)
+        self.assertEquals(timers["2"]["next_update"], now)
+        self.assertEquals(timers["3"]["next_update"], now + 30 * 60)
+
+        # The next update is stored in the config
+        for key in self.rssfeeds:
+            self.assertEquals(yarss2.util.common.isodate_to_timestamp(self.rssfeeds[key]["next_update"]),
+                              int(timers[key]["next_update"]))
+
+        queued = self.record_queued_updates()
+        self.clock.advance(0)
+        self.assertEquals(queued, ["2"])
+        # Rescheduled after the update
+        self.assertEquals(timers["2"]["next_update"], now + 10 * 60)
+
+    def test_jitter_is_deterministic(self):
+        jitter = self.scheduler._get_jitter("1", 60)
+        self.assertEquals(jitter, self.scheduler._get_jitter("1", 60))
+        self.assertTrue(0 <= jitter <= 60 * 60 * TIMER_JITTER_FRACTION)
+        self.assertTrue(self.scheduler._get_jitter("1", 100000) <= TIMER_JITTER_MAX)
+
+    def record_queued_updates(self):
+        queued = []
+
+        def queue_rssfeed_update(rssfeed_key=None, subscription_key=None, priority=None):
+            queued.append(rssfeed_key)
+        self.scheduler.queue_rssfeed_update = queue_rssfeed_update
+        return queued
+
+    @inlineCallbacks
+    def test_rssfeed_update(self):
+        self.scheduler.disable_timers()
         subscription = yarss2.yarss_config.get_fresh_subscription_config(rssfeed_key="0", key="0")
         self.config.set_config({"subscriptions": {"0": subscription}})
 
@@ -103,27 +395,51 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
         old_last_update = self.rssfeeds["0"]["last_update"]
 
         # Run the rssfeed with key 0
-        self.scheduler.rssfeed_update_handler("0")
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
         self.assertNotEquals(old_last_update, self.rssfeeds["0"]["last_update"])
 
         old_last_update = self.rssfeeds["0"]["last_update"]
 
         # Run the subscription with key 0 like when the user runs it manually
-        self.scheduler.rssfeed_update_handler(None, "0")
+        yield self.scheduler.queue_rssfeed_update(subscription_key="0", priority=PRIORITY_MANUAL)
 
         # last_update should not have changed
         self.assertEquals(old_last_update, self.rssfeeds["0"]["last_update"])
 
-    def test_rssfeed_update_handler_exception(self):
+    def test_run_stage_safe_exception(self):
         subscription = yarss2.yarss_config.get_fresh_subscription_config(rssfeed_key="0", key="0")
         self.config.set_config({"subscriptions": {"0": subscription}})
 
-        self.scheduler.rssfeed_update_handler_safe("0")
         # Run the rssfeed with invalid key
-        self.assertRaises(KeyError, self.scheduler.rssfeed_update_handler, 1)
+        self.assertRaises(KeyError, self.scheduler.fetch_stage, 1)
         # Safe function should not raise exception
-        self.assertFalse(self.scheduler.rssfeed_update_handler_safe(1))
+        self.assertEquals(self.scheduler.run_stage_safe(self.scheduler.fetch_stage, {"rssfeed_key": 1}, 1), None)
 
+    @inlineCallbacks
+    def test_rssfeed_update_deadline(self):
+        """Tests that the update is abandoned when the deadline has passed"""
+        self.scheduler.disable_timers()
+        config = test_common.get_test_config_dict()
+        config["general"]["feed_update_deadline"] = 0.05
+        self.config.set_config(config)
+        fetch_feed_items = self.scheduler.rssfeedhandler.fetch_feed_items
+
+        def slow_fetch_feed_items(*args, **kwargs):
+            result = fetch_feed_items(*args, **kwargs)
+            time.sleep(0.1)
+            return result
+        self.scheduler.rssfeedhandler.fetch_feed_items = slow_fetch_feed_items
+
+        self.assertRaises(FeedUpdateDeadlineError, self.scheduler.parse_and_match_stage, "0",
+                          config=self.scheduler.get_config_snapshot("0"), deadline=0.05)
+        self.assertEquals(self.test_component.downloads, [])
+        # The queued update is abandoned
+        self.scheduler.add_torrents_func = lambda *args: self.fail("The torrents must not be added")
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        self.assertEquals(self.test_component.downloads, [])
+        self.assertTrue("Deadline passed" in self.scheduler.feed_health.get_state("0")["last_error"])
+
+    @inlineCallbacks
     def test_ttl_value_updated(self):
         config = test_common.get_test_config_dict()
         config["rssfeeds"]["0"]["update_interval"] = 30
@@ -143,7 +459,7 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
         self.scheduler.add_torrents_func = add_torrents_pass
 
         # Run the rssfeed with key 0
-        self.scheduler.rssfeed_update_handler("0")
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
 
         # Verify that update_interval of rssfeed in config was updated
         self.assertEquals(yarss_config.get_config()["rssfeeds"]["0"]["update_interval"], 60)
@@ -169,14 +485,250 @@ class RSSFeedSchedulerTestCase(unittest.TestCase):
             add_torrents_count.append(0)
         self.scheduler.add_torrents_func = add_torrents_cb
 
-        d_first = self.scheduler.queue_rssfeed_update(rssfeed_key="0")
-        self.scheduler.queue_rssfeed_update(subscription_key="1")
-        self.scheduler.queue_rssfeed_update(rssfeed_key="1")
-        d_last = self.scheduler.queue_rssfeed_update(rssfeed_key="2")
+        # The updates may run concurrently, so wait for all of them
+        deferreds = [self.scheduler.queue_rssfeed_update(rssfeed_key="0"),
+                     self.scheduler.queue_rssfeed_update(subscription_key="1"),
+                     self.scheduler.queue_rssfeed_update(rssfeed_key="1"),
+                     self.scheduler.queue_rssfeed_update(rssfeed_key="2")]
 
         def verify_callback_count(args):
             self.assertEquals(len(add_torrents_count), 3)
-        return DeferredList([d_first, d_last]).addBoth(verify_callback_count)
+        return DeferredList(deferreds).addBoth(verify_callback_count)
+
+    def test_rssfeed_update_queue_uses_config_snapshot(self):
+        """Tests that the update runs on a copy of the config, and that the
+        changes are merged into the live config in the main thread"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        live_config = self.config.get_config()
+        old_last_update = live_config["rssfeeds"]["0"]["last_update"]
+        worker_configs = []
+        cookie_index_threads = []
+        get_cookie_index = self.config.get_cookie_index
+
+        def get_cookie_index_main_thread():
+            cookie_index_threads.append(threadable.isInIOThread())
+            return get_cookie_index()
+        self.config.get_cookie_index = get_cookie_index_main_thread
+
+        def add_torrents_cb(save_subscription_func, matching_torrents, config):
+            worker_configs.append(config)
+            for torrent in matching_torrents:
+                self.assertIsNot(torrent["subscription_data"], live_config["subscriptions"]["0"])
+                torrent["subscription_data"]["last_match"] = torrent["updated_datetime"].isoformat()
+                save_subscription_func(subscription_data=torrent["subscription_data"])
+        self.scheduler.add_torrents_func = add_torrents_cb
+
+        def verify(result):
+            self.assertEquals(len(worker_configs), 1)
+            self.assertIsNot(worker_configs[0]["rssfeeds"]["0"], live_config["rssfeeds"]["0"])
+            # Only the RSS Feed being updated and its subscriptions are included
+            self.assertEquals(list(worker_configs[0]["rssfeeds"].keys()), ["0"])
+            self.assertFalse("4" in worker_configs[0]["subscriptions"])
+            # The changes made by the update are stored in the live config
+            self.assertNotEquals(old_last_update, live_config["rssfeeds"]["0"]["last_update"])
+            self.assertNotEquals(test_common.get_default_subscriptions(1)["0"]["last_match"],
+                                 live_config["subscriptions"]["0"]["last_match"])
+            # The live config is only read in the main thread
+            self.assertEquals(cookie_index_threads, [True])
+        d = self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        d.addCallback(verify)
+        return d
+
+    def test_queued_update_uses_config_when_started(self):
+        """Tests that an update waiting in the run queue takes the snapshot
+        of the config when it is started, and not when it is queued"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        self.scheduler.run_queue.set_limits(1)
+        self.scheduler.add_torrents_func = lambda *args: None
+        release = threading.Event()
+        last_matches = []
+        fetch_feed_items = self.scheduler.rssfeedhandler.fetch_feed_items
+
+        def fetch_feed_items_blocking(config, rssfeed_key, subscription_key=None, **kwargs):
+            release.wait(5)
+            last_matches.append(config["subscriptions"]["0"]["last_match"])
+            return fetch_feed_items(config, rssfeed_key, subscription_key=subscription_key, **kwargs)
+        self.scheduler.rssfeedhandler.fetch_feed_items = fetch_feed_items_blocking
+
+        d1 = self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        d2 = self.scheduler.queue_rssfeed_update(subscription_key="0")
+        self.assertEquals(self.scheduler.run_queue.get_queued_count(), 1)
+        self.config.get_config()["subscriptions"]["0"]["last_match"] = "2026-10-18T12:00:00+00:00"
+        release.set()
+
+        def verify(result):
+            self.assertEquals(len(last_matches), 2)
+            self.assertNotEquals(last_matches[0], "2026-10-18T12:00:00+00:00")
+            self.assertEquals(last_matches[1], "2026-10-18T12:00:00+00:00")
+        return DeferredList([d1, d2]).addCallback(verify)
+
+    def test_last_match_not_moved_backwards(self):
+        """Tests that an update finishing after another update of the same subscription
+        does not replace a newer last_match"""
+        self.config.set_config(test_common.get_test_config_dict())
+        subscription = self.config.get_config()["subscriptions"]["0"]
+        subscription["last_match"] = "2026-10-18T12:00:00+00:00"
+        snapshot = dict(subscription, last_match="2026-10-18T11:00:00+00:00")
+        self.scheduler.save_subscription_last_match(snapshot)
+        self.assertEquals(subscription["last_match"], "2026-10-18T12:00:00+00:00")
+        snapshot["last_match"] = "2026-10-18T13:00:00+00:00"
+        self.scheduler.save_subscription_last_match(snapshot)
+        self.assertEquals(subscription["last_match"], "2026-10-18T13:00:00+00:00")
+
+    @inlineCallbacks
+    def test_change_detection_reset_during_update(self):
+        """Tests that the ETag of an update is not stored if the change detection of the RSS Feed
+        was reset in the live config during the update"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        self.scheduler.add_torrents_func = lambda *args: None
+        live_rssfeed = self.config.get_config()["rssfeeds"]["0"]
+        live_rssfeed["etag"] = '"v1"'
+        resets = [True]
+
+        def fetch_feed_items(config, rssfeed_key, **kwargs):
+            config["rssfeeds"][rssfeed_key]["etag"] = '"v2"'
+            if resets:
+                # A subscription of the RSS Feed is saved
+                reset_change_detection(live_rssfeed)
+            return {"matching_torrents": [], "subscriptions": [], "status": 200}
+        self.scheduler.rssfeedhandler.fetch_feed_items = fetch_feed_items
+
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        self.assertEquals(live_rssfeed["etag"], "")
+
+        resets.pop()
+        yield self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        self.assertEquals(live_rssfeed["etag"], '"v2"')
+
+    def test_queue_rssfeed_update_invalid_key(self):
+        d = self.scheduler.queue_rssfeed_update(rssfeed_key="100")
+        d.addCallback(self.assertIsNone)
+        return d
+
+    def test_rssfeed_update_queue_coalesces_duplicates(self):
+        """Tests that an update already queued is not queued again"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        add_torrents_count = []
+
+        def add_torrents_cb(*arg):
+            add_torrents_count.append(0)
+        self.scheduler.add_torrents_func = add_torrents_cb
+
+        self.scheduler.run_queue.set_limits(1)
+        release = threading.Event()
+        blocker = self.scheduler.run_queue.push(release.wait, 5)
+        deferreds = [self.scheduler.queue_rssfeed_update(rssfeed_key="0"),
+                     self.scheduler.queue_rssfeed_update(rssfeed_key="0"),
+                     self.scheduler.queue_rssfeed_update(rssfeed_key="0", subscription_key="0")]
+        self.assertEquals(self.scheduler.run_queue.get_queued_count(), 2)
+        release.set()
+
+        def verify(result):
+            self.assertEquals(len(add_torrents_count), 2)
+        return DeferredList([blocker] + deferreds).addCallback(verify)
+
+    def test_rssfeed_update_stages_overlap(self):
+        """Tests that the torrent downloads of one update do not hold up the fetching of the next"""
+        self.scheduler.disable_timers()
+        self.config.set_config(test_common.get_test_config_dict())
+        self.scheduler.run_queue.set_limits(1)
+        self.scheduler.add_torrents_func = lambda *args: None
+        release = threading.Event()
+        downloads = []
+
+        def get_torrent(torrent, timeout=None, deadline=None):
+            downloads.append(torrent["title"])
+            release.wait(5)
+            return TorrentDownload()
+        self.scheduler.torrent_handler.get_torrent = get_torrent
+
+        # Update of the RSS Feed with matching torrents
+        d1 = self.scheduler.queue_rssfeed_update(rssfeed_key="0")
+        finished = []
+        d1.addCallback(finished.append)
+        # Run of the subscription without matches
+        d2 = self.scheduler.queue_rssfeed_update(subscription_key="1")
+
+        def verify_overlap(result):
+            self.assertEquals(finished, [])
+            stats = self.scheduler.get_stage_stats()
+            # The torrent files are on the same host
+            self.assertEquals(stats["download"]["running"], 2)
+            self.assertEquals(stats["download"]["queued"], 1)
+            self.assertEquals(stats["fetch"]["running"], 0)
+            release.set()
+            return d1
+
+        def verify_finished(result):
+            self.assertEquals(finished, [None])
+            self.assertEquals(len(downloads), 3)
+            self.assertEquals(self.scheduler._updates_in_progress, {})
+        return d2.addCallback(verify_overlap).addCallback(verify_finished)
+
+    def test_rssfeed_update_parallel_downloads(self):
+        """Tests that the torrent files are downloaded in parallel, limited per host,
+        and that the torrents are added in the order of the RSS Feed"""
+        self.scheduler.disable_timers()
+        config = test_common.get_test_config_dict()
+        config["general"]["max_concurrent_torrent_downloads"] = 3
+        config["general"]["max_torrent_downloads_per_host"] = 2
+        self.config.set_config(config)
+        self.scheduler.update_run_queue_limits()
+        lock = threading.Lock()
+        running = {}
+        max_running = {}
+        added = []
+
+        def get_torrent(torrent, timeout=None, deadline=None):
+            host = "magnet" if torrent["link"].startswith("magnet:") else "torrents"
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                running["total"] = running.get("total", 0) + 1
+                for key in (host, "total"):
+                    max_running[key] = max(max_running.get(key, 0), running[key])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+                running["total"] -= 1
+            return TorrentDownload({"url": torrent["link"]})
+        self.scheduler.torrent_handler.get_torrent = get_torrent
+
+        def add_torrents_cb(save_subscription_func, matching_torrents, config):
+            added.extend(matching_torrents)
+        self.scheduler.add_torrents_func = add_torrents_cb
+
+        fetch_feed_items = self.scheduler.rssfeedhandler.fetch_feed_items
+
+        def fetch_more_feed_items(*args, **kwargs):
+            fetch_data = fetch_feed_items(*args, **kwargs)
+            items = fetch_data["rssfeed_items"]
+            for i in range(3):
+                key = len(items)
+                items[key] = dict(items[0], key=key, title="sparc64 magnet %d" % i, link="magnet:?xt=%d" % i)
+            return fetch_data
+        self.scheduler.rssfeedhandler.fetch_feed_items = fetch_more_feed_items
+
+        def verify(result):
+            self.assertEquals(len(added), 6)
+            for torrent in added:
+                self.assertEquals(torrent["torrent_download"]["url"], torrent["link"])
+            self.assertEquals([torrent["title"] for torrent in added][3:],
+                              ["sparc64 magnet %d" % i for i in range(3)])
+            self.assertEquals(max_running["torrents"], 2)
+            self.assertEquals(max_running["total"], 3)
+        return self.scheduler.queue_rssfeed_update(rssfeed_key="0").addCallback(verify)
+
+    def test_update_run_queue_limits(self):
+        general = self.config.get_config()["general"]
+        general["max_concurrent_feed_updates"] = 5
+        general["max_connections_per_host"] = 2
+        self.scheduler.update_run_queue_limits()
+        self.assertEquals(self.scheduler.run_queue.concurrentMax, 5)
+        self.assertEquals(self.scheduler.run_queue.max_per_host, 2)
 
 
 class RSSFeedRunQueueTestCase(unittest.TestCase):
@@ -231,3 +783,169 @@ class RSSFeedRunQueueTestCase(unittest.TestCase):
         # Add verify_callback_results to the deferred chain
         d_verify.chainDeferred(d_verify_callback)
         return d_verify
+
+    def test_task_queue_host_limit(self):
+        """Test that jobs towards different hosts run concurrently, while
+        jobs towards the same host respect max_per_host"""
+        lock = threading.Lock()
+        running = {"host1": 0, "host2": 0, "total": 0}
+        max_running = {"host1": 0, "host2": 0, "total": 0}
+        release = threading.Event()
+
+        def test_run(host):
+            with lock:
+                for key in (host, "total"):
+                    running[key] += 1
+                    max_running[key] = max(max_running[key], running[key])
+            release.wait(5)
+            with lock:
+                for key in (host, "total"):
+                    running[key] -= 1
+            return host
+
+        taskq = RSSFeedRunQueue(concurrent_max=3, max_per_host=1)
+        deferreds = []
+        for host in ["host1", "host1", "host1", "host2", "host2"]:
+            deferreds.append(taskq.push_host(host, test_run, host))
+
+        # Only one job per host may run, and the jobs for host2 must not wait for host1
+        self.assertEquals(taskq._running, 2)
+        self.assertEquals(len(taskq._queued), 3)
+        release.set()
+
+        def verify(results):
+            self.assertEquals([result for (success, result) in results],
+                              ["host1", "host1", "host1", "host2", "host2"])
+            self.assertEquals(max_running["host1"], 1)
+            self.assertEquals(max_running["host2"], 1)
+            self.assertEquals(taskq._running, 0)
+            self.assertEquals(taskq._running_hosts, {})
+        return DeferredList(deferreds).addCallback(verify)
+
+    def test_task_queue_priority_and_coalescing(self):
+        """Test that queued jobs run in order of priority, and that jobs with
+        the same key are coalesced with the queued job"""
+        release = threading.Event()
+        order = []
+
+        def test_run(id):
+            order.append(id)
+            return id
+
+        taskq = RSSFeedRunQueue(concurrent_max=1)
+        blocker = taskq.push(release.wait, 5)
+        d1 = taskq.push_job(test_run, args=("normal1",), key="a", priority=PRIORITY_NORMAL)
+        d2 = taskq.push_job(test_run, args=("normal2",), key="b", priority=PRIORITY_NORMAL)
+        d3 = taskq.push_job(test_run, args=("manual",), key="c", priority=PRIORITY_MANUAL)
+        # Coalesced with the queued job with key "b", which is upgraded to manual priority
+        d4 = taskq.push_job(test_run, args=("normal2 latest",), key="b", priority=PRIORITY_MANUAL)
+        self.assertEquals(taskq.get_queued_count(), 3)
+        self.assertEquals(taskq.get_running_count(), 1)
+        release.set()
+
+        def verify(results):
+            # The upgraded job keeps its place among the jobs with the same priority
+            self.assertEquals(order, ["normal2 latest", "manual", "normal1"])
+            self.assertEquals([result for (success, result) in results[1:]],
+                              ["normal1", "normal2 latest", "manual", None])
+            self.assertEquals(taskq._queued_keys, {})
+            self.assertEquals(taskq._running_keys, {})
+        return DeferredList([blocker, d1, d2, d3, d4]).addCallback(verify)
+
+    def test_task_queue_coalesce_running(self):
+        """Test that a job is coalesced with a running job only when requested"""
+        release = threading.Event()
+        calls = []
+
+        def test_run(id):
+            calls.append(id)
+            release.wait(5)
+            return id
+
+        taskq = RSSFeedRunQueue(concurrent_max=2)
+        d1 = taskq.push_job(test_run, args=("first",), key="a")
+        d2 = taskq.push_job(test_run, args=("coalesced",), key="a", coalesce_running=True)
+        d3 = taskq.push_job(test_run, args=("second",), key="a")
+        self.assertEquals(taskq.get_running_count(), 2)
+        release.set()
+
+        def verify(results):
+            self.assertEquals(sorted(calls), ["first", "second"])
+            self.assertEquals([result for (success, result) in results], ["first", None, "second"])
+        return DeferredList([d1, d2, d3]).addCallback(verify)
+
+    def test_task_queue_downstream_full(self):
+        """Test that no jobs are started while the downstream queue is full"""
+        release = threading.Event()
+        upstream = RSSFeedRunQueue(concurrent_max=1)
+        downstream = RSSFeedRunQueue(concurrent_max=1, max_queued=1)
+        upstream.set_downstream(downstream)
+
+        d1 = downstream.push(release.wait, 5)
+        d2 = downstream.push(lambda: "downstream")
+        self.assertTrue(downstream.is_full())
+        d3 = upstream.push(lambda: "upstream")
+        self.assertEquals(upstream.get_queued_count(), 1)
+        release.set()
+
+        def verify(results):
+            self.assertEquals([result for (success, result) in results], [True, "downstream", "upstream"])
+            self.assertFalse(downstream.is_full())
+        return DeferredList([d1, d2, d3]).addCallback(verify)
+
+    def test_task_queue_deadline(self):
+        """Test that the watchdog abandons a job that does not finish within
+        the deadline, and that the freed slot is used by the next job"""
+        clock = Clock()
+        release = threading.Event()
+
+        def test_run(id):
+            release.wait(5)
+            return id
+
+        taskq = RSSFeedRunQueue(concurrent_max=1, clock=clock)
+        d1 = taskq.push_job(test_run, args=("hung",), deadline=10)
+        d2 = taskq.push_job(test_run, args=("next",), deadline=10)
+        self.assertEquals(taskq.get_queued_count(), 1)
+        clock.advance(9)
+        self.assertEquals(taskq.get_stats()["stalled"], 0)
+        clock.advance(1)
+        self.assertEquals(taskq.get_stats(), {"running": 1, "queued": 0, "stalled": 1, "abandoned_running": 1})
+        d1_failures = []
+        d1.addErrback(lambda failure: d1_failures.append(failure.trap(FeedUpdateDeadlineError)))
+        self.assertEquals(d1_failures, [FeedUpdateDeadlineError])
+        release.set()
+
+        def verify(result):
+            self.assertEquals(result, "next")
+            # The watchdog of the finished job is cancelled
+            self.assertEquals(clock.getDelayedCalls(), [])
+            self.assertEquals(taskq.get_stats()["running"], 0)
+        return d2.addCallback(verify)
+
+    def test_task_queue_in_reactor(self):
+        """Test jobs run in the reactor, and that the watchdog cancels a job that does not finish in time"""
+        clock = Clock()
+        requests = []
+
+        def test_run(id):
+            d = Deferred(lambda d: requests.remove(d))
+            requests.append(d)
+            return d
+
+        taskq = RSSFeedRunQueue(concurrent_max=1, clock=clock)
+        d1 = taskq.push_job(test_run, args=("hung",), deadline=10, in_thread=False)
+        d2 = taskq.push_job(test_run, args=("next",), deadline=10, in_thread=False)
+        self.assertEquals(len(requests), 1)
+        clock.advance(10)
+        self.assertFailure(d1, FeedUpdateDeadlineError)
+        # The hung job is cancelled instead of being left running like an abandoned thread
+        self.assertEquals(taskq.get_stats(), {"running": 1, "queued": 0, "stalled": 1, "abandoned_running": 0})
+        self.assertEquals(len(requests), 1)
+        results = []
+        d2.addCallback(results.append)
+        requests[0].callback("next")
+        self.assertEquals(results, ["next"])
+        self.assertEquals(taskq.get_stats()["running"], 0)
+        self.assertEquals(clock.getDelayedCalls(), [])
+        return d1
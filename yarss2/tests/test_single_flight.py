@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import threading
+
+from twisted.internet import defer, threads
+from twisted.trial import unittest
+
+import yarss2.util.common
+from yarss2.rssfeed_handling import RSSFeedHandler, get_fetch_key
+from yarss2.util import http, logging
+from yarss2.util.single_flight import SingleFlight
+
+from .utils.log_utils import plugin_tests_logger_name
+
+log = logging.getLogger(plugin_tests_logger_name)
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.flights = SingleFlight()
+        self.calls = []
+
+    @defer.inlineCallbacks
+    def test_call_coalesced(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def fetch(url):
+            self.calls.append(url)
+            started.set()
+            release.wait(10)
+            return {"url": url}
+
+        first = threads.deferToThread(self.flights.call, "key", fetch, "http://example.com/feed")
+        yield threads.deferToThread(started.wait, 10)
+        second = threads.deferToThread(self.flights.call, "key", fetch, "http://example.com/feed")
+        third = threads.deferToThread(self.flights.call, "key", fetch, "http://example.com/feed")
+        while self.flights.get_stats()["coalesced"] < 2:
+            yield threads.deferToThread(release.wait, 0.01)
+        release.set()
+        results = yield defer.gatherResults([first, second, third])
+        self.assertEquals(self.calls, ["http://example.com/feed"])
+        self.assertTrue(results[0] is results[1] and results[0] is results[2])
+        self.assertEquals(self.flights.get_stats()["in_flight"], 0)
+
+    def test_get_fetch_key(self):
+        self.assertEquals(get_fetch_key("http://example.com/feed", {"Cookie": "uid=1"}, None),
+                          get_fetch_key("http://example.com/feed", {"Cookie": "uid=1"}, None))
+        self.assertNotEquals(get_fetch_key("http://example.com/feed", {}, None),
+                             get_fetch_key("http://example.com/feed", {"Cookie": "uid=1"}, None))
+        self.assertNotEquals(get_fetch_key("http://example.com/feed", {}, None),
+                             get_fetch_key("http://example.com/feed", {}, "agent"))
+
+    @defer.inlineCallbacks
+    def fetch_by_update_and_gui(self, download_file):
+        """Fetch the RSS Feed by a conditional update, and by the GUI while the update downloads it.
+        Returns the results of get_rssfeed_parsed of the update and the GUI."""
+        started = threading.Event()
+        release = threading.Event()
+
+        def download_file_blocking(url, **kwargs):
+            self.calls.append(kwargs.get("etag"))
+            started.set()
+            release.wait(10)
+            return download_file(url, **kwargs)
+
+        self.patch(http, "download_file", download_file_blocking)
+        handler = RSSFeedHandler(log)
+        rssfeed_data = {"name": "Test", "url": "http://example.com/feed", "parser": "atoma"}
+        update = threads.deferToThread(handler.get_rssfeed_parsed, rssfeed_data, etag="1", content_hash="hash")
+        yield threads.deferToThread(started.wait, 10)
+        gui = threads.deferToThread(handler.get_rssfeed_parsed, rssfeed_data, full_items=True)
+        while handler.fetches.get_stats()["coalesced"] < 1:
+            yield threads.deferToThread(release.wait, 0.01)
+        release.set()
+        results = yield defer.gatherResults([update, gui])
+        defer.returnValue(results)
+
+    @defer.inlineCallbacks
+    def test_download_shared_by_update_and_gui(self):
+        filename = yarss2.util.common.get_resource("ezrss-rss-2.xml", path="tests/data/feeds/")
+        content = yarss2.util.common.read_file(filename)
+        update, gui = yield self.fetch_by_update_and_gui(lambda url, **kwargs: {"status": 200, "content": content})
+        self.assertEquals(self.calls, ["1"])
+        # Parsed by each caller
+        self.assertEquals(len(update["items"]), 2)
+        self.assertEquals(len(gui["items"]), 2)
+        self.assertTrue("guid" in gui["raw_result"]["items"][0])
+        self.assertFalse("guid" in update["raw_result"]["items"][0])
+
+    @defer.inlineCallbacks
+    def test_not_modified_download_not_shared(self):
+        filename = yarss2.util.common.get_resource("ezrss-rss-2.xml", path="tests/data/feeds/")
+        content = yarss2.util.common.read_file(filename)
+
+        def download_file(url, etag=None, **kwargs):
+            return {"status": 304} if etag else {"status": 200, "content": content}
+        update, gui = yield self.fetch_by_update_and_gui(download_file)
+        # Not Modified since the previous response of the update, so the GUI downloads the RSS Feed
+        self.assertEquals(self.calls, ["1", None])
+        self.assertTrue(update["not_modified"])
+        self.assertEquals(len(gui["items"]), 2)
+
+    def test_call_error(self):
+        def fail():
+            raise ValueError("Failed")
+        self.assertRaises(ValueError, self.flights.call, "key", fail)
+        self.assertEquals(self.flights.call("key", lambda: 1), 1)
+
+    def test_call_async_coalesced(self):
+        download = defer.Deferred()
+
+        def fetch():
+            self.calls.append(1)
+            return download
+
+        first = self.flights.call_async("key", fetch)
+        second = self.flights.call_async("key", fetch)
+        third = self.flights.call_async("key", fetch)
+        # Cancelling one caller does not cancel the download
+        third.cancel()
+        self.assertFailure(third, defer.CancelledError)
+        download.callback("content")
+        self.assertEquals(self.successResultOf(first), "content")
+        self.assertEquals(self.successResultOf(second), "content")
+        self.assertEquals(self.calls, [1])
+        self.flights.call_async("key", fetch)
+        self.assertEquals(self.calls, [1, 1])
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import os
+
+from deluge import bencode
+from twisted.trial import unittest
+
+import yarss2.util.common
+from yarss2.torrent_handling import TorrentHandler
+from yarss2.util import logging
+from yarss2.util.common import TorrentDownload
+from yarss2.util import torrent_cache
+from yarss2.util.torrent_cache import TorrentCache, get_infohash, get_magnet_infohash, normalize_infohash
+
+from .utils.helpers import TempDir
+from .utils.log_utils import plugin_tests_logger_name
+
+log = logging.getLogger(plugin_tests_logger_name)
+
+
+def get_torrent_data(name, size=1000):
+    info = {b"name": name, b"piece length": 16384, b"pieces": b"0" * 20, b"length": 1}
+    return bencode.bencode({b"info": info, b"comment": b"x" * size})
+
+
+class TorrentCacheTestCase(unittest.TestCase):
+
+    def setUp(self):  # NOQA
+        self.tmp_dir = TempDir(prefix="yarss2_unit_tests")
+        self.directory = os.path.join(self.tmp_dir.path, "torrent_cache")
+        self.cache = TorrentCache(self.directory, max_size=2500)
+
+    def tearDown(self):  # NOQA
+        self.tmp_dir.dissolve()
+
+    def test_get(self):
+        data = get_torrent_data(b"a")
+        infohash = self.cache.put("http://Example.com:80/get.php?id=1&passkey=x#top", data)
+        self.assertEquals(infohash, get_infohash(data))
+        self.assertEquals(self.cache.get("http://example.com/get.php?passkey=x&id=1"), data)
+        self.assertEquals(self.cache.get("http://example.com/get.php?id=2&passkey=x"), None)
+        self.assertEquals(self.cache.put("http://example.com/error", b"<html></html>"), None)
+        stats = self.cache.get_stats()
+        self.assertEquals((stats["hits"], stats["misses"], stats["files"]), (1, 1, 1))
+
+    def test_same_torrent_stored_once(self):
+        data = get_torrent_data(b"a")
+        self.cache.put("http://example.com/1.torrent", data)
+        self.cache.put("http://mirror.example.com/1.torrent", data)
+        self.assertEquals(len([f for f in os.listdir(self.directory) if f.endswith(".torrent")]), 1)
+        self.assertEquals(self.cache.get("http://mirror.example.com/1.torrent"), data)
+
+    def test_least_recently_used_is_evicted(self):
+        for name in (b"a", b"b"):
+            self.cache.put("http://example.com/%s.torrent" % name.decode(), get_torrent_data(name))
+        # Used, so b is the least recently used
+        self.cache.get("http://example.com/a.torrent")
+        self.cache.put("http://example.com/c.torrent", get_torrent_data(b"c"))
+        self.assertEquals(self.cache.get("http://example.com/b.torrent"), None)
+        self.assertEquals(self.cache.get("http://example.com/a.torrent"), get_torrent_data(b"a"))
+        self.cache.set_max_size(0)
+        self.assertEquals(self.cache.get_stats()["files"], 0)
+
+    def test_loaded_from_disk(self):
+        data = get_torrent_data(b"a")
+        self.cache.put("http://example.com/a.torrent", data)
+        self.cache.flush()
+        cache = TorrentCache(self.directory)
+        self.assertEquals(cache.get("http://example.com/a.torrent"), data)
+
+    def test_urls_saved_in_batches(self):
+        urls_path = os.path.join(self.directory, torrent_cache.URLS_FILENAME)
+        data = get_torrent_data(b"a")
+        for i in range(torrent_cache.URLS_SAVE_BATCH - 1):
+            self.cache.put("http://example.com/%d.torrent" % i, data)
+        self.assertFalse(os.path.exists(urls_path))
+        self.cache.put("http://example.com/last.torrent", data)
+        self.assertTrue(os.path.exists(urls_path))
+        self.assertEquals(TorrentCache(self.directory).get_stats()["urls"], torrent_cache.URLS_SAVE_BATCH)
+
+    def test_get_by_infohash(self):
+        data = get_torrent_data(b"a")
+        infohash = self.cache.put("http://example.com/a.torrent?passkey=1", data)
+        # Another URL of the same torrent
+        self.assertEquals(self.cache.get("http://example.com/a.torrent?passkey=2", infohash=infohash.upper()), data)
+        self.assertEquals(self.cache.get("http://example.com/a.torrent?passkey=2", infohash="0" * 40), None)
+        self.assertEquals(self.cache.get("http://example.com/a.torrent?passkey=1", infohash="0" * 40), data)
+
+    def test_normalize_infohash(self):
+        infohash = "4CF874831F61F5DB9C3299E503E28A8103047BA0"
+        self.assertEquals(normalize_infohash(infohash), infohash.lower())
+        self.assertEquals(normalize_infohash("JT4HJAY7MH25XHBSTHSQHYUKQEBQI65A"), infohash.lower())
+        self.assertEquals(normalize_infohash("not an infohash"), None)
+        self.assertEquals(normalize_infohash(None), None)
+        self.assertEquals(get_magnet_infohash("magnet:?xt=urn:btih:%s&dn=name" % infohash), infohash.lower())
+        self.assertEquals(get_magnet_infohash(None), None)
+
+    def test_get_torrent_uses_cache(self):
+        handler = TorrentHandler(log, torrent_cache=self.cache)
+        self.cache.set_max_size(10 * 1024 * 1024)
+        filename = yarss2.util.common.get_resource("FreeBSD-9.0-RELEASE-amd64-dvd1.torrent", path="tests/data/")
+        downloads = []
+
+        def download_torrent_file(torrent_url, cookies=None, headers=None, timeout=None, deadline=None):
+            downloads.append(torrent_url)
+            return TorrentDownload({"url": torrent_url, "filedump": yarss2.util.common.read_file(filename)})
+
+        handler.download_torrent_file = download_torrent_file
+        first = handler.get_torrent({"link": "http://example.com/1.torrent"})
+        second = handler.get_torrent({"link": "http://example.com/1.torrent"})
+        self.assertEquals(len(downloads), 1)
+        self.assertTrue(second.success)
+        self.assertEquals(second.filedump, first.filedump)
@@ -11,7 +11,6 @@ import datetime
 import os.path
 from unittest import mock
 
-import requests
 from twisted.trial import unittest
 
 from deluge.error import AddTorrentError
@@ -19,7 +18,7 @@ from deluge.error import AddTorrentError
 import yarss2.torrent_handling
 import yarss2.util.common
 from yarss2.torrent_handling import TorrentDownload, TorrentHandler
-from yarss2.util import logging
+from yarss2.util import http_sessions, logging
 from yarss2.util.common import GeneralSubsConf, read_file
 
 from . import common as test_common
@@ -54,7 +53,7 @@ class TestComponent(object):
         self.added.append(download)
         return download
 
-    def download_torrent_file(self, torrent_url, cookies=None, headers=None):
+    def download_torrent_file(self, torrent_url, cookies=None, headers=None, timeout=None, deadline=None):
         download = TorrentDownload()
         download.torrent_url = torrent_url
         download.cookies = cookies
@@ -85,19 +84,17 @@ def get(key):
 yarss2.torrent_handling.component = test_torrent_handling
 
 
-def get_file(url, cookies={}, headers={}, verify=True):
+def get_file(url, cookies={}, headers={}, verify=True, timeout=None, max_size=None, rejected_types=()):
 
     class Request(object):
         pass
     r = Request
+    r.content = None
     try:
         r.content = read_file(url)
     except Exception:
         pass
-    return r
-
-
-requests.get = get_file
+    return r, r.content
 
 
 class TorrentHandlingTestCase(unittest.TestCase):
@@ -110,6 +107,7 @@ class TorrentHandlingTestCase(unittest.TestCase):
         self.config.core_config.save()
         global test_component
         test_component = TestComponent(add_retval=True)
+        self.patch(http_sessions.session_pool, "get_content", get_file)
 
     def test_add_torrent(self):
         handler = TorrentHandler(self.log)
@@ -9,45 +9,58 @@
 
 import os
 
-import requests
+import twisted.internet.defer as defer
 
 import deluge.component as component
 from deluge._libtorrent import lt
 from deluge.core.torrent import TorrentOptions
 from deluge.error import AddTorrentError
 
-from yarss2.util import common, http, torrentinfo
+from yarss2.util import common, http, http_sessions, torrentinfo
 from yarss2.util.common import GeneralSubsConf, TorrentDownload
 from yarss2.util.yarss_email import send_torrent_email
+from yarss2.yarss_config import DEFAULT_MAX_TORRENT_SIZE
 
 
 class TorrentHandler(object):
 
-    def __init__(self, logger):
+    def __init__(self, logger, torrent_cache=None):
         self.log = logger
+        # Bytes of a torrent file to download
+        self.max_torrent_size = DEFAULT_MAX_TORRENT_SIZE
+        # The torrent_cache.TorrentCache of the downloaded torrent files, or None
+        self.torrent_cache = torrent_cache
 
     def listen_on_torrent_finished(self, enable=True):
         component.get("EventManager").register_event_handler("TorrentFinishedEvent", self.on_torrent_finished_event)
 
-    def download_torrent_file(self, torrent_url, cookies=None, headers=None):
+    def download_torrent_file(self, torrent_url, cookies=None, headers=None, timeout=None, deadline=None):
         download = TorrentDownload()
         download.url = torrent_url
         download.cookies = cookies
         args = {"verify": False}
+        if timeout is not None:
+            args["timeout"] = timeout
+        if deadline is not None:
+            args["deadline"] = deadline
         if cookies is not None:
             args["cookies"] = cookies
         if headers is not None:
             args["headers"] = headers
         download.headers = headers
         try:
-            r = requests.get(torrent_url, **args)
-            download.filedump = r.content
+            r, download.filedump = http_sessions.session_pool.get_content(
+                torrent_url, max_size=self.max_torrent_size, rejected_types=http_sessions.TORRENT_REJECTED_TYPES,
+                **args)
         except Exception as e:
             error_msg = "Failed to download torrent url: '%s'. Exception: %s" % (torrent_url, str(e))
             self.log.error(error_msg)
             download.set_error(error_msg)
             return download
+        return self.check_torrent_file(download)
 
+    def check_torrent_file(self, download):
+        """Verify that the filedump of download is a torrent file. Sets the error of download if not"""
         if download.filedump is None:
             error_msg = "Filedump is None"
             download.set_error(error_msg)
@@ -58,20 +71,23 @@ class TorrentHandler(object):
             # Get the info to see if any exceptions are raised
             lt.torrent_info(lt.bdecode(download.filedump))
         except Exception as e:
-            error_msg = "Unable to decode torrent file! (%s) URL: '%s'" % (str(e), torrent_url)
+            error_msg = "Unable to decode torrent file! (%s) URL: '%s'" % (str(e), download.url)
             download.set_error(error_msg)
             self.log.error(error_msg)
         return download
 
-    def get_torrent(self, torrent_info):
-        url = torrent_info["link"]
-        site_cookies_dict = torrent_info.get("site_cookies_dict", None)
-        download = None
+    def _get_request_headers(self, torrent_info):
         headers = {}
         user_agent = torrent_info.get("user_agent", None)
-
         if user_agent:
             headers["User-Agent"] = user_agent
+        return headers
+
+    def get_torrent(self, torrent_info, timeout=None, deadline=None):
+        url = torrent_info["link"]
+        site_cookies_dict = torrent_info.get("site_cookies_dict", None)
+        download = None
+        headers = self._get_request_headers(torrent_info)
 
         if url.startswith("magnet:"):
             self.log.info("Fetching magnet: '%s'" % url, gtkui=False)
@@ -79,20 +95,90 @@ class TorrentHandler(object):
         else:
             # Fix unicode URLs
             url = http.url_fix(url)
+            download = self.get_cached_torrent(url, infohash=torrent_info.get("infohash"))
+            if download is not None:
+                return download
             self.log.info("Downloading torrent: '%s' using cookies: '%s', headers: '%s'" %
                           (url, str(site_cookies_dict), str(headers)), gtkui=True)
-            download = self.download_torrent_file(url, cookies=site_cookies_dict, headers=headers)
-            # Error occured
-            if not download.success:
-                return download
-            # Get the torrent data from the torrent file
-            try:
-                torrentinfo.TorrentInfo(filedump=download.filedump)
-            except Exception as e:
-                download.set_error("Unable to open torrent file: %s. Error: %s" % (url, str(e)))
-                self.log.warning(download.error_msg)
+            download = self.download_torrent_file(url, cookies=site_cookies_dict, headers=headers, timeout=timeout,
+                                                  deadline=deadline)
+            download = self.check_torrent_info(download)
+            self.cache_torrent(download)
+        return download
+
+    def get_cached_torrent(self, url, infohash=None):
+        """Returns a TorrentDownload with the cached torrent file with infohash, or downloaded from url, or None"""
+        if self.torrent_cache is None:
+            return None
+        filedump = self.torrent_cache.get(url, infohash=infohash)
+        if filedump is None:
+            return None
+        self.log.info("Using cached torrent: '%s'" % url, gtkui=True)
+        return TorrentDownload({"url": url, "filedump": filedump})
+
+    def cache_torrent(self, download):
+        """Store the torrent file of a successful download in the cache"""
+        if self.torrent_cache is not None and download.success and download.filedump:
+            self.torrent_cache.put(download.url, download.filedump)
+
+    def check_torrent_info(self, download):
+        """Verify that the torrent info can be read from the torrent file"""
+        # Error occured
+        if not download.success:
+            return download
+        # Get the torrent data from the torrent file
+        try:
+            torrentinfo.TorrentInfo(filedump=download.filedump)
+        except Exception as e:
+            download.set_error("Unable to open torrent file: %s. Error: %s" % (download.url, str(e)))
+            self.log.warning(download.error_msg)
         return download
 
+    def get_torrent_async(self, torrent_info, http_client, timeout=None):
+        """Like get_torrent, but the torrent file is downloaded with http_client
+        (an AsyncHTTPClient) without blocking.
+        Returns a Deferred called with the TorrentDownload.
+        """
+        url = torrent_info["link"]
+        if url.startswith("magnet:"):
+            return defer.succeed(self.get_torrent(torrent_info))
+        site_cookies_dict = torrent_info.get("site_cookies_dict", None)
+        headers = self._get_request_headers(torrent_info)
+        # Fix unicode URLs
+        url = http.url_fix(url)
+        download = self.get_cached_torrent(url, infohash=torrent_info.get("infohash"))
+        if download is not None:
+            return defer.succeed(download)
+        self.log.info("Downloading torrent: '%s' using cookies: '%s', headers: '%s'" %
+                      (url, str(site_cookies_dict), str(headers)), gtkui=True)
+        download = TorrentDownload()
+        download.url = url
+        download.cookies = site_cookies_dict
+        download.headers = headers
+        request_headers = dict(headers)
+        if site_cookies_dict:
+            request_headers.update(http.get_cookie_header(site_cookies_dict))
+
+        def on_downloaded(response):
+            download.filedump = response["content"]
+            checked = self.check_torrent_info(self.check_torrent_file(download))
+            self.cache_torrent(checked)
+            return checked
+
+        def on_error(failure):
+            # Cancelled by the watchdog of the run queue
+            if failure.check(defer.CancelledError):
+                return failure
+            error_msg = "Failed to download torrent url: '%s'. Exception: %s" % (url, failure.getErrorMessage())
+            self.log.error(error_msg)
+            download.set_error(error_msg)
+            return download
+
+        d = http_client.get(url, headers=request_headers, timeout=timeout, verify=False,
+                            max_size=self.max_torrent_size, rejected_types=http_sessions.TORRENT_REJECTED_TYPES)
+        d.addCallbacks(on_downloaded, on_error)
+        return d
+
     def add_torrent(self, torrent_info):
         # Initialize options with default configurations
         options = TorrentOptions()
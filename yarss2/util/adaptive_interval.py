@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Estimates the update interval of an RSS Feed from the publish times of its items.
+
+Feeds tend to publish in bursts, and then sit idle for hours. While items are arriving,
+the interval follows the mean time between the newest items. While the feed is quiet,
+the interval grows with the time since the newest item.
+"""
+
+# Part of the mean time between the newest items used as the interval
+ARRIVAL_FACTOR = 0.5
+# Part of the time since the newest item used as the interval
+IDLE_FACTOR = 0.25
+# Number of the newest items used to estimate the arrival rate
+ARRIVAL_WINDOW = 10
+
+
+def get_adaptive_interval(published_dates, now, min_interval, max_interval, lower_bound=None):
+    """Returns the update interval in minutes, between min_interval and max_interval
+
+    Args:
+        published_dates (list): The publish times (datetime.datetime) of the items in the feed
+        now (datetime.datetime): The current time
+        min_interval (int): The minimum interval in minutes
+        max_interval (int): The maximum interval in minutes
+        lower_bound (int): Seconds the feed is not expected to change, e.g. from Cache-Control or TTL
+
+    Returns:
+        int: The interval, or None if the feed has too few dated items to estimate the arrival rate
+
+    """
+    dates = sorted((dt for dt in published_dates if dt is not None and dt <= now), reverse=True)
+    dates = dates[:ARRIVAL_WINDOW]
+    if len(dates) < 2:
+        return None
+    mean_gap = (dates[0] - dates[-1]).total_seconds() / (len(dates) - 1)
+    idle = (now - dates[0]).total_seconds()
+    interval = max(mean_gap * ARRIVAL_FACTOR, idle * IDLE_FACTOR)
+    if lower_bound:
+        interval = max(interval, lower_bound)
+    minutes = int(round(interval / 60.0))
+    return max(min_interval, min(max_interval, minutes))
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+HTTP client for the RSS Feed and torrent downloads that runs in the reactor.
+
+The requests are made with the Agent of twisted.web, with a pool of persistent connections,
+so waiting for a slow server does not hold a worker thread. The results have the same form
+as the results of http.download_file, so they can be parsed by the same code.
+"""
+
+from OpenSSL import SSL
+from twisted.internet import defer, protocol, ssl
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+from twisted.internet.interfaces import IOpenSSLClientConnectionCreator
+from twisted.web.client import (Agent, BrowserLikeRedirectAgent, ContentDecoderAgent, GzipDecoder,
+                                HTTPConnectionPool, ResponseDone)
+from twisted.web.http import PotentialDataLoss
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IPolicyForHTTPS
+from zope.interface import implementer
+
+from yarss2.error import DownloadRejectedError
+from yarss2.util.feedparsing.http import ACCEPT_HEADER, USER_AGENT, _parse_retry_after, get_permanent_redirect
+from yarss2.util.http_sessions import FEED_REJECTED_TYPES, check_response_headers
+
+# Seconds to wait for a request when no timeout is given
+DEFAULT_TIMEOUT = 60
+# Idle connections kept open to each host
+MAX_PERSISTENT_PER_HOST = 2
+# Seconds an idle connection is kept open
+CACHED_CONNECTION_TIMEOUT = 240
+
+
+@implementer(IOpenSSLClientConnectionCreator)
+class NoVerifyClientTLSOptions(object):
+    """Creates the TLS connections to hostname without verifying the certificate of the server.
+    Like twisted.internet.ssl.optionsForClientTLS, the host name is sent with SNI, so
+    the servers hosting several sites answer with the certificate of the right site."""
+
+    def __init__(self, hostname):
+        if not isinstance(hostname, bytes):
+            hostname = hostname.encode("idna")
+        self.hostname = hostname
+        # SNI is only for host names, not IP addresses
+        host = hostname.decode("ascii")
+        self.send_sni = not (isIPAddress(host) or isIPv6Address(host))
+        self.context = ssl.CertificateOptions(verify=False).getContext()
+
+    def clientConnectionForTLS(self, tlsProtocol):  # NOQA
+        connection = SSL.Connection(self.context, None)
+        connection.set_app_data(tlsProtocol)
+        if self.send_sni:
+            connection.set_tlsext_host_name(self.hostname)
+        return connection
+
+
+@implementer(IPolicyForHTTPS)
+class NoVerifyPolicyForHTTPS(object):
+    """Accepts any certificate, as the torrent files are downloaded without verifying
+    the certificate of the server"""
+
+    def creatorForNetloc(self, hostname, port):
+        return NoVerifyClientTLSOptions(hostname)
+
+
+class AsyncHTTPClient(object):
+    """Makes HTTP requests without blocking. The connections are kept open
+    and reused for the next requests to the same host.
+
+    If rate_limiter is given, each request waits for its turn in the rate limit of the site.
+    Call close when the client is no longer used, to close the idle connections.
+    """
+
+    def __init__(self, reactor=None, max_persistent_per_host=MAX_PERSISTENT_PER_HOST, rate_limiter=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        self.rate_limiter = rate_limiter
+        self.pool = HTTPConnectionPool(self.reactor, persistent=True)
+        self.pool.maxPersistentPerHost = max_persistent_per_host
+        self.pool.cachedConnectionTimeout = CACHED_CONNECTION_TIMEOUT
+        self._agent = self._create_agent(Agent(self.reactor, pool=self.pool))
+        self._agent_no_verify = self._create_agent(Agent(self.reactor, pool=self.pool,
+                                                         contextFactory=NoVerifyPolicyForHTTPS()))
+
+    def _create_agent(self, agent):
+        return BrowserLikeRedirectAgent(ContentDecoderAgent(agent, [(b"gzip", GzipDecoder)]))
+
+    def get(self, url, headers=None, timeout=None, verify=True, max_size=None, rejected_types=()):
+        """Make a GET request to url
+
+        Args:
+            url (str): The URL
+            headers (dict): The request headers
+            timeout (float): Seconds to wait for the whole response, DEFAULT_TIMEOUT if None.
+                             The time waiting for the rate limit is not included.
+            verify (bool): If the certificate of the server is verified
+            max_size (int): Bytes of content to accept, no limit if None
+            rejected_types (tuple): The content types that are not accepted
+
+        Returns:
+            Deferred: Called with a dict with the keys url (after redirects), status, headers
+                      (with lower case names), redirect_codes and content. Fails with TimeoutError on timeout,
+                      and with DownloadRejectedError if the content type or size is not accepted.
+
+        """
+        request_headers = Headers()
+        for name, value in (headers or {}).items():
+            request_headers.setRawHeaders(_to_bytes(name), [_to_bytes(value)])
+        agent = self._agent if verify else self._agent_no_verify
+
+        def request(result=None):
+            d = agent.request(b"GET", _to_bytes(url), request_headers)
+            d.addCallback(self._read_response, max_size, rejected_types)
+            d.addTimeout(timeout if timeout is not None else DEFAULT_TIMEOUT, self.reactor,
+                         onTimeoutCancel=self._on_timeout)
+            return d
+
+        if self.rate_limiter is None:
+            return request()
+        d = self.rate_limiter.wait_async(url, self.reactor)
+        d.addCallback(request)
+        return d
+
+    def _on_timeout(self, result, timeout):
+        # The CancelledError is wrapped by the Agent, so it is not converted by addTimeout
+        raise defer.TimeoutError("Request did not finish within %s seconds" % timeout)
+
+    def _read_response(self, response, max_size, rejected_types):
+        result = {
+            "url": response.request.absoluteURI.decode("utf-8", "replace"),
+            "status": response.code,
+            "headers": get_response_headers(response),
+            "redirect_codes": get_redirect_codes(response),
+        }
+
+        def on_body(body):
+            result["content"] = body
+            return result
+
+        reader = _LimitedBodyReader(result["url"], max_size)
+        try:
+            check_response_headers(result["url"], result["headers"], max_size, rejected_types)
+        except DownloadRejectedError as err:
+            # The content is not read
+            reader.error = err
+        response.deliverBody(reader)
+        reader.finished.addCallback(on_body)
+        return reader.finished
+
+    def get_feed(self, url, user_agent=None, request_headers=None, timeout=None, etag=None, modified=None,
+                 max_size=None):
+        """Download the RSS Feed at url. If etag or modified (the ETag and Last-Modified
+        of the previous response) are given, the server may answer 304 Not Modified.
+        Fails with DownloadRejectedError if the content is larger than max_size.
+
+        Returns:
+            Deferred: Called with a dict like the one returned by http.download_file
+
+        """
+        headers = {"User-Agent": user_agent or USER_AGENT,
+                   "Accept": ACCEPT_HEADER,
+                   "A-IM": "feed"}
+        if etag:
+            headers["If-None-Match"] = etag
+        if modified:
+            headers["If-Modified-Since"] = modified
+        if request_headers:
+            headers.update(request_headers)
+        d = self.get(url, headers=headers, timeout=timeout, max_size=max_size, rejected_types=FEED_REJECTED_TYPES)
+        d.addCallback(get_feed_download_result)
+        return d
+
+    def close(self):
+        """Close the idle connections. Returns a Deferred called when they are closed"""
+        return self.pool.closeCachedConnections()
+
+
+class _LimitedBodyReader(protocol.Protocol):
+    """Collects the content of a response, like readBody. The connection is closed
+    and finished fails with DownloadRejectedError when more than max_size bytes arrive."""
+
+    def __init__(self, url, max_size):
+        self.url = url
+        self.max_size = max_size
+        self.size = 0
+        self.chunks = []
+        # The error of an aborted download. Set before the connection is made to not read the content.
+        self.error = None
+        self.finished = defer.Deferred(lambda d: self.transport.stopProducing())
+
+    def connectionMade(self):  # NOQA
+        if self.error is not None:
+            self.abort(self.error)
+
+    def dataReceived(self, data):  # NOQA
+        if self.finished.called or self.error is not None:
+            return
+        self.size += len(data)
+        if self.max_size and self.size > self.max_size:
+            self.abort(DownloadRejectedError("Download aborted after more than %d bytes: %s" %
+                                             (self.max_size, self.url)))
+            return
+        self.chunks.append(data)
+
+    def abort(self, error):
+        """Stop reading the content. finished fails with error when the connection is lost."""
+        self.error = error
+        self.transport.stopProducing()
+
+    def connectionLost(self, reason):  # NOQA
+        if self.finished.called:
+            return
+        if self.error is not None:
+            self.finished.errback(self.error)
+        elif reason.check(ResponseDone, PotentialDataLoss):
+            # Without a Content-Length, the end of the content is the end of the connection
+            self.finished.callback(b"".join(self.chunks))
+        else:
+            self.finished.errback(reason)
+
+
+def get_response_headers(response):
+    """Returns the headers of response as a dict of str, with lower case names"""
+    headers = {}
+    for name, values in response.headers.getAllRawHeaders():
+        headers[name.decode("latin-1").lower()] = ", ".join(v.decode("latin-1") for v in values)
+    return headers
+
+
+def get_redirect_codes(response):
+    """Returns the status codes of the redirects that led to response, first to last"""
+    codes = []
+    previous = response.previousResponse
+    while previous is not None:
+        codes.insert(0, previous.code)
+        previous = previous.previousResponse
+    return codes
+
+
+def get_feed_download_result(response):
+    """Convert the result of AsyncHTTPClient.get into the form returned by http.download_file"""
+    from . import feedparsing
+    result = dict(
+        bozo=False,
+        entries=[],
+        feed={},
+        headers=response["headers"],
+        href=response["url"],
+        status=response["status"],
+    )
+    if "retry-after" in result["headers"]:
+        retry_after = _parse_retry_after(result["headers"]["retry-after"])
+        if retry_after is not None:
+            result["retry_after"] = retry_after
+    permanent_redirect = get_permanent_redirect(response["url"], response.get("redirect_codes"))
+    if permanent_redirect is not None:
+        result["permanent_redirect"] = permanent_redirect
+    result["content"] = feedparsing.convert_to_utf8(result["headers"], response["content"], result)
+    return result
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode("utf-8")
@@ -11,12 +11,18 @@ from __future__ import print_function
 import datetime
 import os
 import sys
+import time
 
 import pkg_resources
 
 PY2 = sys.version_info.major == 2
 PY3 = sys.version_info.major == 3
 
+# Number of date strings whose datetime is kept by isodate_to_datetime
+ISODATE_CACHE_SIZE = 1024
+_isodate_cache = {}
+_utc = None
+
 
 def get_version():
     """
@@ -63,15 +69,27 @@ def datetime_ensure_timezone(dt):
     return dt
 
 
+def get_utc():
+    """Returns the UTC tzinfo, which is created once"""
+    global _utc
+    if _utc is None:
+        from dateutil.tz import tzutc
+        _utc = tzutc()
+    return _utc
+
+
 def datetime_add_timezone(dt, tzinfo=None):
-    from dateutil.tz import tzutc
     if tzinfo is None:
-        tzinfo = tzutc()
+        tzinfo = get_utc()
     return dt.replace(tzinfo=tzinfo)
 
 
 def isodate_to_datetime(date_in_isoformat):
     """
+    The dates are parsed with datetime.fromisoformat if possible, and with dateutil otherwise.
+    The datetimes of the last ISODATE_CACHE_SIZE dates are kept, as the same dates
+    (e.g. the last_match of the subscriptions) are converted on every update.
+
     Args:
         date_in_isoformat (str): The date in iso format
 
@@ -79,15 +97,73 @@ def isodate_to_datetime(date_in_isoformat):
         datetime.datetime: The datetime object converted from date_in_isoformat
 
     """
-    from dateutil import parser as dateutil_parser
+    dt = _isodate_cache.get(date_in_isoformat)
+    if dt is not None:
+        return dt
     try:
-        dt = dateutil_parser.parse(date_in_isoformat)
-        return datetime_add_timezone(dt)
-    except ValueError as err:
-        from yarss2.util import logging
-        log = logging.getLogger(__name__)
-        log.warning("isodate_to_datetime error:", err)
-        return get_default_date()
+        # Python 3.7 or later
+        dt = datetime.datetime.fromisoformat(date_in_isoformat)
+    except (AttributeError, TypeError, ValueError):
+        from dateutil import parser as dateutil_parser
+        try:
+            dt = dateutil_parser.parse(date_in_isoformat)
+        except ValueError as err:
+            from yarss2.util import logging
+            log = logging.getLogger(__name__)
+            log.warning("isodate_to_datetime error:", err)
+            dt = get_default_date()
+    dt = datetime_add_timezone(dt)
+    if len(_isodate_cache) >= ISODATE_CACHE_SIZE:
+        _isodate_cache.clear()
+    _isodate_cache[date_in_isoformat] = dt
+    return dt
+
+
+def isodate_to_epoch(date_in_isoformat):
+    """
+    Args:
+        date_in_isoformat (str): The date in iso format
+
+    Returns:
+        float: Seconds since the epoch of the datetime returned by isodate_to_datetime,
+               so the dates can be compared as numbers
+
+    """
+    dt = isodate_to_datetime(date_in_isoformat)
+    return (dt.replace(tzinfo=None) - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+def timestamp_to_isodate(timestamp):
+    """
+    Args:
+        timestamp (float): Seconds since the epoch
+
+    Returns:
+        str: The date in iso format, in local time like the dates returned by get_current_date
+
+    """
+    dt = datetime.datetime.fromtimestamp(timestamp).replace(microsecond=0)
+    return datetime_add_timezone(dt).isoformat()
+
+
+def isodate_to_timestamp(date_in_isoformat):
+    """
+    Inverse of timestamp_to_isodate
+
+    Args:
+        date_in_isoformat (str): The date in iso format, in local time
+
+    Returns:
+        float: Seconds since the epoch, or None if the date is empty or invalid
+
+    """
+    if not date_in_isoformat:
+        return None
+    dt = isodate_to_datetime(date_in_isoformat)
+    try:
+        return time.mktime(dt.replace(tzinfo=None).timetuple())
+    except (OverflowError, ValueError):
+        return None
 
 
 def get_new_dict_key(dictionary, string_key=True):
@@ -277,6 +353,31 @@ class GeneralSubsConf:
             return GeneralSubsConf.DISABLED
 
 
+class Deadline(object):
+    """The point in time when a task must be finished.
+    seconds is the time from now, or None if the task has no deadline"""
+
+    def __init__(self, seconds=None):
+        self.end = time.time() + seconds if seconds else None
+
+    def remaining(self):
+        """Seconds until the deadline, or None if there is no deadline"""
+        if self.end is None:
+            return None
+        return max(0, self.end - time.time())
+
+    def expired(self):
+        return self.end is not None and time.time() >= self.end
+
+    def get_timeout(self, timeout):
+        """Returns timeout, reduced to the time remaining until the deadline"""
+        remaining = self.remaining()
+        if remaining is None:
+            return timeout
+        # A timeout of 0 means non-blocking for sockets
+        return max(0.1, min(timeout, remaining) if timeout is not None else remaining)
+
+
 class TorrentDownload(dict):
     def __init__(self, d={}):
         self["filedump"] = None
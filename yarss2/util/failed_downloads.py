@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import threading
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+# Seconds a torrent URL is skipped after a failed download
+DEFAULT_TTL = 60 * 60
+# Failed downloads of a torrent URL before it is no longer retried
+DEFAULT_MAX_RETRIES = 5
+# Maximum number of URLs kept. The URLs with the oldest failures are forgotten first.
+MAX_ENTRIES = 10000
+
+
+class FailedDownloads(object):
+    """Negative cache of the torrent URLs that failed to download.
+
+    A matching item whose torrent file failed to download is matched again on the next
+    update, as the last_match of the subscription is not changed. After a failure, the URL
+    is skipped for ttl seconds, and after max_retries failures it is skipped until the daemon
+    is restarted, so a broken link is not downloaded on every update.
+
+    The failures are recorded by the worker threads, so the state is protected by a lock.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, max_retries=DEFAULT_MAX_RETRIES, clock=None):
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.clock = clock if clock is not None else reactor
+        # Ordered by the time of the last failure
+        self._urls = OrderedDict()
+        self._lock = threading.Lock()
+
+    def set_limits(self, ttl, max_retries):
+        with self._lock:
+            self.ttl = ttl
+            self.max_retries = max_retries
+
+    def record_success(self, url):
+        with self._lock:
+            self._urls.pop(url, None)
+
+    def record_failure(self, url, error):
+        """Record a failed download of url. Returns True if url will not be retried"""
+        with self._lock:
+            entry = self._urls.pop(url, None)
+            if entry is None:
+                entry = {"failures": 0}
+            entry["failures"] += 1
+            entry["last_error"] = error
+            entry["retry_at"] = self.clock.seconds() + self.ttl
+            self._urls[url] = entry
+            if len(self._urls) > MAX_ENTRIES:
+                self._urls.popitem(last=False)
+            return self._given_up(entry)
+
+    def _given_up(self, entry):
+        return self.max_retries > 0 and entry["failures"] >= self.max_retries
+
+    def get_skip_reason(self, url):
+        """Returns why the download of url should be skipped, or None if it should be downloaded"""
+        with self._lock:
+            entry = self._urls.get(url)
+            if entry is None:
+                return None
+            if self._given_up(entry):
+                return "Failed %d times, not retried. Last error: %s" % (entry["failures"], entry["last_error"])
+            if self.clock.seconds() < entry["retry_at"]:
+                return "Failed %d times, retried in %d seconds. Last error: %s" % (
+                    entry["failures"], entry["retry_at"] - self.clock.seconds(), entry["last_error"])
+            return None
+
+    def is_given_up(self, url):
+        """Returns True if url has failed too many times to be retried"""
+        with self._lock:
+            entry = self._urls.get(url)
+            return entry is not None and self._given_up(entry)
+
+    def get_urls(self):
+        """Returns a dict with the state of the failed URLs"""
+        with self._lock:
+            return dict((url, dict(entry, given_up=self._given_up(entry))) for url, entry in self._urls.items())
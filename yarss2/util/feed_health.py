@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+import threading
+
+from twisted.internet import reactor
+
+# Seconds an RSS Feed is skipped after the first failed update. Doubled for each consecutive failure.
+BACKOFF_BASE = 300
+# Maximum seconds an RSS Feed is skipped
+BACKOFF_MAX = 24 * 60 * 60
+
+STATE_CLOSED = "closed"
+STATE_OPEN = "open"
+STATE_HALF_OPEN = "half-open"
+
+
+class FeedHealth(object):
+    """Circuit breaker for the updates of the RSS Feeds.
+
+    A breaker is closed while the updates of the RSS Feed succeed. After a failed update
+    the breaker is open, and the RSS Feed is not updated until the backoff delay has passed.
+    The delay is doubled for each consecutive failure, and is at least the delay requested
+    by the server with Retry-After. When the delay has passed the breaker is half-open, and
+    the next update is let through. If that update succeeds the breaker is closed, if not it
+    is opened again with a longer delay.
+
+    The failures where the RSS Feed is gone, and the permanent redirects of the RSS Feeds
+    are also counted, so the scheduler can deactivate or move an RSS Feed when they repeat.
+
+    The failures are recorded by the worker threads, so the state is protected by a lock.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else reactor
+        self._feeds = {}
+        # The URL each RSS Feed is permanently redirected to, and the number of updates in a row
+        self._redirects = {}
+        self._lock = threading.Lock()
+
+    def _get_feed(self, key):
+        if key not in self._feeds:
+            self._feeds[key] = {"failures": 0, "retry_at": None, "last_error": None, "failed_at": None,
+                                "gone": 0, "gone_since": None}
+        return self._feeds[key]
+
+    def get_backoff(self, failures, retry_after=None):
+        """Returns the seconds to wait after failures consecutive failures"""
+        delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** min(failures - 1, 32))
+        if retry_after:
+            delay = max(delay, min(retry_after, BACKOFF_MAX))
+        return delay
+
+    def record_success(self, key):
+        with self._lock:
+            self._feeds.pop(key, None)
+
+    def record_failure(self, key, error, retry_after=None, gone=False):
+        """Record a failed update of the RSS Feed. Returns the seconds until it may be updated again.
+        gone: If the RSS Feed no longer exists, e.g. 410 Gone, or the host name is not found"""
+        with self._lock:
+            feed = self._get_feed(key)
+            now = self.clock.seconds()
+            feed["failures"] += 1
+            feed["last_error"] = error
+            feed["failed_at"] = now
+            # Consecutive failures where the RSS Feed was gone, and the time of the first of them
+            feed["gone"] = feed["gone"] + 1 if gone else 0
+            if feed["gone"] == 1:
+                feed["gone_since"] = now
+            delay = self.get_backoff(feed["failures"], retry_after=retry_after)
+            feed["retry_at"] = now + delay
+            return delay
+
+    def allow_update(self, key):
+        """Returns True if the breaker of the RSS Feed is closed or half-open"""
+        with self._lock:
+            feed = self._feeds.get(key)
+            return feed is None or self.clock.seconds() >= feed["retry_at"]
+
+    def get_gone_count(self, key):
+        """Returns the number of consecutive failed updates where the RSS Feed was gone"""
+        with self._lock:
+            feed = self._feeds.get(key)
+            return feed["gone"] if feed is not None else 0
+
+    def get_gone_time(self, key):
+        """Returns the seconds since the first of the consecutive failed updates where the RSS Feed was gone"""
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None or not feed["gone"]:
+                return 0
+            return self.clock.seconds() - feed["gone_since"]
+
+    def get_last_failure_time(self, key):
+        """Returns the time of the last failed update of the RSS Feed, or None if the last update succeeded"""
+        with self._lock:
+            feed = self._feeds.get(key)
+            return feed["failed_at"] if feed is not None else None
+
+    def record_redirect(self, key, url):
+        """Record the URL the RSS Feed was permanently redirected to, or None if it was not
+        redirected. Returns the number of consecutive updates redirected to url."""
+        with self._lock:
+            if url is None:
+                self._redirects.pop(key, None)
+                return 0
+            previous_url, count = self._redirects.get(key, (None, 0))
+            count = count + 1 if previous_url == url else 1
+            self._redirects[key] = (url, count)
+            return count
+
+    def remove(self, key):
+        with self._lock:
+            self._feeds.pop(key, None)
+            self._redirects.pop(key, None)
+
+    def get_state(self, key):
+        """Returns a dict with the state of the breaker of the RSS Feed"""
+        with self._lock:
+            feed = self._feeds.get(key)
+            if feed is None:
+                return {"state": STATE_CLOSED, "failures": 0, "retry_in": 0, "last_error": None}
+            retry_in = max(0, feed["retry_at"] - self.clock.seconds())
+            return {"state": STATE_OPEN if retry_in > 0 else STATE_HALF_OPEN,
+                    "failures": feed["failures"],
+                    "retry_in": int(retry_in),
+                    "last_error": feed["last_error"]}
+
+    def get_states(self):
+        """Returns the state of the RSS Feeds with failed updates"""
+        return dict((key, self.get_state(key)) for key in list(self._feeds.keys()))
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Registry of the parsers of RSS Feeds.
+
+The parser is selected with the feed_parser value in the general config, and can be
+overridden with the parser value of each RSS Feed. With "auto", the lxml parser is used
+if lxml is installed, and the bundled atoma parser otherwise.
+
+The parsers can be compared on an RSS Feed file with:
+
+    python benchmark_feed_parsers.py <file>
+"""
+
+import abc
+import importlib
+import timeit
+from collections import OrderedDict
+
+from yarss2.util import logging
+from yarss2.util.feed_stream import atoma_result_to_dict, defused_iterparse, lxml_iterparse, parse_rss_stream
+
+log = logging.getLogger(__name__)
+
+# Use the first available parser in AUTO_ORDER
+AUTO = "auto"
+AUTO_ORDER = ("lxml", "atoma")
+
+
+class ParserBackend(abc.ABCMeta("ParserBackendBase", (object,), {})):
+    """A parser of RSS Feeds. The parser is available if all the modules in requires can be imported.
+    The subclasses must implement parse."""
+
+    name = None
+    description = None
+    requires = ()
+
+    def __init__(self):
+        self._available = None
+
+    def is_available(self):
+        if self._available is None:
+            try:
+                for module in self.requires:
+                    importlib.import_module(module)
+                self._available = True
+            except ImportError:
+                self._available = False
+        return self._available
+
+    @abc.abstractmethod
+    def parse(self, data, watermark=None, full_items=False):
+        """Parse the RSS Feed in the bytes data.
+        Returns a dict like the one of feedparser, with "items", "feed" and "bozo".
+        Raises atoma.FeedXMLError if data is not valid XML. See feed_stream.parse_rss_stream."""
+
+
+class StreamParserBackend(ParserBackend):
+    """Parses the RSS Feed with feed_stream.parse_rss_stream"""
+
+    iterparse = None
+
+    def parse(self, data, watermark=None, full_items=False):
+        stream_result = parse_rss_stream(data, watermark=watermark, full_items=full_items, iterparse=self.iterparse)
+        parsed_feed = atoma_result_to_dict(stream_result)
+        if stream_result.stopped_early:
+            parsed_feed["stopped_at_watermark"] = True
+            # The items after the watermark are left out, so their publish dates are needed
+            # to estimate the update interval
+            parsed_feed["published_dates"] = [dt.isoformat() for dt in stream_result.published_dates]
+        return parsed_feed
+
+
+class AtomaParserBackend(StreamParserBackend):
+    name = "atoma"
+    description = "The bundled atoma parser with defusedxml"
+    requires = ("atoma", "defusedxml")
+    iterparse = staticmethod(defused_iterparse)
+
+
+class LxmlParserBackend(StreamParserBackend):
+    name = "lxml"
+    description = "The atoma parser with lxml, which parses the XML faster"
+    requires = ("atoma", "lxml")
+    iterparse = staticmethod(lxml_iterparse)
+
+
+_backends = OrderedDict()
+
+
+def register_backend(backend):
+    """Add backend (a ParserBackend) to the registry, replacing a backend with the same name"""
+    _backends[backend.name] = backend
+
+
+def get_backends():
+    """Returns the registered backends"""
+    return list(_backends.values())
+
+
+def get_available_backends():
+    """Returns the names of the registered backends that can be used"""
+    return [backend.name for backend in _backends.values() if backend.is_available()]
+
+
+def get_backend(name=None):
+    """Returns the backend with name, or the first available backend in AUTO_ORDER
+    if name is empty, "auto", unknown or not available"""
+    if name and name != AUTO:
+        backend = _backends.get(name)
+        if backend is not None and backend.is_available():
+            return backend
+        log.warning("The feed parser '%s' is not available, using '%s'." % (name, AUTO))
+    for auto_name in AUTO_ORDER:
+        backend = _backends.get(auto_name)
+        if backend is not None and backend.is_available():
+            return backend
+    raise ValueError("No feed parser is available")
+
+
+for backend_class in (AtomaParserBackend, LxmlParserBackend):
+    register_backend(backend_class())
+
+
+def benchmark(data, names=None, number=10, full_items=False):
+    """Parse the RSS Feed in the bytes data number times with each of the available backends,
+    or those in names.
+
+    Returns:
+        list: A tuple (name, seconds per parse, number of items) for each backend
+    """
+    results = []
+    for backend in get_backends():
+        if (names and backend.name not in names) or not backend.is_available():
+            continue
+        items = len(backend.parse(data, full_items=full_items)["items"])
+        timer = timeit.Timer(lambda: backend.parse(data, full_items=full_items))
+        seconds = min(timer.repeat(repeat=3, number=number)) / number
+        results.append((backend.name, seconds, items))
+    return results
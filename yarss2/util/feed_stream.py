@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Streaming parser for RSS Feeds.
+
+The items are parsed one at a time as the XML is read, and each item element is removed
+from the tree when it has been parsed, so the whole document is never held as a tree.
+The items of an RSS Feed are normally ordered newest first, so when the items are older
+than the newest item already matched by the subscriptions (the watermark), the rest of
+the document is not parsed.
+
+By default only the values of the items used to match the subscriptions are read
+from the elements (see extract_item), and the full atoma RSSItems are only made
+when all the values are needed, e.g. to show the parsed RSS Feed in the GUI.
+
+The XML is parsed with defusedxml, or with lxml by lxml_iterparse (see feed_parsers).
+"""
+
+from io import BytesIO
+
+import attr
+
+from yarss2.util import common
+from yarss2.util.adaptive_interval import ARRIVAL_WINDOW
+
+# Tags of the channel and item elements of RSS 2.0, which have no namespace
+ITEM_TAG = "item"
+CHANNEL_TAG = "channel"
+# Publish dates read when the parsing stops at the watermark, so the update
+# interval can still be estimated from the items older than the watermark
+WATERMARK_PUBLISHED_DATES = ARRIVAL_WINDOW
+
+
+class StreamParseResult(object):
+    """The result of parse_rss_stream. Has the attributes of the channel used from
+    an atoma RSSChannel, and items, the items that were parsed."""
+
+    def __init__(self):
+        self.items = []
+        self.ttl = None
+        self.content_encoded = None
+        self.link = None
+        self.title = None
+        self.description = None
+        self.language = None
+        self.version = None
+        # True if the parsing stopped at the watermark
+        self.stopped_early = False
+        # The publish dates (with the time zone replaced by UTC) of the items that were read,
+        # including some of the items after the watermark if the parsing stopped there
+        self.published_dates = []
+        # The channel element, without the items
+        self.channel = None
+
+
+def extract_item(element):
+    """Returns a dict with the values of the item element used to match the subscriptions
+    and to add the torrents: title, link, description, enclosures, pub_date, folder and torrent.
+    The values are the same as in the atoma RSSItem, with the enclosures and the torrent as dicts.
+    """
+    from atoma import rss, utils
+    torrent = rss._get_torrent_element(element)
+    if torrent is not None:
+        torrent = {"filename": torrent.filename, "contentlength": torrent.contentlength,
+                   "infohash": torrent.infohash, "magneturi": torrent.magneturi}
+    return {
+        "title": utils.get_text(element, "title"),
+        "link": rss._get_link(element),
+        "description": utils.get_text(element, "description"),
+        "enclosures": [{"url": e.attrib["url"], "length": utils.try_parse_length(e.attrib.get("length")),
+                        "type": e.attrib.get("type")} for e in element.findall("enclosure")],
+        "pub_date": utils.get_datetime(element, "pubDate"),
+        "folder": utils.get_text(element, "folder"),
+        "torrent": torrent,
+    }
+
+
+def defused_iterparse(data):
+    """Yield the start and end events of the XML in the bytes data, parsed with defusedxml.
+    Raises atoma.FeedXMLError if data is not valid XML."""
+    from atoma.exceptions import FeedXMLError
+    from defusedxml.ElementTree import ParseError, iterparse
+    try:
+        for event in iterparse(BytesIO(data), events=("start", "end")):
+            yield event
+    except ParseError:
+        raise FeedXMLError("Not a valid XML document")
+
+
+def lxml_iterparse(data):
+    """Yield the start and end events of the XML in the bytes data, parsed with lxml.
+    As with defusedxml, a document declaring entities is rejected, and no entities, DTDs
+    or other resources are loaded. Raises atoma.FeedXMLError if data is not valid XML."""
+    from atoma.exceptions import FeedXMLError
+    from lxml import etree
+    events = etree.iterparse(BytesIO(data), events=("start", "end"), resolve_entities=False,
+                             no_network=True, load_dtd=False, huge_tree=False,
+                             remove_comments=True, remove_pis=True)
+    checked = False
+    try:
+        for event, elem in events:
+            if not checked:
+                # The DTD is parsed before the root element
+                checked = True
+                dtd = elem.getroottree().docinfo.internalDTD
+                if dtd is not None and any(True for _ in dtd.iterentities()):
+                    raise FeedXMLError("Entity declarations are not allowed")
+            yield event, elem
+    except etree.XMLSyntaxError:
+        raise FeedXMLError("Not a valid XML document")
+
+
+def iter_rss_items(data, result, iterparse=defused_iterparse):
+    """Parse the RSS Feed in the bytes data, and yield the item elements of the channel as
+    they are parsed. An element is removed from the tree when the next one is requested.
+    The channel element is stored in result (a StreamParseResult).
+
+    Raises atoma.FeedXMLError if data is not valid XML, and atoma.FeedParseError
+    if it is not an RSS Feed.
+    """
+    from atoma.exceptions import FeedParseError
+
+    root = None
+    depth = 0
+    in_channel = False
+    for event, elem in iterparse(data):
+        if event == "start":
+            depth += 1
+            if root is None:
+                root = elem
+                result.version = root.get("version")
+            elif depth == 2 and result.channel is None and elem.tag == CHANNEL_TAG:
+                result.channel = elem
+                in_channel = True
+            continue
+        depth -= 1
+        # Only the items of the channel are parsed, like atoma does
+        if in_channel and depth == 2 and elem.tag == ITEM_TAG:
+            yield elem
+            # The item is no longer needed in the tree
+            result.channel.remove(elem)
+        elif elem is result.channel:
+            in_channel = False
+    if result.channel is None:
+        raise FeedParseError("RSS does not have a channel")
+
+
+def _set_channel_values(result):
+    from atoma import utils
+    channel = result.channel
+    result.ttl = utils.get_int(channel, "ttl")
+    result.content_encoded = utils.get_text(channel, "content:encoded")
+    result.link = utils.get_text(channel, "link")
+    result.title = utils.get_text(channel, "title")
+    result.description = utils.get_text(channel, "description")
+    result.language = utils.get_text(channel, "language")
+
+
+def parse_rss_stream(data, watermark=None, full_items=False, iterparse=defused_iterparse):
+    """Parse the RSS Feed in the bytes data.
+
+    Args:
+        data (bytes): The XML of the RSS Feed
+        watermark (datetime): If given, the parsing stops at the first item published before
+                              watermark, as long as the items have been in order newest first.
+                              The items without a publish date do not stop the parsing.
+                              The dates are compared with their time zones replaced by UTC,
+                              like common.isodate_to_datetime does.
+        full_items (bool): If True, the items are atoma RSSItems with all the values,
+                           else the dicts returned by extract_item.
+        iterparse (function): Yields the start and end events of the XML in data,
+                              e.g. defused_iterparse or lxml_iterparse.
+
+    Returns:
+        StreamParseResult: The items and the channel values. If the parsing stopped early,
+                           only the publish dates of the first WATERMARK_PUBLISHED_DATES items
+                           are read. If the channel has no ttl before the items, the rest of the
+                           items are skipped to read the channel values after them, else the
+                           channel values after the items are not included.
+    """
+    from atoma import rss, utils
+    result = StreamParseResult()
+    get_item = rss._get_item if full_items else extract_item
+    elements = iter_rss_items(data, result, iterparse=iterparse)
+    if watermark is not None:
+        watermark = common.datetime_add_timezone(watermark)
+    previous_date = None
+    ordered = True
+    ttl_read = False
+    for elem in elements:
+        if result.stopped_early:
+            if len(result.published_dates) < WATERMARK_PUBLISHED_DATES:
+                date = utils.get_datetime(elem, "pubDate")
+                if date is not None:
+                    result.published_dates.append(common.datetime_add_timezone(date))
+            elif ttl_read:
+                break
+            continue
+        item = get_item(elem)
+        date = item.pub_date if full_items else item["pub_date"]
+        if date is not None:
+            # Compared like the subscriptions compare the publish date with last_match,
+            # which is the time in the time zone of the RSS Feed, taken as UTC
+            date = common.datetime_add_timezone(date)
+            result.published_dates.append(date)
+            if previous_date is not None and date > previous_date:
+                # Not ordered newest first, so an old item says nothing about the next items
+                ordered = False
+            previous_date = date
+            if watermark is not None and ordered and date < watermark:
+                result.stopped_early = True
+                # The ttl is used by the update, so it must be read even if it is after the items
+                ttl_read = result.channel.find("ttl") is not None
+                continue
+        result.items.append(item)
+    elements.close()
+    _set_channel_values(result)
+    return result
+
+
+def atoma_result_to_dict(atoma_result):
+    """Returns a dict like the one of feedparser with the items and the channel values
+    of atoma_result. The items are either atoma RSSItems, which are converted with all
+    their values, or the dicts of extract_item."""
+
+    def item_to_dict(item):
+        if isinstance(item, dict):
+            d = item
+        else:
+            d = attr.asdict(item)
+        if d['pub_date'] is not None:
+            dt = d['pub_date']
+            if dt.tzinfo is None:
+                dt = common.datetime_add_timezone(dt)
+            d['published_date'] = dt.isoformat()
+            # We must remove datetime.datetime to make the dict encodable by rencode
+            del d['pub_date']
+
+        return d
+
+    def get_title(item):
+        return item['title'] if isinstance(item, dict) else item.title
+
+    items = [item_to_dict(item) for item in atoma_result.items if get_title(item) is not None]
+    result = {
+        'items': items, 'bozo': 0,
+        'feed': {
+            'ttl': atoma_result.ttl,
+            'encoded': atoma_result.content_encoded,
+            'link': atoma_result.link,
+            'title': atoma_result.title,
+            'subtitle': atoma_result.description,
+            'language': atoma_result.language,
+            'version': atoma_result.version,
+        }
+    }
+    return result
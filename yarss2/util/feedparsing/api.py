@@ -69,7 +69,8 @@ SUPPORTED_VERSIONS = {
     'cdf': 'CDF',
 }
 
-def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, result, timeout=None):
+def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, result, timeout=None,
+                   session_pool=None, max_size=None, rejected_types=(), deadline=None):
     """URL, filename, or string --> stream
 
     This function lets you define parsers that take any input source
@@ -100,6 +101,13 @@ def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, h
     if request_headers is supplied it is a dictionary of HTTP request headers
     that will override the values generated by FeedParser.
 
+    If session_pool is supplied, http and https URLs are downloaded with
+    the sessions of the pool (see yarss2.util.http_sessions).
+
+    URLs with a content larger than max_size, or with a content type starting
+    with one of rejected_types, raise DownloadRejectedError. The content read with
+    the sessions is abandoned with FeedUpdateDeadlineError when deadline has passed.
+
     :return: A :class:`StringIO.StringIO` or :class:`io.BytesIO`.
     """
     if hasattr(url_file_stream_or_string, 'read'):
@@ -107,7 +115,9 @@ def _open_resource(url_file_stream_or_string, etag, modified, agent, referrer, h
 
     if isinstance(url_file_stream_or_string, basestring) \
        and urllib.parse.urlparse(url_file_stream_or_string)[0] in ('http', 'https', 'ftp', 'file', 'feed'):
-        return http.get(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, result, timeout=timeout)
+        return http.get(url_file_stream_or_string, etag, modified, agent, referrer, handlers, request_headers, result, timeout=timeout,
+                        session_pool=session_pool, max_size=max_size, rejected_types=rejected_types,
+                        deadline=deadline)
 
     # try to open with native open function (if url_file_stream_or_string is a filename)
     try:
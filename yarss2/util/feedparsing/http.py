@@ -1,9 +1,11 @@
 from __future__ import absolute_import, unicode_literals, with_statement
 
+import calendar
 import datetime
 import gzip
 import re
 import struct
+import time
 import zlib
 
 try:
@@ -43,6 +45,7 @@ else:
     # Python 3.1 deprecated decodestring in favor of decodebytes
     _base64decode = getattr(base64, 'decodebytes')
 
+from ..http_sessions import check_content_size, check_response_headers
 from .datetimes import _parse_date
 from .urls import _convert_to_idn
 
@@ -59,6 +62,8 @@ bytes_ = type(b'')
 # HTTP "Accept" header to send to servers when downloading feeds.  If you don't
 # want to send an Accept header, set this to None.
 ACCEPT_HEADER = "application/atom+xml,application/rdf+xml,application/rss+xml,application/x-netcdf,application/xml;q=0.9,text/xml;q=0.2,*/*;q=0.1"
+# Redirects that mean the resource has moved, so the new URL can be used for the next requests
+PERMANENT_REDIRECT_CODES = (301, 308)
 
 class _FeedURLHandler(urllib.request.HTTPDigestAuthHandler, urllib.request.HTTPRedirectHandler, urllib.request.HTTPDefaultErrorHandler):
     def http_error_default(self, req, fp, code, msg, headers):
@@ -72,6 +77,8 @@ class _FeedURLHandler(urllib.request.HTTPDigestAuthHandler, urllib.request.HTTPR
                                                             code, msg, hdrs)
         result.status = code
         result.newurl = result.geturl()
+        # The status codes of the redirects, first to last
+        result.redirect_codes = [code] + getattr(result, 'redirect_codes', [])
         return result
     # The default implementations in urllib.request.HTTPRedirectHandler
     # are identical, so hardcoding a http_error_301 call above
@@ -80,6 +87,7 @@ class _FeedURLHandler(urllib.request.HTTPDigestAuthHandler, urllib.request.HTTPR
     http_error_302 = http_error_301
     http_error_303 = http_error_301
     http_error_307 = http_error_301
+    http_error_308 = http_error_301
 
     def http_error_401(self, req, fp, code, msg, headers):
         # Check if
@@ -105,9 +113,21 @@ class _FeedURLHandler(urllib.request.HTTPDigestAuthHandler, urllib.request.HTTPR
 
 def _build_urllib2_request(url, agent, accept_header, etag, modified, referrer, auth, request_headers):
     request = urllib.request.Request(url)
-    request.add_header('User-Agent', agent)
+    for header_name, header_value in _get_request_headers(agent, accept_header, etag, modified, referrer, auth,
+                                                          request_headers).items():
+        request.add_header(header_name, header_value)
+    return request
+
+def _get_request_headers(agent, accept_header, etag, modified, referrer, auth, request_headers):
+    headers = {}
+
+    def add_header(name, value):
+        # Same as urllib.request.Request.add_header, so a request header replaces a generated one
+        headers[name.capitalize()] = value
+
+    add_header('User-Agent', agent)
     if etag:
-        request.add_header('If-None-Match', etag)
+        add_header('If-None-Match', etag)
     if isinstance(modified, basestring):
         modified = _parse_date(modified)
     elif isinstance(modified, datetime.datetime):
@@ -119,29 +139,49 @@ def _build_urllib2_request(url, agent, accept_header, etag, modified, referrer,
         # in English.
         short_weekdays = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
         months = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
-        request.add_header('If-Modified-Since', '%s, %02d %s %04d %02d:%02d:%02d GMT' % (short_weekdays[modified[6]], modified[2], months[modified[1] - 1], modified[0], modified[3], modified[4], modified[5]))
+        add_header('If-Modified-Since', '%s, %02d %s %04d %02d:%02d:%02d GMT' % (short_weekdays[modified[6]], modified[2], months[modified[1] - 1], modified[0], modified[3], modified[4], modified[5]))
     if referrer:
-        request.add_header('Referer', referrer)
+        add_header('Referer', referrer)
     if gzip and zlib:
-        request.add_header('Accept-encoding', 'gzip, deflate')
+        add_header('Accept-encoding', 'gzip, deflate')
     elif gzip:
-        request.add_header('Accept-encoding', 'gzip')
+        add_header('Accept-encoding', 'gzip')
     elif zlib:
-        request.add_header('Accept-encoding', 'deflate')
+        add_header('Accept-encoding', 'deflate')
     else:
-        request.add_header('Accept-encoding', '')
+        add_header('Accept-encoding', '')
     if auth:
-        request.add_header('Authorization', 'Basic %s' % auth)
+        add_header('Authorization', 'Basic %s' % auth)
     if accept_header:
-        request.add_header('Accept', accept_header)
+        add_header('Accept', accept_header)
     # use this for whatever -- cookies, special headers, etc
     # [('Cookie','Something'),('x-special-header','Another Value')]
     for header_name, header_value in request_headers.items():
-        request.add_header(header_name, header_value)
-    request.add_header('A-IM', 'feed') # RFC 3229 support
-    return request
+        add_header(header_name, header_value)
+    add_header('A-IM', 'feed') # RFC 3229 support
+    return headers
+
+def get_permanent_redirect(url, redirect_codes):
+    """Returns url, the URL after the redirects, if all the redirects were permanent, else None"""
+    if redirect_codes and all(code in PERMANENT_REDIRECT_CODES for code in redirect_codes):
+        return url
+    return None
 
-def get(url, etag=None, modified=None, agent=None, referrer=None, handlers=None, request_headers=None, result=None, timeout=None):
+def _parse_retry_after(value):
+    """Returns the seconds to wait given by a Retry-After header, which is either
+    a number of seconds or an HTTP date. Returns None if the value is invalid."""
+    if isinstance(value, bytes_):
+        value = value.decode('utf-8', 'ignore')
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = _parse_date(value)
+    if date is None:
+        return None
+    return max(0, int(calendar.timegm(date) - time.time()))
+
+def get(url, etag=None, modified=None, agent=None, referrer=None, handlers=None, request_headers=None, result=None, timeout=None,
+        session_pool=None, max_size=None, rejected_types=(), deadline=None):
     if handlers is None:
         handlers = []
     elif not isinstance(handlers, list):
@@ -171,13 +211,24 @@ def get(url, etag=None, modified=None, agent=None, referrer=None, handlers=None,
     if not isinstance(url, bytes_):
         url = _convert_to_idn(url)
 
+    # http(s) requests are made with the sessions of session_pool, which keep the connections open
+    if session_pool is not None and not handlers and not isinstance(url, bytes_) \
+       and url.split(':', 1)[0].lower() in ('http', 'https'):
+        return _get_with_session(session_pool, url, etag, modified, agent, referrer, auth, request_headers,
+                                 result, timeout, max_size, rejected_types, deadline)
+
     # try to open with urllib2 (to use optional headers)
     request = _build_urllib2_request(url, agent, ACCEPT_HEADER, etag, modified, referrer, auth, request_headers)
     opener = urllib.request.build_opener(*tuple(handlers + [_FeedURLHandler()]))
     opener.addheaders = [] # RMK - must clear so we only send our custom User-Agent
     f = opener.open(request, timeout=timeout)
-    data = f.read()
-    f.close()
+    try:
+        check_response_headers(url, dict((k.lower(), v) for k, v in f.headers.items()), max_size, rejected_types)
+        # Read one byte more than the limit to know if the content is too large
+        data = f.read(max_size + 1) if max_size else f.read()
+        check_content_size(url, len(data), max_size)
+    finally:
+        f.close()
 
     # lowercase all of the HTTP headers for comparisons per RFC 2616
     result['headers'] = dict((k.lower(), v) for k, v in f.headers.items())
@@ -207,6 +258,30 @@ def get(url, etag=None, modified=None, agent=None, referrer=None, handlers=None,
                 result['bozo'] = True
                 result['bozo_exception'] = e
 
+    _save_response_info(result, f.url, getattr(f, 'status', 200), getattr(f, 'code', 0),
+                        getattr(f, 'redirect_codes', ()))
+    return data
+
+def _get_with_session(session_pool, url, etag, modified, agent, referrer, auth, request_headers, result, timeout,
+                      max_size, rejected_types, deadline=None):
+    headers = _get_request_headers(agent, ACCEPT_HEADER, etag, modified, referrer, auth, request_headers)
+    if not isinstance(timeout, (int, float)):
+        timeout = None
+    # The content is decompressed by requests
+    response, data = session_pool.get_content(url, max_size=max_size, rejected_types=rejected_types,
+                                              deadline=deadline, headers=headers, timeout=timeout)
+
+    # lowercase all of the HTTP headers for comparisons per RFC 2616
+    result['headers'] = dict((k.lower(), v) for k, v in response.headers.items())
+    # Like _FeedURLHandler, the status of a redirected request is the status of the redirect
+    status = response.history[0].status_code if response.history else response.status_code
+    _save_response_info(result, response.url, status, response.status_code,
+                        [r.status_code for r in response.history])
+    return data
+
+def _save_response_info(result, url, status, code, redirect_codes=()):
+    """Save the headers, final URL and status of the response in result.
+    redirect_codes: The status codes of the redirects to url, if any"""
     # save HTTP headers
     if 'etag' in result['headers']:
         etag = result['headers'].get('etag', '')
@@ -219,16 +294,23 @@ def get(url, etag=None, modified=None, agent=None, referrer=None, handlers=None,
         if modified:
             result['modified'] = modified
             result['modified_parsed'] = _parse_date(modified)
-    if isinstance(f.url, bytes_):
-        result['href'] = f.url.decode('utf-8', 'ignore')
+    if isinstance(url, bytes_):
+        result['href'] = url.decode('utf-8', 'ignore')
     else:
-        result['href'] = f.url
-    result['status'] = getattr(f, 'status', 200)
+        result['href'] = url
+    result['status'] = status
+    permanent_redirect = get_permanent_redirect(result['href'], redirect_codes)
+    if permanent_redirect is not None:
+        result['permanent_redirect'] = permanent_redirect
+
+    # Delay requested by the server, e.g. with 429 Too Many Requests or 503 Service Unavailable
+    if 'retry-after' in result['headers']:
+        retry_after = _parse_retry_after(result['headers']['retry-after'])
+        if retry_after is not None:
+            result['retry_after'] = retry_after
 
     # Stop processing if the server sent HTTP 304 Not Modified.
-    if getattr(f, 'code', 0) == 304:
+    if code == 304:
         result['version'] = ''
         result['debug_message'] = 'The feed has not changed since you last checked, ' + \
             'so the server sent no data.  This is a feature, not a bug!'
-
-    return data
@@ -8,6 +8,11 @@
 #
 
 import re
+import socket
+import time
+from email.utils import mktime_tz, parsedate_tz
+
+from twisted.internet.error import DNSLookupError
 
 PY2 = False
 PY3 = False
@@ -30,8 +35,11 @@ except ImportError:
 
 def download_file(url_file_stream_or_string, site_cookies_dict=None, etag=None, modified=None, user_agent=None,
                   referrer=None, handlers=None, request_headers=None, response_headers=None,
-                  resolve_relative_uris=None, sanitize_html=None, timeout='Global'):
-    from . import feedparsing
+                  resolve_relative_uris=None, sanitize_html=None, timeout='Global', session_pool=None, max_size=None,
+                  deadline=None):
+    from . import feedparsing, http_sessions
+    if session_pool is None:
+        session_pool = http_sessions.session_pool
     result = dict(
         bozo=False,
         entries=[],
@@ -46,11 +54,75 @@ def download_file(url_file_stream_or_string, site_cookies_dict=None, etag=None,
         request_headers.update(cookie_header)
 
     data = feedparsing._open_resource(url_file_stream_or_string, etag, modified, user_agent, referrer,
-                                      handlers, request_headers, result, timeout=timeout)
+                                      handlers, request_headers, result, timeout=timeout,
+                                      session_pool=session_pool, max_size=max_size,
+                                      rejected_types=http_sessions.FEED_REJECTED_TYPES, deadline=deadline)
     result['content'] = feedparsing.convert_to_utf8(result['headers'], data, result)
     return result
 
 
+# The getaddrinfo errors where the host name does not exist. Other errors, e.g. EAI_AGAIN,
+# may be temporary failures of the resolver.
+HOST_NOT_FOUND_ERRNOS = tuple(getattr(socket, name) for name in ("EAI_NONAME", "EAI_NODATA") if hasattr(socket, name))
+
+
+def is_host_not_found_error(error):
+    """Returns True if the exception error, or an exception that caused it,
+    is a failure to resolve a host name because it does not exist.
+    The DNSLookupError of Twisted does not say why the lookup failed, so it is always included."""
+    seen = set()
+    while error is not None and id(error) not in seen:
+        if isinstance(error, socket.gaierror):
+            return error.errno in HOST_NOT_FOUND_ERRNOS
+        if isinstance(error, DNSLookupError):
+            return True
+        seen.add(id(error))
+        # requests and urllib3 wrap the error of the connection
+        cause = getattr(error, "__cause__", None) or getattr(error, "__context__", None) or \
+            getattr(error, "reason", None)
+        if cause is None and getattr(error, "args", None) and isinstance(error.args[0], BaseException):
+            cause = error.args[0]
+        error = cause if isinstance(cause, BaseException) else None
+    return False
+
+
+def get_hostname(url):
+    """Returns the lower case hostname of url, or None if url has no hostname (e.g. a local file)"""
+    try:
+        return urlparse.urlsplit(url).hostname
+    except ValueError:
+        return None
+
+
+def get_cache_lifetime(headers, now=None):
+    """Returns the seconds a response may be cached according to the Cache-Control
+    or Expires headers, or None if the headers do not say.
+
+    headers: A dictionary with lower case header names
+    """
+    cache_control = headers.get("cache-control")
+    if cache_control:
+        for directive in cache_control.lower().split(","):
+            directive = directive.strip()
+            if directive in ("no-cache", "no-store"):
+                return 0
+            if directive.startswith("max-age="):
+                try:
+                    return max(0, int(directive[len("max-age="):].strip('"')))
+                except ValueError:
+                    pass
+    expires = headers.get("expires")
+    if expires:
+        expires = parsedate_tz(expires)
+        # An invalid date means already expired
+        if expires is None:
+            return 0
+        if now is None:
+            now = time.time()
+        return max(0, int(mktime_tz(expires) - now))
+    return None
+
+
 def get_matching_cookies_dict(cookies, url):
     """Takes a dictionary of cookie key/values, and
     returns a dict with the cookies matching the url
@@ -68,6 +140,80 @@ def get_matching_cookies_dict(cookies, url):
     return matching_cookies
 
 
+# The characters of a host name, used to tell the cookie sites that are host names
+HOST_RE = re.compile(r"^[a-z0-9-]+(\.[a-z0-9-]+)+$")
+
+
+def get_url_host(url):
+    """Returns the lower case host of url, which may also be a host name without a scheme,
+    e.g. the site of an RSS Feed"""
+    if "://" in url:
+        return get_hostname(url) or ""
+    return url.split("/", 1)[0].rsplit("@", 1)[-1].split(":", 1)[0].lower()
+
+
+class CookieIndex(object):
+    """Finds the cookies matching a URL without testing every cookie.
+
+    The active cookies are indexed by the host of their site. A URL matches the cookies
+    of its host and of the parent domains of its host, so the site "example.com" matches
+    "http://tracker.example.com/rss". Sites that are not host names (e.g. "example") are
+    matched as before, by being a substring of the URL.
+
+    With substring_match, all cookies are matched like get_matching_cookies_dict does.
+
+    The results are cached by host. Create a new index when the cookies change.
+    """
+
+    def __init__(self, cookies, substring_match=False):
+        # The cookies are replaced, not changed, when saved, so the index of a copy can be
+        # used in the worker threads while the cookies of the live config are changed
+        self.cookies = dict(cookies or {})
+        self.substring_match = substring_match
+        # Host -> [(position, cookie values)]
+        self._by_host = {}
+        # Cookies with a site that is not a host name, matched as substrings
+        self._substring_sites = []
+        self._cache = {}
+        for position, key in enumerate(self.cookies.keys()):
+            cookie = self.cookies[key]
+            if not cookie["active"]:
+                continue
+            host = get_url_host(cookie["site"])
+            if HOST_RE.match(host):
+                self._by_host.setdefault(host, []).append((position, cookie["value"]))
+            else:
+                self._substring_sites.append((position, cookie["site"], cookie["value"]))
+
+    def get_cookies(self, url):
+        """Returns the merged values of the cookies matching url, and the
+        Cookie header with those values (an empty dict if no cookies match)"""
+        if self.substring_match:
+            cookies = get_matching_cookies_dict(self.cookies, url)
+            return cookies, get_cookie_header(cookies)
+        host = get_url_host(url)
+        result = self._cache.get(host) if not self._substring_sites else None
+        if result is None:
+            result = self._match(host, url)
+            if not self._substring_sites:
+                self._cache[host] = result
+        return dict(result[0]), dict(result[1])
+
+    def _match(self, host, url):
+        matching = []
+        labels = host.split(".")
+        for i in range(len(labels)):
+            matching.extend(self._by_host.get(".".join(labels[i:]), ()))
+        for position, site, value in self._substring_sites:
+            if url.find(site) != -1:
+                matching.append((position, value))
+        # Merged in the order of the cookies in the config, like get_matching_cookies_dict
+        cookies = {}
+        for position, value in sorted(matching, key=lambda match: match[0]):
+            cookies.update(value)
+        return cookies, get_cookie_header(cookies)
+
+
 def get_cookie_header(cookies, url=None):
     """Takes a dictionary of cookie key/values,
     and returns the cookies matching url encoded
@@ -111,6 +257,28 @@ def url_fix(s, charset='utf-8'):
     return urlparse.urlunsplit((scheme, netloc, path, qs, anchor))
 
 
+# The bytes of an error page read by summarize_html_body, and the characters of text returned
+ERROR_PAGE_MAX_BYTES = 64 * 1024
+ERROR_PAGE_MAX_CHARS = 2000
+
+
+def summarize_html_body(html_page, max_bytes=ERROR_PAGE_MAX_BYTES, max_chars=ERROR_PAGE_MAX_CHARS):
+    """Returns the text of html_page (bytes or str), without scripts and styles, with one line
+    for each piece of text. Only the first max_bytes are read, and the parsing stops when
+    max_chars of text are found, so this is cheap enough for every error page of an RSS Feed.
+    clean_html_body gives a more readable result."""
+    if isinstance(html_page, bytes):
+        html_page = html_page[:max_bytes].decode("utf-8", "replace")
+    else:
+        html_page = html_page[:max_bytes]
+    summarizer = HTMLSummarizer(max_chars)
+    for i in range(0, len(html_page), 4096):
+        summarizer.feed(html_page[i:i + 4096])
+        if summarizer.full:
+            break
+    return summarizer.get_text()
+
+
 def clean_html_body(html_page):
     from bs4 import BeautifulSoup, Comment
     soup = BeautifulSoup(html_page, features="html5lib")
@@ -158,3 +326,38 @@ class HTMLStripper(HTMLParser):
                 data += i.rstrip()
             prev_empty = empty
         return data
+
+
+class HTMLSummarizer(HTMLParser):
+    """Collects the text of an HTML page, with the whitespace collapsed, until max_chars are found"""
+
+    SKIPPED_TAGS = ("script", "style")
+
+    def __init__(self, max_chars):
+        super(HTMLSummarizer, self).__init__()
+        self.reset()
+        self.max_chars = max_chars
+        self.lines = []
+        self.length = 0
+        self.full = False
+        self.skipped_tag = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIPPED_TAGS:
+            self.skipped_tag = tag
+
+    def handle_endtag(self, tag):
+        if tag == self.skipped_tag:
+            self.skipped_tag = None
+
+    def handle_data(self, d):
+        if self.full or self.skipped_tag is not None:
+            return
+        line = " ".join(d.split())
+        if line:
+            self.lines.append(line)
+            self.length += len(line) + 1
+            self.full = self.length >= self.max_chars
+
+    def get_text(self):
+        return "\n".join(self.lines)[:self.max_chars]
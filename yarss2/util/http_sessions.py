@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Pool of requests sessions, one for each host, so the TCP and TLS connections
+are reused by the next requests to the same host.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+    from urllib.parse import urlsplit
+except ImportError:
+    # python 2
+    from cookielib import DefaultCookiePolicy
+    from urlparse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from yarss2.error import DownloadRejectedError, FeedUpdateDeadlineError
+from yarss2.util import rate_limit
+
+# Maximum number of hosts with a session
+MAX_SESSIONS = 32
+# Maximum number of connections kept open to each host
+MAX_CONNECTIONS_PER_HOST = 4
+# Seconds an unused session is kept
+IDLE_TIMEOUT = 300
+# Bytes read from the response at a time
+CHUNK_SIZE = 64 * 1024
+
+# Content types that can not be an RSS Feed or a torrent file. The prefixes of the
+# types are compared, so "video/" matches all videos.
+FEED_REJECTED_TYPES = ("application/x-bittorrent", "audio/", "image/", "video/")
+TORRENT_REJECTED_TYPES = ("audio/", "image/", "video/")
+
+
+class SessionPool(object):
+    """Thread-safe pool of requests sessions, by host.
+
+    At most max_sessions sessions are kept. When a session is needed for a new host,
+    the least recently used session not in use is closed. Sessions that have not been
+    used for idle_timeout seconds are also closed.
+
+    The sessions do not store the cookies set by the servers, so each request
+    only sends the cookies given with the request, like requests.get.
+
+    If rate_limiter is given, each request waits for its turn in the rate limit of the site.
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, max_connections_per_host=MAX_CONNECTIONS_PER_HOST,
+                 idle_timeout=IDLE_TIMEOUT, clock=time.time, rate_limiter=None):
+        self.max_sessions = max_sessions
+        self.max_connections_per_host = max_connections_per_host
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.rate_limiter = rate_limiter
+        # The entries of the sessions by host, least recently used first
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self.created_count = 0
+        self.evicted_count = 0
+
+    def _create_session(self):
+        session = requests.Session()
+        session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections_per_host)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        self.created_count += 1
+        return session
+
+    def _acquire(self, host):
+        """Returns the entry of the session for host, marked as in use"""
+        with self._lock:
+            to_close = self._evict(self.clock())
+            entry = self._sessions.pop(host, None)
+            if entry is None:
+                entry = {"session": self._create_session(), "in_use": 0, "last_used": None}
+            entry["in_use"] += 1
+            self._sessions[host] = entry
+            to_close.extend(self._evict_lru())
+        for session in to_close:
+            session.close()
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry["in_use"] -= 1
+            entry["last_used"] = self.clock()
+
+    def _evict(self, now):
+        """Remove the idle sessions. Returns the sessions to close"""
+        evicted = []
+        for host, entry in list(self._sessions.items()):
+            if not entry["in_use"] and entry["last_used"] is not None and \
+               now - entry["last_used"] >= self.idle_timeout:
+                evicted.append(self._sessions.pop(host)["session"])
+        self.evicted_count += len(evicted)
+        return evicted
+
+    def _evict_lru(self):
+        """Remove the least recently used sessions not in use while there are too many"""
+        evicted = []
+        for host, entry in list(self._sessions.items()):
+            if len(self._sessions) <= self.max_sessions:
+                break
+            if not entry["in_use"]:
+                evicted.append(self._sessions.pop(host)["session"])
+        self.evicted_count += len(evicted)
+        return evicted
+
+    def request(self, method, url, **kwargs):
+        """Make a request with the session of the host of url.
+        The keyword arguments are passed on to requests.Session.request"""
+        if self.rate_limiter is not None:
+            self.rate_limiter.wait(url)
+        parts = urlsplit(url)
+        entry = self._acquire((parts.scheme.lower(), parts.netloc.lower()))
+        try:
+            return entry["session"].request(method, url, **kwargs)
+        finally:
+            self._release(entry)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def get_content(self, url, max_size=None, rejected_types=(), deadline=None, **kwargs):
+        """Make a GET request, and read the content of the response as it arrives.
+
+        Raises DownloadRejectedError without reading the content if the Content-Length
+        is larger than max_size or the Content-Type is in rejected_types, and while
+        reading the content if it becomes larger than max_size.
+        Raises FeedUpdateDeadlineError if deadline (a common.Deadline) passes while
+        the content is read.
+
+        Returns:
+            tuple: The response and the content
+        """
+        response = self.get(url, stream=True, **kwargs)
+        return response, read_content(response, max_size=max_size, rejected_types=rejected_types, deadline=deadline)
+
+    def evict_idle(self):
+        """Close the sessions that have been idle for idle_timeout seconds"""
+        with self._lock:
+            to_close = self._evict(self.clock())
+        for session in to_close:
+            session.close()
+
+    def close(self):
+        """Close all the sessions not in use"""
+        with self._lock:
+            to_close = [self._sessions.pop(host)["session"] for host, entry in list(self._sessions.items())
+                        if not entry["in_use"]]
+        for session in to_close:
+            session.close()
+
+    def get_stats(self):
+        with self._lock:
+            return {"sessions": len(self._sessions),
+                    "in_use": sum(1 for entry in self._sessions.values() if entry["in_use"]),
+                    "created": self.created_count,
+                    "evicted": self.evicted_count}
+
+
+def check_response_headers(url, headers, max_size=None, rejected_types=()):
+    """Raise DownloadRejectedError if the Content-Length or Content-Type in headers
+    show that the content of the response should not be read"""
+    content_type = (headers.get("content-type") or "").split(";")[0].strip().lower()
+    if content_type and content_type.startswith(tuple(rejected_types)):
+        raise DownloadRejectedError("Content type '%s' is not accepted: %s" % (content_type, url))
+    if max_size:
+        try:
+            length = int(headers.get("content-length") or 0)
+        except ValueError:
+            length = 0
+        if length > max_size:
+            raise DownloadRejectedError("Content length %d is larger than the limit of %d bytes: %s" %
+                                        (length, max_size, url))
+
+
+def check_content_size(url, size, max_size):
+    """Raise DownloadRejectedError if size bytes of the content is more than max_size"""
+    if max_size and size > max_size:
+        raise DownloadRejectedError("Download aborted after more than %d bytes: %s" % (max_size, url))
+
+
+def read_content(response, max_size=None, rejected_types=(), deadline=None):
+    """Read the content of a response of a streamed request, aborting the download
+    when it is larger than max_size, or when deadline (a common.Deadline) has passed.
+    The response is closed."""
+    try:
+        check_response_headers(response.url, response.headers, max_size, rejected_types)
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            check_content_size(response.url, size, max_size)
+            # The timeout only limits each read, so a slow server could keep sending after the deadline
+            if deadline is not None and deadline.expired():
+                raise FeedUpdateDeadlineError("Deadline passed after reading %d bytes: %s" % (size, response.url))
+            chunks.append(chunk)
+        return b"".join(chunks)
+    finally:
+        response.close()
+
+
+# The pool used for the RSS Feed and torrent downloads
+session_pool = SessionPool(rate_limiter=rate_limit.rate_limiter)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Rate limiting of the HTTP requests to each site, with a token bucket for each host,
+or for each domain with its own limits.
+
+The RSS Feed fetches, the torrent downloads of the updates and the torrents added
+from the GUI all wait on the same buckets, so the requests to a site are paced
+no matter how many are made concurrently.
+"""
+
+import threading
+import time
+
+from twisted.internet import defer, task
+
+from yarss2.util import logging
+from yarss2.util.http import get_hostname
+
+log = logging.getLogger(__name__)
+
+# Requests per second to each site, 0 for no limit
+DEFAULT_RATE = 0
+# Requests that can be made at once after a site has not been used for a while
+DEFAULT_BURST = 1
+
+
+class TokenBucket(object):
+    """Token bucket with rate tokens per second and room for burst tokens.
+
+    A request takes a token, and waits for it if the bucket is empty. The tokens
+    are reserved in the order the requests arrive, so the waiting requests are
+    served first come, first served.
+    """
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = now
+
+    def reserve(self, now):
+        """Take a token. Returns the seconds to wait before the token is available"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        # The tokens below zero are reserved by the requests waiting in line
+        return -self.tokens / self.rate
+
+
+class SiteRateLimiter(object):
+    """Thread-safe rate limiter with a TokenBucket for each site.
+
+    The limits of a site are taken from site_limits, with the site or one of its
+    parent domains as key, and the default rate and burst otherwise. A rate of 0
+    means the requests to the site are not limited. The hosts matching the same
+    domain in site_limits share the bucket of the domain.
+    """
+
+    def __init__(self, rate=DEFAULT_RATE, burst=DEFAULT_BURST, site_limits=None, clock=time.time,
+                 sleep=time.sleep):
+        self.clock = clock
+        self.sleep = sleep
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self.throttled_count = 0
+        self.wait_time = 0
+        self.set_limits(rate, burst, site_limits)
+
+    def set_limits(self, rate, burst, site_limits=None):
+        """Set the default limits, and the limits of each site as a dict of site -> (rate, burst).
+        The buckets are reset."""
+        with self._lock:
+            self.rate = rate
+            self.burst = burst
+            self.site_limits = dict((site.lower(), tuple(limits)) for site, limits in (site_limits or {}).items())
+            self._buckets = {}
+
+    def _get_limits(self, site):
+        """Returns the key of the bucket of site, which is the domain in site_limits
+        matching site, or site itself if none does, and the rate and burst"""
+        domain = site
+        while domain:
+            if domain in self.site_limits:
+                return (domain,) + self.site_limits[domain]
+            domain = domain.partition(".")[2]
+        return site, self.rate, self.burst
+
+    def reserve(self, url):
+        """Take a token from the bucket of the site of url.
+        Returns the seconds to wait before making the request"""
+        site = get_hostname(url) or ""
+        with self._lock:
+            key, rate, burst = self._get_limits(site)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if not rate or rate <= 0:
+                    return 0
+                bucket = self._buckets[key] = TokenBucket(rate, burst, self.clock())
+            delay = bucket.reserve(self.clock())
+            if delay:
+                self.throttled_count += 1
+                self.wait_time += delay
+        if delay:
+            log.debug("Waiting %.2f seconds before request to '%s'" % (delay, site))
+        return delay
+
+    def wait(self, url):
+        """Block until a request to url may be made. Must not be called in the reactor thread,
+        use wait_async there."""
+        delay = self.reserve(url)
+        if delay:
+            self.sleep(delay)
+
+    def wait_async(self, url, reactor):
+        """Returns a Deferred called when a request to url may be made"""
+        delay = self.reserve(url)
+        if not delay:
+            return defer.succeed(None)
+        return task.deferLater(reactor, delay, lambda: None)
+
+    def get_stats(self):
+        with self._lock:
+            return {"sites": len(self._buckets),
+                    "throttled": self.throttled_count,
+                    "wait_time": self.wait_time}
+
+
+# The rate limiter of all the requests of the plugin
+rate_limiter = SiteRateLimiter()
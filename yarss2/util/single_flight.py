@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+Coalescing of identical calls in progress, so concurrent callers share one result.
+"""
+
+import sys
+import threading
+
+from twisted.internet import defer
+from twisted.python.failure import Failure
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+        # The Deferreds of the callers of an asynchronous call
+        self.waiters = []
+
+
+class SingleFlight(object):
+    """Runs one call at a time for each key. A caller that finds a call with its key in
+    progress waits for that call and gets the same result, or the same exception.
+
+    The blocking calls (call) and the calls returning a Deferred (call_async) are kept
+    apart, as waiting for a call running in the reactor would block the reactor.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._async_calls = {}
+        self.coalesced_count = 0
+
+    def _find(self, calls, key):
+        flight = calls.get(key)
+        if flight is not None:
+            self.coalesced_count += 1
+        return flight
+
+    def call(self, key, f, *args, **kwargs):
+        """Call f with args and kwargs, or wait for the call in progress with key"""
+        with self._lock:
+            flight = self._find(self._calls, key)
+            if flight is None:
+                flight = self._calls[key] = _Call()
+                leader = True
+            else:
+                leader = False
+
+        if leader:
+            try:
+                flight.result = f(*args, **kwargs)
+            except Exception:
+                flight.exc_info = sys.exc_info()
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                flight.done.set()
+            return flight.result
+
+        flight.done.wait()
+        if flight.exc_info is not None:
+            raise flight.exc_info[1]
+        return flight.result
+
+    def call_async(self, key, f, *args, **kwargs):
+        """Call f, which returns a Deferred, or wait for the call in progress with key.
+        Must be called in the reactor thread.
+
+        Returns:
+            Deferred: Called with the result of the call. Each caller gets its own Deferred,
+                      so a caller cancelling its Deferred does not affect the others.
+        """
+        with self._lock:
+            flight = self._find(self._async_calls, key)
+        waiter = defer.Deferred()
+        if flight is not None:
+            flight.waiters.append(waiter)
+            return waiter
+
+        flight = _Call()
+        flight.waiters.append(waiter)
+        with self._lock:
+            self._async_calls[key] = flight
+
+        def on_result(result):
+            with self._lock:
+                del self._async_calls[key]
+            for d in flight.waiters:
+                # Not called if cancelled by the caller
+                if not d.called:
+                    if isinstance(result, Failure):
+                        d.errback(result)
+                    else:
+                        d.callback(result)
+
+        defer.maybeDeferred(f, *args, **kwargs).addBoth(on_result)
+        return waiter
+
+    def get_stats(self):
+        with self._lock:
+            return {"in_flight": len(self._calls) + len(self._async_calls),
+                    "coalesced": self.coalesced_count}
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2012-2019 bendikro bro.devel+yarss2@gmail.com
+#
+# This file is part of YaRSS2 and is licensed under GNU General Public License 3.0, or later, with
+# the additional special exception to link portions of this program with the OpenSSL library.
+# See LICENSE for more details.
+#
+
+"""
+On-disk cache of downloaded torrent files.
+
+The torrent files are stored by infohash, so a torrent linked by several URLs is stored once,
+and the URLs are mapped to the infohashes. A torrent is found by its infohash when the RSS Feed
+gives it, and by its URL otherwise. When the files take more than the size limit, the least
+recently used files are removed.
+
+The index of the URLs is written to disk after URLS_SAVE_BATCH changes, and by flush.
+"""
+
+import base64
+import binascii
+import hashlib
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from deluge import bencode
+
+from yarss2.util import logging
+
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+except ImportError:
+    # python 2
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit, urlunsplit
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MAX_SIZE = 100 * 1024 * 1024
+# The directory of the cache, in the config directory of deluge
+CACHE_DIRNAME = "yarss2_torrent_cache"
+URLS_FILENAME = "urls.json"
+TORRENT_EXTENSION = ".torrent"
+# Changes of the index of the URLs before it is written to disk
+URLS_SAVE_BATCH = 20
+
+MAGNET_INFOHASH_RE = re.compile(r"[?&]xt=urn:btih:([0-9a-zA-Z]+)")
+
+# Replaces an existing file also on Windows
+_replace = getattr(os, "replace", os.rename)
+
+
+def normalize_url(url):
+    """Returns url with lower case scheme and host, without the default port
+    and the fragment, and with the query parameters sorted"""
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = parts.netloc.lower()
+    default_port = {"http": ":80", "https": ":443"}.get(scheme)
+    if default_port and netloc.endswith(default_port):
+        netloc = netloc[:-len(default_port)]
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+def get_infohash(filedump):
+    """Returns the infohash (hex) of the torrent file in filedump, or None if it is not a torrent file"""
+    try:
+        info = bencode.bdecode(filedump)[b"info"]
+    except Exception:
+        return None
+    return hashlib.sha1(bencode.bencode(info)).hexdigest()
+
+
+def normalize_infohash(infohash):
+    """Returns the infohash in hex (40 characters) or base32 (32 characters) as lower case hex,
+    or None if it is not an infohash"""
+    if not infohash:
+        return None
+    infohash = infohash.strip()
+    if len(infohash) == 32:
+        try:
+            infohash = binascii.hexlify(base64.b32decode(infohash.upper())).decode("ascii")
+        except (TypeError, ValueError):
+            return None
+    if len(infohash) != 40:
+        return None
+    try:
+        int(infohash, 16)
+    except ValueError:
+        return None
+    return infohash.lower()
+
+
+def get_magnet_infohash(magnet):
+    """Returns the infohash (hex) of the magnet URI, or None"""
+    match = MAGNET_INFOHASH_RE.search(magnet or "")
+    return normalize_infohash(match.group(1)) if match else None
+
+
+class TorrentCache(object):
+    """Thread-safe cache of torrent files in directory, of at most max_size bytes"""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # Normalized URL -> infohash
+        self._urls = {}
+        # Infohash -> file size, least recently used first
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # Changes of _urls not written to disk
+        self._unsaved = 0
+        # Held while writing the index of the URLs, which is done without holding _lock
+        self._save_lock = threading.Lock()
+        self._load()
+
+    def _get_path(self, infohash):
+        return os.path.join(self.directory, infohash + TORRENT_EXTENSION)
+
+    def _load(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        files = []
+        for filename in os.listdir(self.directory):
+            if filename.endswith(TORRENT_EXTENSION):
+                stat = os.stat(os.path.join(self.directory, filename))
+                files.append((stat.st_mtime, filename[:-len(TORRENT_EXTENSION)], stat.st_size))
+        # The modification time is updated when a file is read
+        for mtime, infohash, size in sorted(files):
+            self._entries[infohash] = size
+        try:
+            with open(os.path.join(self.directory, URLS_FILENAME)) as f:
+                urls = json.load(f)
+        except (IOError, OSError, ValueError):
+            urls = {}
+        self._urls = dict((url, infohash) for url, infohash in urls.items() if infohash in self._entries)
+        if self._evict() or len(self._urls) != len(urls):
+            self._unsaved += 1
+
+    def flush(self):
+        """Write the index of the URLs to disk if it has changed"""
+        with self._save_lock:
+            with self._lock:
+                if not self._unsaved:
+                    return
+                urls = dict(self._urls)
+                self._unsaved = 0
+            path = os.path.join(self.directory, URLS_FILENAME)
+            try:
+                with open(path + ".tmp", "w") as f:
+                    json.dump(urls, f)
+                _replace(path + ".tmp", path)
+            except (IOError, OSError) as err:
+                log.warning("Failed to save the URLs of the cached torrent files: %s" % err)
+                with self._lock:
+                    self._unsaved += 1
+
+    def _evict(self):
+        """Remove the least recently used files while the cache is larger than max_size"""
+        size = sum(self._entries.values())
+        evicted = set()
+        while self._entries and size > self.max_size:
+            infohash, file_size = self._entries.popitem(last=False)
+            size -= file_size
+            evicted.add(infohash)
+            try:
+                os.remove(self._get_path(infohash))
+            except OSError as err:
+                log.warning("Failed to remove cached torrent file %s: %s" % (infohash, err))
+        if evicted:
+            self._urls = dict((url, infohash) for url, infohash in self._urls.items() if infohash not in evicted)
+        return evicted
+
+    def set_max_size(self, max_size):
+        with self._lock:
+            self.max_size = max_size
+            if self._evict():
+                self._unsaved += 1
+
+    def get(self, url, infohash=None):
+        """Returns the cached torrent file with infohash (given by the RSS Feed), or downloaded
+        from url, or None"""
+        infohash = normalize_infohash(infohash)
+        with self._lock:
+            if infohash not in self._entries:
+                infohash = self._urls.get(normalize_url(url))
+            if infohash is None:
+                self.misses += 1
+                return None
+            self._entries[infohash] = self._entries.pop(infohash)
+            path = self._get_path(infohash)
+        try:
+            with open(path, "rb") as f:
+                filedump = f.read()
+            os.utime(path, None)
+        except (IOError, OSError, ValueError) as err:
+            log.warning("Failed to read cached torrent file for '%s': %s" % (url, err))
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return filedump
+
+    def put(self, url, filedump):
+        """Store the torrent file downloaded from url. Returns the infohash, or None
+        if filedump is not a torrent file or is larger than the cache"""
+        infohash = get_infohash(filedump)
+        if infohash is None or len(filedump) > self.max_size:
+            return None
+        path = self._get_path(infohash)
+        url = normalize_url(url)
+        with self._lock:
+            try:
+                if infohash not in self._entries:
+                    with open(path + ".tmp", "wb") as f:
+                        f.write(filedump)
+                    _replace(path + ".tmp", path)
+                    self._entries[infohash] = len(filedump)
+                else:
+                    self._entries[infohash] = self._entries.pop(infohash)
+            except (IOError, OSError) as err:
+                log.warning("Failed to cache torrent file from '%s': %s" % (url, err))
+                return None
+            if self._urls.get(url) != infohash:
+                self._urls[url] = infohash
+                self._unsaved += 1
+            if self._evict():
+                self._unsaved += 1
+            save = self._unsaved >= URLS_SAVE_BATCH
+        if save:
+            self.flush()
+        return infohash
+
+    def get_stats(self):
+        with self._lock:
+            return {"files": len(self._entries), "size": sum(self._entries.values()), "urls": len(self._urls),
+                    "hits": self.hits, "misses": self.misses}
@@ -14,7 +14,7 @@ import deluge.component as component
 import deluge.configmanager
 from deluge.event import DelugeEvent
 
-from yarss2.util import common
+from yarss2.util import common, http
 from yarss2.util.common import GeneralSubsConf
 
 try:
@@ -26,6 +26,26 @@ except NameError:
 
 LATEST_CONFIG_VERSION = 8
 DEFAULT_UPDATE_INTERVAL = 120
+DEFAULT_ADAPTIVE_INTERVAL_MIN = 5
+DEFAULT_ADAPTIVE_INTERVAL_MAX = 720
+DEFAULT_MAX_CONCURRENT_FEED_UPDATES = 3
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 1
+DEFAULT_MAX_CONCURRENT_FEED_MATCHING = 1
+DEFAULT_MAX_CONCURRENT_TORRENT_DOWNLOADS = 4
+DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST = 2
+DEFAULT_STARTUP_UPDATE_SPACING = 2
+DEFAULT_FEED_UPDATE_DEADLINE = 300
+DEFAULT_MAX_FEED_SIZE = 10 * 1024 * 1024
+DEFAULT_MAX_TORRENT_SIZE = 10 * 1024 * 1024
+DEFAULT_TORRENT_CACHE_SIZE = 100 * 1024 * 1024
+DEFAULT_FAILED_DOWNLOAD_TTL = 60 * 60
+DEFAULT_FAILED_DOWNLOAD_MAX_RETRIES = 5
+DEFAULT_SITE_REQUEST_RATE = 0
+DEFAULT_SITE_REQUEST_BURST = 1
+DEFAULT_PERMANENT_REDIRECT_THRESHOLD = 3
+DEFAULT_GONE_DEACTIVATE_THRESHOLD = 5
+DEFAULT_GONE_DEACTIVATE_MIN_TIME = 24 * 60 * 60
+DEFAULT_FEED_PARSER = u"auto"
 
 DUMMY_RSSFEED_KEY = "9999"
 CONFIG_FILENAME = "yarss2.conf"
@@ -36,7 +56,7 @@ __DEFAULT_PREFS = {
     "subscriptions": {},
     "cookies": {},
     "email_messages": {},
-    "general": {"show_log_in_gui": True},
+    "general": {},
 }
 
 
@@ -55,7 +75,9 @@ def get_user_agent(rssfeed_data=None):
 
 
 def default_prefs():
-    return copy.deepcopy(__DEFAULT_PREFS)
+    prefs = copy.deepcopy(__DEFAULT_PREFS)
+    prefs["general"] = get_fresh_general_config()
+    return prefs
 
 
 class YARSSConfigChangedEvent(DelugeEvent):
@@ -75,6 +97,8 @@ class YARSSConfig(object):
         self.log = logger
         self.core_config = core_config
         self.config = config
+        # Built from the cookies when needed, see get_cookie_index
+        self._cookie_index = None
 
         # Prividing a config here us used for testing
         if config is None:
@@ -113,8 +137,17 @@ class YARSSConfig(object):
         """Replaces the config data in self.config with the available keys in config"""
         for key in config.keys():
             self.config[key] = config[key]
+        if "cookies" in config or "general" in config:
+            self._cookie_index = None
         self.config.save()
 
+    def get_cookie_index(self):
+        """Returns the http.CookieIndex of the cookies, which is rebuilt after the cookies are changed"""
+        if self._cookie_index is None:
+            self._cookie_index = http.CookieIndex(self.config["cookies"],
+                                                  substring_match=self.config["general"]["cookie_substring_match"])
+        return self._cookie_index
+
     def generic_save_config(self, config_name, dict_key=None, data_dict=None, delete=False):
         """Save email message to config.
 
@@ -131,6 +164,8 @@ class YARSSConfig(object):
             raise ValueError("Invalid config key:" + str(config_name))
 
         config = self.config[config_name]
+        if config_name == "cookies":
+            self._cookie_index = None
 
         # Means delete
         if data_dict is None:
@@ -202,6 +237,12 @@ class YARSSConfig(object):
         if self._verify_types(None, self.config["email_configurations"], default_config):
             changed = True
 
+        default_config = get_fresh_general_config()
+        if self._insert_missing_dict_values(self.config["general"], default_config, level=1):
+            changed = True
+        if self._verify_types(None, self.config["general"], default_config):
+            changed = True
+
         if changed:
             self.config.save()
 
@@ -512,6 +553,53 @@ def get_fresh_email_config():
     return config_dict
 
 
+def get_fresh_general_config():
+    """Return the default general dictionary"""
+    config_dict = {}
+    config_dict["show_log_in_gui"] = True
+    # Number of RSS Feeds updated in parallel, and how many of those may access the same host
+    config_dict["max_concurrent_feed_updates"] = DEFAULT_MAX_CONCURRENT_FEED_UPDATES
+    config_dict["max_connections_per_host"] = DEFAULT_MAX_CONNECTIONS_PER_HOST
+    # Number of RSS Feeds matched against the subscriptions in parallel
+    config_dict["max_concurrent_feed_matching"] = DEFAULT_MAX_CONCURRENT_FEED_MATCHING
+    # Number of torrent files downloaded in parallel, and how many of those from the same host
+    config_dict["max_concurrent_torrent_downloads"] = DEFAULT_MAX_CONCURRENT_TORRENT_DOWNLOADS
+    config_dict["max_torrent_downloads_per_host"] = DEFAULT_MAX_TORRENT_DOWNLOADS_PER_HOST
+    # Seconds between the updates of the RSS Feeds that are updated on startup
+    config_dict["startup_update_spacing"] = DEFAULT_STARTUP_UPDATE_SPACING
+    # Seconds an update of an RSS Feed (fetch, parse, match and torrent downloads) may take before it is abandoned
+    config_dict["feed_update_deadline"] = DEFAULT_FEED_UPDATE_DEADLINE
+    # Download the RSS Feeds and torrent files with the Twisted HTTP client instead of in worker threads
+    config_dict["use_async_http"] = False
+    # Bytes of an RSS Feed or a torrent file to download. Larger downloads are aborted.
+    config_dict["max_feed_size"] = DEFAULT_MAX_FEED_SIZE
+    config_dict["max_torrent_size"] = DEFAULT_MAX_TORRENT_SIZE
+    # Match the cookies whose site is a substring of the URL, instead of the cookies
+    # of the host of the URL and its parent domains
+    config_dict["cookie_substring_match"] = False
+    # Bytes of downloaded torrent files kept on disk, so they are not downloaded again. 0 disables the cache.
+    config_dict["torrent_cache_size"] = DEFAULT_TORRENT_CACHE_SIZE
+    # Seconds a torrent URL that failed to download is skipped, and the number of failures
+    # after which it is no longer retried (0 to always retry)
+    config_dict["failed_download_ttl"] = DEFAULT_FAILED_DOWNLOAD_TTL
+    config_dict["failed_download_max_retries"] = DEFAULT_FAILED_DOWNLOAD_MAX_RETRIES
+    # Requests per second and burst size of the requests to each site (0 for no limit),
+    # and the limits of specific sites as a dict of site -> [rate, burst]
+    config_dict["site_request_rate"] = DEFAULT_SITE_REQUEST_RATE
+    config_dict["site_request_burst"] = DEFAULT_SITE_REQUEST_BURST
+    config_dict["site_rate_limits"] = {}
+    # Updates in a row an RSS Feed must be permanently redirected to the same URL before the URL
+    # is changed, and the updates in a row where it is gone (410 Gone, or the host name is not
+    # found) before it is deactivated. 0 to never change the URL or deactivate the RSS Feed.
+    config_dict["permanent_redirect_threshold"] = DEFAULT_PERMANENT_REDIRECT_THRESHOLD
+    config_dict["gone_deactivate_threshold"] = DEFAULT_GONE_DEACTIVATE_THRESHOLD
+    # Seconds an RSS Feed must have been gone before it is deactivated
+    config_dict["gone_deactivate_min_time"] = DEFAULT_GONE_DEACTIVATE_MIN_TIME
+    # The parser of the RSS Feeds: "auto" (lxml if installed, else atoma), "lxml" or "atoma"
+    config_dict["feed_parser"] = DEFAULT_FEED_PARSER
+    return config_dict
+
+
 def get_fresh_rssfeed_config(name=u"", url=u"", site=u"", active=True, last_update=u"",
                              update_interval=DEFAULT_UPDATE_INTERVAL, update_on_startup=False,
                              obey_ttl=False, user_agent=u"", key=None):
@@ -522,11 +610,26 @@ def get_fresh_rssfeed_config(name=u"", url=u"", site=u"", active=True, last_upda
     config_dict["site"] = site
     config_dict["active"] = active
     config_dict["last_update"] = last_update
+    config_dict["next_update"] = u""
     config_dict["update_interval"] = update_interval
     config_dict["update_on_startup"] = update_on_startup
     config_dict["obey_ttl"] = obey_ttl
     config_dict["user_agent"] = user_agent
     config_dict["prefer_magnet"] = False
+    # The ETag and Last-Modified headers of the last response, sent back with the next
+    # request so the server can answer 304 Not Modified if the RSS Feed has not changed
+    config_dict["etag"] = u""
+    config_dict["last_modified"] = u""
+    # Hash of the content of the last response. The RSS Feed is not parsed again
+    # when the server sends the same content.
+    config_dict["content_hash"] = u""
+    # Adapt the update interval to how often the RSS Feed publishes new items,
+    # within the bounds (in minutes). update_interval is used until it can be estimated.
+    config_dict["adaptive_interval"] = False
+    config_dict["adaptive_interval_min"] = DEFAULT_ADAPTIVE_INTERVAL_MIN
+    config_dict["adaptive_interval_max"] = DEFAULT_ADAPTIVE_INTERVAL_MAX
+    # The parser of the RSS Feed, or empty to use the feed_parser of the general config
+    config_dict["parser"] = u""
     if key:
         config_dict["key"] = key
     return config_dict